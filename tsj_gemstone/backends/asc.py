@@ -3,35 +3,18 @@ import glob
 import io
 import logging
 import os
-import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
 import zipfile
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import LRU_CACHE_MAXSIZE, XMLBackend, XMLHandler, ImportSourceError, SkipDiamond, KeyValueError
-from .. import models
+from .base import XMLBackend, XMLHandler, ImportSourceError, SkipDiamond, KeyValueError, clean, cached_clean
 from ..prefs import prefs
 from ..utils import moneyfmt
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 class ASCHandler(XMLHandler):
     def __init__(self, backend, writer):
         # ContentHandler is an old-style class
@@ -64,6 +47,8 @@ class ASCHandler(XMLHandler):
 
 class Backend(XMLBackend):
     handler_class = ASCHandler
+    prefilter_carat_weight = 'Stone1Wt'
+    prefilter_total_price = 'LastCost'
 
     infile_glob = os.path.join(settings.FTP_ROOT, '{username}/data/ASC_ITEM_*XML')
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/asc.xml')
@@ -120,7 +105,7 @@ class Backend(XMLBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(data.get('Stone1Color'), upper=True))
+        color = self.color_aliases.resolve(data.get('Stone1Color'))
 
         certifier = cached_clean(data.get('StoneCertLab1'), upper=True)
         # If the diamond must be certified and it isn't, raise an exception to prevent it from being imported
@@ -138,9 +123,7 @@ class Backend(XMLBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -152,7 +135,7 @@ class Backend(XMLBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('StoneCutGrade1'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('StoneCutGrade1'))
 
         try:
             price = clean(data.get('LastCost').replace(',', ''))
@@ -182,25 +165,21 @@ class Backend(XMLBackend):
             girdle = ''
 
         culet = cached_clean(data.get('cs'), upper=True)
-        polish = self.grading_aliases.get(cached_clean(data.get('StonePolish1'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('StoneSymmetry1'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('StonePolish1'))
+        symmetry = self.grading_aliases.resolve(data.get('StoneSymmetry1'))
 
         fluorescence = cached_clean(data.get('StoneFluorescence1'), upper=True).split()
         fluorescence_id = None
         if fluorescence:
-            for name, id in self.fluorescence_aliases.iteritems():
-                if name == fluorescence[0]:
-                    fluorescence_id = id
-                    continue
+            fluorescence_id = self.fluorescence_aliases.get(fluorescence[0])
         fluorescence = fluorescence_id
 
         fluorescence_color = cached_clean(data.get('fc'), upper=True)
         fluorescence_color_id = None
         if fluorescence_color:
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
             if not fluorescence_color_id: fluorescence_color_id = None
         fluorescence_color = fluorescence_color_id
 
@@ -225,16 +204,7 @@ class Backend(XMLBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -4,35 +4,21 @@ import logging
 import json
 import os
 import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
 from urlparse import urlparse
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
-from thinkspace.utils.http import url_exists
 
-from .base import LRU_CACHE_MAXSIZE, CSVBackend, SkipDiamond, KeyValueError, ImportSourceError
-from .. import models
+from .base import CSVBackend, SkipDiamond, KeyValueError, ImportSourceError, clean, cached_clean
 from ..prefs import prefs
 from ..utils import moneyfmt
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
 # TODO: Need to handle spaces between dimensions
 MEASUREMENT_RE = re.compile('[\sx*-]')
 
-def clean(data, upper=False):
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 def split_measurements(measurements):
     try:
         length, width, depth = [x for x in MEASUREMENT_RE.split(measurements) if x]
@@ -44,6 +30,9 @@ def split_measurements(measurements):
 class Backend(CSVBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/atlantic-diamond.csv')
     infile_glob = os.path.join(settings.FTP_ROOT, 'atlanticdiamond-ftp/1243-diamonds.csv')
+    prefilter_width = 44
+    prefilter_carat_weight = 1
+    prefilter_carat_price = 7
 
     def get_default_filename(self):
         try:
@@ -137,7 +126,7 @@ class Backend(CSVBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        # color = self.color_aliases.get(cached_clean(color, upper=True))
+        # color = self.color_aliases.resolve(color)
 
         if fancy_color:
             color = None
@@ -145,7 +134,7 @@ class Backend(CSVBackend):
             fancy_color_id = self.fancy_colors.get(fancy_color)
         else:
             fancy_color_id = None
-            color = self.color_aliases.get(cached_clean(color, upper=True))
+            color = self.color_aliases.resolve(color)
 
         if fancy_color_intensity:
             fancy_color_intensity = cached_clean(fancy_color_intensity.replace('-', ' ').lower())
@@ -173,9 +162,7 @@ class Backend(CSVBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -187,7 +174,7 @@ class Backend(CSVBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(cut_grade, upper=True))
+        cut_grade = self.grading_aliases.resolve(cut_grade)
         carat_price = clean(carat_price.replace(',', ''))
         try:
             carat_price = Decimal(carat_price)
@@ -216,26 +203,24 @@ class Backend(CSVBackend):
             girdle = ''
 
         culet = cached_clean(culet, upper=True)
-        polish = self.grading_aliases.get(cached_clean(polish, upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(symmetry, upper=True))
+        polish = self.grading_aliases.resolve(polish)
+        symmetry = self.grading_aliases.resolve(symmetry)
 
         fluorescence = cached_clean(fluorescence, upper=True)
         fluorescence_id = None
         fluorescence_color = None
         fluorescence_color_id = None
-        for abbr, id in self.fluorescence_aliases.iteritems():
-            if fluorescence.startswith(abbr.upper()):
-                fluorescence_id = id
-                fluorescence_color = fluorescence.replace(abbr.upper(), '')
-                continue
+        abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+        if abbr:
+            fluorescence_id = id
+            fluorescence_color = fluorescence.replace(abbr, '')
         fluorescence = fluorescence_id
 
         if fluorescence_color:
             fluorescence_color = cached_clean(fluorescence_color, upper=True)
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
             if not fluorescence_color_id: fluorescence_color_id = None
         fluorescence_color = fluorescence_color_id
 
@@ -247,8 +232,6 @@ class Backend(CSVBackend):
         cert_image = cert_image.replace('.net//', '.net/').replace('\\', '/').strip()
         if not cert_image:
             cert_image = ''
-        elif verify_cert_images and cert_image != '' and not url_exists(cert_image):
-            cert_image = ''
 
 
         measurements = clean(measurements)
@@ -278,16 +261,7 @@ class Backend(CSVBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -1,26 +1,206 @@
+from bisect import bisect_right
 from collections import defaultdict, namedtuple
+from cStringIO import StringIO
 from datetime import datetime
-from decimal import Decimal
+from decimal import Decimal, InvalidOperation
+from hashlib import md5
 import csv
 import logging
-import tempfile
+from multiprocessing.pool import ThreadPool
+import re
+from string import ascii_letters, digits, whitespace, punctuation
+import sys
 import xml.sax
+import zipfile
 
 from xlrd import open_workbook
 
 from psycopg2.extras import Json
+import requests
 
 from django.conf import settings
+from django.core.cache import cache
 from django.db import connection, transaction
+from django.utils.encoding import force_text
+from django.utils.lru_cache import lru_cache
 
 from .. import models
+from ..managers import get_schema_name, invalidate_alias_dicts, remember_schema
 from ..prefs import prefs
+from ..summary import rebuild_summary
 
 logger = logging.getLogger('tsj_gemstone.backends')
 summary_logger = logging.getLogger('tsj_gemstone.backends.summary')
 
 LRU_CACHE_MAXSIZE = 2**16
 
+CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
+
+# Bytes of formatted rows to hold in memory before streaming them to COPY
+COPY_BUFFER_SIZE = 2**22
+
+# Turns a pg_get_indexdef() of one of the diamond table's indexes into an
+# anonymous index on another table (see StagingCopyWriter.create_indexes)
+INDEX_DEF_RE = re.compile(r'^CREATE (UNIQUE )?INDEX \S+ ON (ONLY )?\S+ ')
+
+# COPY into an unlogged per-source staging table and check every row got
+# there before swapping them in (see StagingCopyWriter).  Imports which
+# replace a source always do once tsj_gemstone_diamond is partitioned.
+STAGING_IMPORT = getattr(settings, 'TSJ_GEMSTONE_STAGING_IMPORT', False)
+
+# With the rapaport_verify_cert_images pref, how many cert image URLs to
+# check at once and how long (in seconds) to remember each answer
+CERT_IMAGE_WORKERS = getattr(settings, 'TSJ_GEMSTONE_CERT_IMAGE_WORKERS', 16)
+CERT_IMAGE_CACHE_TIMEOUT = getattr(settings, 'TSJ_GEMSTONE_CERT_IMAGE_CACHE_TIMEOUT', 60 * 60 * 24 * 7)
+
+def is_partitioned(cursor, table='tsj_gemstone_diamond'):
+    "Whether `table` is partitioned (see migration 0011)"
+    cursor.execute('SELECT relkind FROM pg_class WHERE oid=%s::regclass', (table,))
+    return cursor.fetchone()[0] == 'p'
+
+def clean(data, upper=False):
+    if data is None:
+        return ''
+    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
+    if upper:
+        data = data.upper()
+
+    return data
+
+cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
+
+class AliasTable(dict):
+    """
+    An alias -> id mapping as returned by DictManager.as_dict, which also
+    resolves raw feed values: cleaned and upper cased lookups, and the
+    longest alias a value starts with (e.g. fluorescence "MEDIUM BLUE").
+    Lookups are memoized per raw value since feeds repeat the same handful
+    of grades on every row.
+    """
+    def __init__(self, *args, **kwargs):
+        super(AliasTable, self).__init__(*args, **kwargs)
+        self.reset()
+
+    def reset(self):
+        self._resolved = {}
+        self._prefixed = {}
+        self._prefix_lengths = None
+
+    def __setitem__(self, key, value):
+        super(AliasTable, self).__setitem__(key, value)
+        self.reset()
+
+    def update(self, *args, **kwargs):
+        super(AliasTable, self).update(*args, **kwargs)
+        self.reset()
+
+    def resolve(self, value):
+        """Return the id `value` is an alias of, or None."""
+        try:
+            return self._resolved[value]
+        except KeyError:
+            id = self._resolved[value] = self.get(cached_clean(value, upper=True))
+            return id
+
+    def match_prefix(self, value):
+        """
+        Return (alias, id) for the longest alias `value` starts with, or
+        (None, None) if it doesn't start with any of them.
+        """
+        try:
+            return self._prefixed[value]
+        except KeyError:
+            pass
+
+        if self._prefix_lengths is None:
+            self._prefix_lengths = sorted(set(len(alias) for alias in self if alias), reverse=True)
+
+        match = (None, None)
+        if value:
+            for length in self._prefix_lengths:
+                if length <= len(value) and value[:length] in self:
+                    match = (value[:length], self[value[:length]])
+                    break
+
+        self._prefixed[value] = match
+        return match
+
+class MarkupTable(object):
+    """
+    DiamondMarkup-style (minimum, maximum, percent) ranges sorted by their
+    minimum so the range for a diamond can be found with a bisect instead of
+    a scan.  Where ranges overlap the one with the greatest minimum wins.
+    A missing minimum is open ended and a missing maximum never matches,
+    as with the comparisons this replaces.
+    """
+    def __init__(self, ranges, name='Markup', by_carat_weight=False):
+        self.name = name
+        self.by_carat_weight = by_carat_weight
+        self.ranges = sorted(r for r in ranges if r[1] is not None)
+        self.minimums = [r[0] for r in self.ranges]
+        # The furthest any range up to and including i reaches, so find()
+        # knows when it can stop walking back through overlapping ranges
+        self.reach = []
+        for minimum, maximum, percent in self.ranges:
+            self.reach.append(max(maximum, self.reach[-1]) if self.reach else maximum)
+
+    def __nonzero__(self):
+        return bool(self.ranges)
+
+    def check(self):
+        """Log overlapping and gapped ranges, which are usually typos."""
+        for (min1, max1, _), (min2, max2, _) in zip(self.ranges, self.ranges[1:]):
+            if min2 <= max1:
+                logger.warning('%s ranges %s-%s and %s-%s overlap', self.name, min1, max1, min2, max2)
+            elif min2 > max1 + Decimal(1).scaleb(max1.as_tuple().exponent):
+                logger.warning('%s ranges %s-%s and %s-%s leave a gap', self.name, min1, max1, min2, max2)
+
+    def find(self, value):
+        """Return the percent for the range containing `value`, or None."""
+        i = bisect_right(self.minimums, value)
+        while i:
+            i -= 1
+            if self.reach[i] < value:
+                break
+            if self.ranges[i][1] >= value:
+                return self.ranges[i][2]
+        return None
+
+    def percent(self, price, carat_weight):
+        return self.find(carat_weight if self.by_carat_weight else price)
+
+    def apply(self, price, carat_weight):
+        """
+        Return `price` marked up by the range it (or `carat_weight`, when
+        markups are by carat weight) falls in, or None if there isn't one.
+        """
+        percent = self.percent(price, carat_weight)
+        if percent is None:
+            return None
+        return price * (1 + percent/100)
+
+class Markup(object):
+    """
+    The markups for an import, built once in populate_import_data.
+    Lab-grown diamonds use the LabGrownDiamondMarkup ranges when there are
+    any and everything else uses the DiamondMarkup ones.
+    """
+    def __init__(self, markup_list, lab_markup_list, by_carat_weight=False):
+        self.by_carat_weight = by_carat_weight
+        self.mined = MarkupTable(markup_list, 'Diamond markup', by_carat_weight)
+        self.lab = MarkupTable(lab_markup_list, 'Lab-grown diamond markup', by_carat_weight)
+        self.mined.check()
+        self.lab.check()
+
+    def get_table(self, manmade='f'):
+        return self.lab if manmade != 'f' and self.lab else self.mined
+
+    def percent(self, price, carat_weight, manmade='f'):
+        return self.get_table(manmade).percent(price, carat_weight)
+
+    def apply(self, price, carat_weight, manmade='f'):
+        return self.get_table(manmade).apply(price, carat_weight)
+
 class KeyValueError(Exception):
     def __init__(self, key, value):
         self.key, self.value = key, value
@@ -29,20 +209,468 @@ class KeyValueError(Exception):
         return 'KeyValueError: %s[%s]' % (self.key, self.value)
 
 class SkipDiamond(Exception):
-    pass
+    """
+    Raised to leave a diamond out of the import.  Arguments after `reason`
+    fill in its placeholders, but only once per distinct set of them when
+    the import is reported, so the per-diamond cost is just counting.
+    Pass arguments which are cheap to hash, like strings, on hot paths.
+    """
+    def __init__(self, reason, *args):
+        super(SkipDiamond, self).__init__(reason, *args)
+
+    def __str__(self):
+        return format_reason(self.args)
+
+def format_reason(key):
+    reason, args = key[0], key[1:]
+    if args:
+        return reason % args
+    return reason
+
+class Rejection(object):
+    """
+    Returned by write_diamond_row instead of a row to leave the diamond out
+    of the import, the same as raising SkipDiamond or KeyValueError without
+    the cost of raising.  Rejections which don't depend on the row can be
+    made once and returned every time.
+    """
+    __slots__ = ()
+
+    def count(self, backend):
+        raise NotImplementedError
+
+class Skip(Rejection):
+    "Skips the diamond for `reason`, formatted with `args` like SkipDiamond"
+    __slots__ = ('key',)
+
+    def __init__(self, reason, *args):
+        self.key = (reason,) + args
+
+    def count(self, backend):
+        backend.skip_counts[self.key] += 1
+
+class MissingValue(Rejection):
+    "Skips the diamond for a value `key` has no alias for, like KeyValueError"
+    __slots__ = ('key', 'value')
+
+    def __init__(self, key, value):
+        self.key, self.value = key, value
+
+    def count(self, backend):
+        backend.missing_values[self.key][self.value] += 1
+
+MISSING_DELTA_KEY_MESSAGE = 'No %s to match the diamond with between imports.'
+
+CARAT_WEIGHT_MINIMUM_MESSAGE = 'Carat weight is less than the minimum of %s.'
+CARAT_WEIGHT_MAXIMUM_MESSAGE = 'Carat weight is greater than the maximum of %s.'
+PRICE_MINIMUM_MESSAGE = 'Price before markup is less than the minimum of %s.'
+PRICE_MAXIMUM_MESSAGE = 'Price before markup is greater than the maximum of %s.'
 
 class SkipImport(Exception):
     pass
 
+class PendingCertifier(object):
+    """
+    Stands in for the id of a certifier the feed has which isn't in the
+    database yet, until BaseBackend.create_certifiers gives it one.  Rows
+    are formatted for COPY with str(), so they don't need rewriting.
+    """
+    __slots__ = ('abbr', 'id', 'disabled')
+
+    def __init__(self, abbr):
+        self.abbr = abbr
+        self.id = None
+        self.disabled = False
+
+    def __int__(self):
+        if self.id is None:
+            raise ValueError('Certifier %s has not been created yet' % self.abbr)
+        return self.id
+
+    def __str__(self):
+        return str(int(self))
+
 # A failure to load source data from the backend (HTTP error, API error, missing file, etc)
 class ImportSourceError(Exception):
     pass
 
+# The feed is the same as the one last imported, and so is everything else
+# which decides what its rows become
+class FeedUnchanged(Exception):
+    pass
+
+class CertImageVerifier(object):
+    """
+    Checks that cert image URLs exist for a batch of rows at a time, with a
+    pool of threads sharing one HTTP session, and blanks out the ones that
+    don't.  Answers are kept in the cache so the next import (of this or any
+    other site) only has to check new URLs.
+    """
+    def __init__(self, workers=CERT_IMAGE_WORKERS, timeout=CERT_IMAGE_CACHE_TIMEOUT, request_timeout=10):
+        self.timeout = timeout
+        self.request_timeout = request_timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = ThreadPool(workers)
+        self.results = {}
+
+    def get_cache_key(self, url):
+        return 'tsj_gemstone:cert_image:%s' % md5(url if isinstance(url, bytes) else url.encode('utf-8')).hexdigest()
+
+    def url_exists(self, url):
+        try:
+            response = self.session.head(url, allow_redirects=True, timeout=self.request_timeout)
+            if response.status_code == 405:
+                response = self.session.get(url, stream=True, timeout=self.request_timeout)
+                response.close()
+        except (requests.RequestException, ValueError):
+            return False
+        return response.status_code < 400
+
+    def verify(self, urls):
+        """Return a dict of whether each of `urls` exists."""
+        keys = dict((self.get_cache_key(url), url) for url in set(urls) if url not in self.results)
+        for key, exists in cache.get_many(keys.keys()).iteritems():
+            self.results[keys.pop(key)] = exists
+
+        if keys:
+            urls = keys.values()
+            found = dict(zip(urls, self.pool.map(self.url_exists, urls)))
+            self.results.update(found)
+            cache.set_many(dict((self.get_cache_key(url), exists) for url, exists in found.iteritems()), self.timeout)
+
+        return self.results
+
+    def filter_rows(self, rows):
+        results = self.verify(row.cert_image for row in rows if row.cert_image and row.cert_image != 'NULL')
+        return [
+            row._replace(cert_image='') if row.cert_image in results and not results[row.cert_image] else row
+            for row in rows
+        ]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.session.close()
+
+class GradeOrders(object):
+    """
+    Adds the diamonds' *_order columns (see models.GRADE_ORDER_FIELDS) to
+    rows, looked up from the grade ids already in them, so they're copied
+    along with the rest of the row.
+    """
+    fields = tuple(name + '_order' for name in models.GRADE_ORDER_FIELDS)
+
+    def __init__(self, row_fields):
+        self.columns = []
+        grade_orders = models.get_grade_orders()
+        for name in models.GRADE_ORDER_FIELDS:
+            orders = grade_orders[name]
+            # Backends write ids as ints or strings
+            orders.update([(str(id), order) for id, order in orders.items()])
+            self.columns.append((row_fields.index(name + '_id'), orders))
+
+    def extend(self, rows):
+        columns = self.columns
+        return [tuple(row) + tuple(orders.get(row[i], 'NULL') for i, orders in columns) for row in rows]
+
+class CopyWriter(object):
+    """
+    Stands in for the csv.writer that backends used to write into a temp
+    file.  Rows are formatted for COPY into an in-memory buffer which is
+    streamed to the database each time it grows past `buffer_size`, so a
+    feed never has to be written out to local disk.
+
+    Rows are copied into a temporary table as the feed is read, outside of
+    any transaction, so nothing is locked while the feed downloads.  close()
+    then replaces the source's rows (see BaseBackend.delete_existing) from
+    it in one short transaction, and abort() just drops it.  The temporary
+    table has no defaults, so ids are only drawn from the sequence once the
+    rows are inserted.
+    """
+    def __init__(self, backend, table='tsj_gemstone_diamond', buffer_size=COPY_BUFFER_SIZE):
+        self.backend = backend
+        self.table = table
+        self.buffer_size = buffer_size
+        self.buffer = StringIO()
+        self.writer = csv.writer(self.buffer, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
+        self.grade_orders = GradeOrders(backend.Row._fields)
+        self.fields = backend.Row._fields + GradeOrders.fields
+        self.columns = ','.join(self.fields)
+        self.staging_table = self.get_staging_table()
+        self.sql = self.get_copy_sql(self.staging_table)
+        self.cursor = None
+
+    def get_staging_table(self):
+        # Qualified so it can't be confused with another import's table
+        return 'pg_temp.%s_import_%s' % (self.table, self.backend.backend_module)
+
+    def get_copy_sql(self, table):
+        return "COPY %s (%s) FROM STDIN WITH NULL AS 'NULL'" % (table, self.columns)
+
+    def writerows(self, rows):
+        self.backend.create_certifiers()
+        if self.backend.cert_image_verifier is not None:
+            rows = self.backend.cert_image_verifier.filter_rows(rows)
+        self.writer.writerows(self.grade_orders.extend(rows))
+        if self.buffer.tell() >= self.buffer_size:
+            self.flush()
+
+    def begin(self):
+        self.cursor = connection.cursor()
+        self.cursor.execute('DROP TABLE IF EXISTS %s' % self.staging_table)
+        self.create_staging_table('TEMPORARY')
+
+    def create_staging_table(self, kind):
+        "The table's columns, without the id's default or any constraints"
+        self.cursor.execute('CREATE %s TABLE %s AS SELECT * FROM %s WITH NO DATA' % (kind, self.staging_table, self.table))
+
+    def flush(self):
+        if self.cursor is None:
+            self.begin()
+        if not self.buffer.tell():
+            return
+
+        self.buffer.seek(0)
+        try:
+            self.cursor.copy_expert(self.sql, self.buffer)
+        except Exception as e:
+            logger.exception("Error on copy for %s" % self.backend.backend_module)
+            self.abort()
+            raise ImportSourceError('Unable to save diamonds: %s' % e)
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+    def close(self):
+        self.flush()
+        self.prepare_swap()
+
+        try:
+            with transaction.atomic():
+                self.swap()
+        except Exception as e:
+            logger.exception("Error swapping in staged rows for %s" % self.backend.backend_module)
+            self.abort()
+            raise ImportSourceError('Unable to save diamonds: %s' % e)
+
+        self.drop()
+
+    def prepare_swap(self):
+        "Called once every row has been copied, before the swap's transaction"
+        pass
+
+    def swap(self):
+        self.backend.delete_existing(self.cursor)
+        self.cursor.execute('INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            self.table, self.columns, self.columns, self.staging_table))
+
+    def abort(self):
+        self.drop()
+
+    def drop(self):
+        if self.cursor is not None:
+            self.cursor.execute('DROP TABLE IF EXISTS %s' % self.staging_table)
+        self.cursor = None
+
+class StagingCopyWriter(CopyWriter):
+    """
+    Copies rows into an unlogged, per-source staging table rather than a
+    temporary one, and checks every row made it there before the swap.
+
+    When tsj_gemstone_diamond is partitioned by source (migration 0011) the
+    staging table is built as a ready-made partition instead: it's indexed
+    like the parent and swapped in for the source's old partition with
+    DETACH/ATTACH, so the old rows are dropped rather than deleted.
+    """
+    def __init__(self, backend, **kwargs):
+        super(StagingCopyWriter, self).__init__(backend, **kwargs)
+        self.row_count = 0
+        self.attach = False
+
+    def get_staging_table(self):
+        return '%s_import_%s' % (self.table, self.backend.backend_module)
+
+    def writerows(self, rows):
+        self.row_count += len(rows)
+        super(StagingCopyWriter, self).writerows(rows)
+
+    def begin(self):
+        self.cursor = connection.cursor()
+        self.attach = self.can_attach()
+        self.cursor.execute('DROP TABLE IF EXISTS %s' % self.staging_table)
+        if self.attach:
+            # The CHECK constraint spares ATTACH PARTITION from scanning the
+            # table to prove every row belongs to the source.
+            self.cursor.execute('CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS, CHECK (source=%%s))' % (
+                self.staging_table, self.table), (self.backend.backend_module,))
+        else:
+            self.create_staging_table('UNLOGGED')
+
+    def can_attach(self):
+        return self.backend.replaces_source and is_partitioned(self.cursor, self.table)
+
+    def create_indexes(self):
+        "Build the parent's indexes on the staging table so ATTACH can adopt them"
+        self.cursor.execute('SELECT pg_get_indexdef(indexrelid) FROM pg_index WHERE indrelid=%s::regclass', (self.table,))
+        for (index_def,) in self.cursor.fetchall():
+            match = INDEX_DEF_RE.match(index_def)
+            self.cursor.execute('CREATE %sINDEX ON %s %s' % (
+                match.group(1) or '', self.staging_table, index_def[match.end():]))
+
+    def prepare_swap(self):
+        self.cursor.execute('SELECT COUNT(*) FROM %s' % self.staging_table)
+        staged = self.cursor.fetchone()[0]
+        if staged != self.row_count:
+            self.abort()
+            raise ImportSourceError('Only %s of %s diamonds were staged' % (staged, self.row_count))
+
+        if self.attach:
+            self.create_indexes()
+
+    def swap(self):
+        if self.attach:
+            self.swap_partition()
+            return
+        super(StagingCopyWriter, self).swap()
+
+    def swap_partition(self):
+        cursor = self.cursor
+        source = self.backend.backend_module
+        cursor.execute('SELECT tsj_gemstone_diamond_partition(%s)', (source,))
+        partition = cursor.fetchone()[0]
+        cursor.execute('ALTER TABLE %s DETACH PARTITION %s' % (self.table, partition))
+        cursor.execute('DROP TABLE %s' % partition)
+        cursor.execute('ALTER TABLE %s RENAME TO %s' % (self.staging_table, partition))
+        cursor.execute('ALTER TABLE %s ATTACH PARTITION %s FOR VALUES IN (%%s)' % (self.table, partition), (source,))
+
+class DeltaCopyWriter(StagingCopyWriter):
+    """
+    Stages rows like StagingCopyWriter, but instead of replacing all of the
+    source's rows it hashes the content of each staged row and compares it
+    with the hash stored on the live row with the same `delta_key`.  Only new
+    diamonds are inserted, changed ones updated and missing ones deactivated,
+    so unchanged diamonds aren't rewritten and keep their ids and created
+    dates.
+    """
+    # Columns which change on every run regardless of content
+    unhashed_fields = ('created', 'modified')
+
+    def can_attach(self):
+        # The staged rows are merged into the source's partition, never
+        # swapped in for it
+        return False
+
+    def swap(self):
+        self.hash_rows()
+        self.drop_repeats()
+        deactivated = self.deactivate_missing()
+        updated = self.update_existing()
+        inserted = self.insert_new()
+
+        summary_logger.info('%s: %s inserted, %s updated, %s deactivated' % (
+            self.backend.backend_module, inserted, updated, deactivated))
+
+    def hash_rows(self):
+        hashed = ','.join(f for f in self.backend.Row._fields if f not in self.unhashed_fields)
+        self.cursor.execute('UPDATE %s SET content_hash=md5(ROW(%s)::text)' % (self.staging_table, hashed))
+
+    def drop_repeats(self):
+        # Feeds occasionally repeat a diamond, keep the last one
+        staging, key = self.staging_table, self.backend.delta_key
+        self.cursor.execute('DELETE FROM %s a USING %s b WHERE a.%s=b.%s AND a.ctid < b.ctid' % (
+            staging, staging, key, key))
+
+    def deactivate_missing(self):
+        key = self.backend.delta_key
+        self.cursor.execute("""
+            UPDATE %s d SET active=false, modified=%%s
+            WHERE d.source=%%s AND d.active
+            AND NOT EXISTS (SELECT 1 FROM %s s WHERE s.%s=d.%s)
+        """ % (self.table, self.staging_table, key, key), (self.backend.added_date, self.backend.backend_module))
+        return self.cursor.rowcount
+
+    def update_existing(self):
+        key = self.backend.delta_key
+        fields = self.fields + ('content_hash',)
+        assignments = ','.join('%s=s.%s' % (f, f) for f in fields if f != 'created')
+        self.cursor.execute("""
+            UPDATE %s d SET %s FROM %s s
+            WHERE d.source=%%s AND d.%s=s.%s
+            AND (d.content_hash IS DISTINCT FROM s.content_hash OR d.active IS DISTINCT FROM s.active)
+        """ % (self.table, assignments, self.staging_table, key, key), (self.backend.backend_module,))
+        return self.cursor.rowcount
+
+    def insert_new(self):
+        key = self.backend.delta_key
+        columns = self.columns + ',content_hash'
+        self.cursor.execute("""
+            INSERT INTO %s (%s) SELECT %s FROM %s s
+            WHERE NOT EXISTS (SELECT 1 FROM %s d WHERE d.source=%%s AND d.%s=s.%s)
+        """ % (self.table, columns, columns, self.staging_table, self.table, key, key), (self.backend.backend_module,))
+        return self.cursor.rowcount
+
+class SyncCopyWriter(DeltaCopyWriter):
+    """
+    For feeds which keep a point of sale's diamonds in step (see
+    BaseBackend.sync_import).  The staged rows are merged in with a few
+    statements: diamonds already stored only have `synced_fields` updated,
+    new ones are inserted, and unless the feed is a partial sync the ones
+    missing from it are deactivated.
+    """
+    synced_fields = ('modified', 'active', 'data', 'price', 'carat_price', 'certifier_id')
+
+    def hash_rows(self):
+        pass
+
+    def deactivate_missing(self):
+        if self.backend.partial_import:
+            return 0
+        return super(SyncCopyWriter, self).deactivate_missing()
+
+    def update_existing(self):
+        key = self.backend.delta_key
+        assignments = ','.join('%s=s.%s' % (f, f) for f in self.synced_fields)
+        self.cursor.execute("""
+            UPDATE %s d SET %s FROM %s s
+            WHERE d.source=%%s AND d.%s=s.%s
+        """ % (self.table, assignments, self.staging_table, key, key), (self.backend.backend_module,))
+        return self.cursor.rowcount
+
 class BaseBackend(object):
     filename = None
     fp_mode = 'rU'
     backend_module = None
 
+    # Whether an import replaces every diamond from the source.  Partial
+    # imports add to (and update) the existing diamonds instead.
+    replaces_source = True
+
+    # Only write the differences between the feed and the stored diamonds
+    # (see DeltaCopyWriter).  delta_key must identify a diamond within the
+    # feed from one run to the next; rows without one are skipped.
+    delta_import = False
+    delta_key = 'stock_number'
+
+    # Update the stored diamonds from the feed by delta_key, like a point
+    # of sale's inventory (see SyncCopyWriter).  A partial_import only has
+    # some of the source's diamonds, so the rest are left as they are.
+    sync_import = False
+    partial_import = False
+
+    # Where write_diamond_row finds the carat weight and the price before
+    # markup, so rows outside the carat weight and price prefs can be
+    # skipped before anything else is read (see prefilter).  Each is an
+    # index into the feed's lines, or a key of its dicts.  The price is
+    # either the price per carat or the total price, not both.
+    prefilter_carat_weight = None
+    prefilter_carat_price = None
+    prefilter_total_price = None
+    # The number of columns write_diamond_row expects.  Lines of any other
+    # length are left for it to report.
+    prefilter_width = None
+
     # Order must match struture of tsj_gemstone_diamond table with the exception
     # of the id column which is excluded when doing an import.
     Row = namedtuple('Row', (
@@ -111,12 +739,27 @@ class BaseBackend(object):
 
         # Keys are the exception message
         self.import_skip = defaultdict(int)
+        # Keys are a SkipDiamond's reason and its arguments; they're only
+        # formatted into import_skip for the report
+        self.skip_counts = defaultdict(int)
         self.import_errors = defaultdict(int)
 
         # To cut down on disk writes, we buffer the rows
         self.row_buffer = []
         self.buffer_size = 1000
 
+        # Set for the length of run() when cert image URLs need checking
+        self.cert_image_verifier = None
+
+        # Certifiers found in the feed which still need creating, by abbr
+        self.pending_certifiers = {}
+
+        # Set when the feed comes through open_feed
+        self.feed_digest = None
+        self.feed_fingerprint = None
+        # The (etag, last_modified) of a streamed feed
+        self.feed_validators = None
+
     @property
     def enabled(self):
         try:
@@ -153,16 +796,16 @@ class BaseBackend(object):
         # We want all the imported records to have the same added_date
         self.added_date = datetime.now()
 
-        self.cut_aliases = models.Cut.objects.as_dict()
-        self.color_aliases = models.Color.objects.as_dict()
-        self.clarity_aliases = models.Clarity.objects.as_dict()
-        self.grading_aliases = models.Grading.objects.as_dict()
-        self.fluorescence_aliases = models.Fluorescence.objects.as_dict()
-        self.fluorescence_color_aliases = models.FluorescenceColor.objects.as_dict()
-        self.fancy_colors = models.FancyColor.objects.as_dict()
-        self.fancy_color_intensities = models.FancyColorIntensity.objects.as_dict()
-        self.fancy_color_overtones = models.FancyColorOvertone.objects.as_dict()
-        self.certifier_aliases = models.Certifier.objects.as_dict_disabled()
+        self.cut_aliases = AliasTable(models.Cut.objects.as_dict())
+        self.color_aliases = AliasTable(models.Color.objects.as_dict())
+        self.clarity_aliases = AliasTable(models.Clarity.objects.as_dict())
+        self.grading_aliases = AliasTable(models.Grading.objects.as_dict())
+        self.fluorescence_aliases = AliasTable(models.Fluorescence.objects.as_dict())
+        self.fluorescence_color_aliases = AliasTable(models.FluorescenceColor.objects.as_dict())
+        self.fancy_colors = AliasTable(models.FancyColor.objects.as_dict())
+        self.fancy_color_intensities = AliasTable(models.FancyColorIntensity.objects.as_dict())
+        self.fancy_color_overtones = AliasTable(models.FancyColorOvertone.objects.as_dict())
+        self.certifier_aliases = AliasTable(models.Certifier.objects.as_dict_disabled())
 
         if prefs.get('markup') == 'carat_weight':
             self.markup_list = models.DiamondMarkup.objects.values_list('minimum_carat_weight', 'maximum_carat_weight', 'percent')
@@ -174,6 +817,8 @@ class BaseBackend(object):
         else:
             self.lab_markup_list = models.LabGrownDiamondMarkup.objects.values_list('minimum_price', 'maximum_price', 'percent')
 
+        self.markup = Markup(self.markup_list, self.lab_markup_list, prefs.get('markup') == 'carat_weight')
+
 
         self.pref_values = (
             Decimal(prefs.get('rapaport_minimum_carat_weight', '0.2')),
@@ -186,6 +831,22 @@ class BaseBackend(object):
             prefs.get('include_lab_grown', False),
 
         )
+        (
+            self.minimum_carat_weight,
+            self.maximum_carat_weight,
+            self.minimum_price,
+            self.maximum_price,
+            self.must_be_certified,
+            self.verify_cert_images,
+            self.include_mined,
+            self.include_lab_grown
+        ) = self.pref_values
+
+        # Most of the diamonds skipped are skipped for these, so they're only made once
+        self.carat_weight_minimum_skip = Skip(CARAT_WEIGHT_MINIMUM_MESSAGE, str(self.minimum_carat_weight))
+        self.carat_weight_maximum_skip = Skip(CARAT_WEIGHT_MAXIMUM_MESSAGE, str(self.maximum_carat_weight))
+        self.price_minimum_skip = Skip(PRICE_MINIMUM_MESSAGE, str(self.minimum_price))
+        self.price_maximum_skip = Skip(PRICE_MAXIMUM_MESSAGE, str(self.maximum_price))
 
         self.add_pref_values = (
             prefs.get('show_prices', 'none')
@@ -204,6 +865,7 @@ class BaseBackend(object):
         cursor = connection.cursor()
 
         if status in ('processed', 'error'):
+            self.collect_skips()
             data = {}
             for k in ('import_successes', 'missing_values', 'import_errors', 'import_skip'):
                 if getattr(self, k):
@@ -227,47 +889,249 @@ class BaseBackend(object):
         #  - write_diamond_row'ing
         #  - copy_from'ing
 
+    def count_skip(self, reason, args=(), count=1):
+        "Skips `count` diamonds for `reason` without raising SkipDiamond"
+        self.skip_counts[(reason,) + tuple(args)] += count
+
+    def collect_skips(self):
+        "Formats the skip reasons counted so far into import_skip"
+        for key, count in self.skip_counts.iteritems():
+            self.import_skip[format_reason(key)] += count
+        self.skip_counts.clear()
+
+    def new_certifier(self, certifier):
+        """
+        The certifier_id for a certifier which isn't in certifier_aliases.
+        Rather than creating it there and then, it's created along with any
+        others the rows found before they're copied (see create_certifiers).
+        """
+        pending = self.pending_certifiers.get(certifier)
+        if pending is None:
+            pending = self.pending_certifiers[certifier] = PendingCertifier(certifier)
+            self.certifier_aliases[certifier] = (pending, False)
+        return pending
+
+    def create_certifiers(self):
+        """
+        Creates the pending certifiers with one upsert.  Certifier
+        abbreviations are unique ignoring case and surrounding spaces
+        (migration 0012), so if another import has created one since the
+        aliases were loaded, its id is used instead.
+        """
+        if not self.pending_certifiers:
+            return
+
+        pending = self.pending_certifiers.values()
+        params = []
+        for certifier in pending:
+            params.extend((certifier.abbr, certifier.abbr))
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO tsj_gemstone_certifier (name, abbr, aliases, url, "desc", disabled)
+            VALUES %s
+            ON CONFLICT ((upper(btrim(abbr)))) DO UPDATE SET abbr=tsj_gemstone_certifier.abbr
+            RETURNING upper(btrim(abbr)), id, disabled
+        """ % ','.join(["(%s, %s, '', '', '', false)"] * len(pending)), params)
+        created = dict((force_text(abbr), (id, disabled)) for abbr, id, disabled in cursor.fetchall())
+
+        for certifier in pending:
+            certifier.id, certifier.disabled = created[force_text(certifier.abbr).strip().upper()]
+            self.certifier_aliases[certifier.abbr] = (certifier.id, certifier.disabled)
+        self.pending_certifiers = {}
+        invalidate_alias_dicts(models.Certifier)
+
+    def open_feed(self, key, download, mode='rb'):
+        """
+        Opens the feed `key` (see feedcache.FeedCache.fetch for `download`),
+        raising FeedUnchanged if this backend has already imported it.
+        With the feed cache it's opened from there; otherwise it's streamed
+        as it downloads, and `mode` doesn't apply.
+        """
+        from .feedcache import FEED_CACHE_DIR, FeedCache, FeedStream, get_feed_key
+
+        if FEED_CACHE_DIR:
+            path, self.feed_digest = FeedCache().fetch(key, download)
+            if self.feed_imported():
+                raise FeedUnchanged
+            return open(path, mode)
+
+        # Only the ETag and Last-Modified of the last import are kept, and
+        # a 304 for them only means nothing changed if nothing else has
+        validators = cache.get(self.get_feed_validators_key())
+        result = None
+        if validators:
+            self.feed_digest = get_feed_key(*validators)
+            if self.feed_imported():
+                result = download(*validators)
+                if result is None:
+                    raise FeedUnchanged
+        if result is None:
+            result = download(None, None)
+            if result is None:
+                raise ImportSourceError('The feed was not modified, but none is cached')
+
+        chunks, etag, last_modified = result
+        fp = FeedStream(chunks)
+        self.feed_digest = self.feed_fingerprint = self.feed_validators = None
+        if etag or last_modified:
+            self.feed_validators = (etag, last_modified)
+            self.feed_digest = get_feed_key(*self.feed_validators)
+            if self.feed_imported():
+                fp.close()
+                raise FeedUnchanged
+        return fp
+
+    def feed_imported(self):
+        "Fingerprints self.feed_digest, and whether it's the feed last imported"
+        self.feed_fingerprint = self.get_feed_fingerprint()
+        if cache.get(self.get_feed_cache_key()) == self.feed_fingerprint:
+            return models.Diamond.objects.filter(source=self.backend_module).exists()
+        return False
+
+    def get_feed_cache_key(self):
+        return 'tsj_gemstone:feed:%s:%s' % (get_schema_name(), self.backend_module)
+
+    def get_feed_validators_key(self):
+        return 'tsj_gemstone:feed_validators:%s:%s' % (get_schema_name(), self.backend_module)
+
+    def get_feed_fingerprint(self):
+        "A hash of the feed and everything else which decides what its rows become"
+        fingerprint = md5(self.feed_digest)
+        for value in (self.pref_values, self.add_pref_values, self.markup_list, self.lab_markup_list):
+            fingerprint.update(repr(list(value) if hasattr(value, 'model') else value))
+        for aliases in (self.cut_aliases, self.color_aliases, self.clarity_aliases, self.grading_aliases,
+                        self.fluorescence_aliases, self.fluorescence_color_aliases, self.fancy_colors,
+                        self.fancy_color_intensities, self.fancy_color_overtones, self.certifier_aliases):
+            fingerprint.update(repr(sorted(aliases.items())))
+        return fingerprint.hexdigest()
+
+    def get_writer(self):
+        if self.sync_import:
+            return SyncCopyWriter(self)
+        if self.delta_import:
+            return DeltaCopyWriter(self)
+        # Swapping in a new partition drops the old rows instead of deleting
+        # them row by row
+        if STAGING_IMPORT or (self.replaces_source and is_partitioned(connection.cursor())):
+            return StagingCopyWriter(self)
+        return CopyWriter(self)
+
     def run(self):
+        # Everything the import looks up from the shared cache is keyed by
+        # the site's schema
+        with remember_schema():
+            self.run_import()
+
+    def run_import(self):
         self.create_import_record()
         self.populate_import_data()
 
+        if prefs.get('rapaport_verify_cert_images', False):
+            self.cert_image_verifier = CertImageVerifier()
+
+        writer = self.get_writer()
         try:
-            tmp_file = self._run()
-            self.save(tmp_file)
+            self._run(writer)
+            writer.close()
+        except FeedUnchanged:
+            writer.abort()
+            self.import_skip['The feed has not changed since the last import'] = 1
+            self.update_import_record('processed')
+            return
         except ImportSourceError as e:
+            writer.abort()
             # TODO: Bit of a hack.  We should represent backend-level errors
             #       differently from record-level errors.
             self.import_errors[str(e)] = 1
             self.update_import_record('error')
             return
+        except:
+            writer.abort()
+            raise
+        finally:
+            if self.cert_image_verifier is not None:
+                self.cert_image_verifier.close()
+                self.cert_image_verifier = None
 
         self.update_import_record('processed')
-
-    def save(self, fp):
-        # fp should be a tempfile.NamedTemporaryFile.  We currently assume
-        # that it's also still open in write mode, so flush and reopen.
-        fp.flush()
-        fp = open(fp.name)
-
-        with transaction.atomic():
-            # FIXME: Don't truncate/replace the table if the import returned no data
-            try:
-                cursor = connection.cursor()
-                cursor.execute("DELETE FROM tsj_gemstone_diamond WHERE source='%s'" % self.backend_module)
-                cursor.copy_from(fp, 'tsj_gemstone_diamond', null='NULL', columns=self.Row._fields)
-            except Exception as e:
-                logger.exception("Error on copy_from for %s" % self.backend_module)
-
-        fp.close()
+        if self.feed_fingerprint:
+            cache.set(self.get_feed_cache_key(), self.feed_fingerprint, None)
+        if self.feed_validators:
+            cache.set(self.get_feed_validators_key(), self.feed_validators, None)
+        rebuild_summary()
+
+    def delete_existing(self, cursor):
+        "Called by the writer, in its transaction, just before the staged rows are copied in"
+        if not self.replaces_source:
+            return
+        # FIXME: Don't truncate/replace the table if the import returned no data
+        cursor.execute("DELETE FROM tsj_gemstone_diamond WHERE source='%s'" % self.backend_module)
+
+    def prefilter(self, data, blank_columns=None):
+        """
+        A Rejection for a row whose carat weight or price before markup is
+        outside the prefs, found without normalizing the rest of the row.
+        Anything which can't be read is left for write_diamond_row.
+        """
+        if self.prefilter_width is not None and len(data) - (blank_columns or 0) != self.prefilter_width:
+            return None
+        try:
+            carat_weight = data[self.prefilter_carat_weight]
+            if not isinstance(carat_weight, basestring):
+                carat_weight = str(carat_weight)
+            carat_weight = Decimal(str(cached_clean(carat_weight)))
+        except (KeyError, IndexError, InvalidOperation, TypeError, ValueError):
+            return None
+        if not carat_weight.is_finite():
+            return None
+
+        if carat_weight < self.minimum_carat_weight:
+            return self.carat_weight_minimum_skip
+        elif self.maximum_carat_weight and carat_weight > self.maximum_carat_weight:
+            return self.carat_weight_maximum_skip
+
+        if self.prefilter_carat_price is not None:
+            key = self.prefilter_carat_price
+        elif self.prefilter_total_price is not None:
+            key = self.prefilter_total_price
+        else:
+            return None
+        try:
+            price = data[key]
+            if isinstance(price, basestring):
+                price = clean(price.replace(',', ''))
+                if not price:
+                    return None
+            elif price is None:
+                return None
+            price = Decimal(price)
+        except (KeyError, IndexError, InvalidOperation, TypeError, ValueError):
+            return None
+        if not price.is_finite():
+            return None
+        if self.prefilter_carat_price is not None:
+            price *= carat_weight
+
+        if self.minimum_price and price < self.minimum_price:
+            return self.price_minimum_skip
+        if self.maximum_price and price > self.maximum_price:
+            return self.price_maximum_skip
 
     def try_write_row(self, writer, *args, **kwargs):
+        # The cheapest skips first, for backends which say where to find them
+        if self.prefilter_carat_weight is not None:
+            rejection = self.prefilter(*args, **kwargs)
+            if rejection is not None:
+                rejection.count(self)
+                return
+
         # TODO: We shouldn't need KeyError or ValueError if we're correctly
         #       accounting for the possible failure conditions with SkipDiamond
         #       and KeyValueError.
         try:
             diamond_row = self.write_diamond_row(*args, **kwargs)
         except SkipDiamond as e:
-            self.import_skip[str(e)] += 1
+            self.skip_counts[e.args] += 1
         except KeyValueError as e:
             self.missing_values[e.key][e.value] += 1
         except KeyError as e:
@@ -280,6 +1144,13 @@ class BaseBackend(object):
             self.import_errors[str(e)] += 1
             logger.error('Diamond import exception', exc_info=e)
         else:
+            if isinstance(diamond_row, Rejection):
+                diamond_row.count(self)
+                return
+            if (self.delta_import or self.sync_import) and getattr(diamond_row, self.delta_key) in (None, '', 'NULL'):
+                # It could never be matched with the stored diamond
+                self.skip_counts[(MISSING_DELTA_KEY_MESSAGE, self.delta_key)] += 1
+                return
             if len(self.row_buffer) > self.buffer_size:
                 writer.writerows(self.row_buffer)
                 self.row_buffer = [diamond_row]
@@ -302,7 +1173,7 @@ class CSVBackend(BaseBackend):
     def _get_reader(self, fp):
         return csv.reader(fp)
 
-    def _run(self):
+    def _run(self, writer):
         fp = self.get_fp()
         reader = self._get_reader(fp)
         headers = self._get_headers(reader)
@@ -314,32 +1185,29 @@ class CSVBackend(BaseBackend):
             if not col:
                 blank_columns += 1
 
-        # Prepare a temp file to use for writing our output CSV to
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
         self._read_rows(reader, writer, headers, blank_columns)
 
         if self.row_buffer:
             writer.writerows(self.row_buffer)
 
-        return tmp_file
+    def _iter_lines(self, reader, headers, blank_columns=None):
+        for line in reader:
+            # Sometimes the feed has blank lines
+            if not line:
+                continue
 
-    def _read_rows(self, reader, writer, headers, blank_columns=None):
-        try:
-            for line in reader:
-                # Sometimes the feed has blank lines
-                if not line:
-                    continue
+            # Rather than fail on malformed CSVs, pad rows which have fewer
+            # columns than the header row
+            col_diff = (len(headers) - blank_columns) - len(line)
+            if col_diff > 0:
+                line.extend([''] * col_diff)
 
-                # Rather than fail on malformed CSVs, pad rows which have fewer
-                # columns than the header row
-                col_diff = (len(headers) - blank_columns) - len(line)
-                if col_diff > 0:
-                    line.extend([''] * col_diff)
+            yield line
 
+    def _read_rows(self, reader, writer, headers, blank_columns=None):
+        try:
+            for line in self._iter_lines(reader, headers, blank_columns):
                 self.try_write_row(writer, line, blank_columns=blank_columns)
-                # print line
         except csv.Error as e:
             raise ImportSourceError(str(e))
 
@@ -361,9 +1229,19 @@ class IterableSheet(object):
 
 class XLSBackend(CSVBackend):
     fp_mode = 'rb'
+    # Have XLSXReader return numeric cells as Decimals rather than text
+    typed_cells = False
 
     def _get_reader(self, fp):
-        fp = self.get_fp()
+        # streaming imports from here
+        from .streaming import XLSXReader
+
+        if zipfile.is_zipfile(fp):
+            fp.seek(0)
+            return XLSXReader(fp, typed=self.typed_cells)
+
+        # Old .xls workbooks still have to be loaded whole
+        fp.seek(0)
         book = open_workbook(file_contents=fp.read())
         sheet = IterableSheet(book.sheet_by_index(0))
         return sheet
@@ -377,32 +1255,13 @@ class JSONBackend(BaseBackend):
     def get_json(self):
         raise NotImplementedError
 
-    def _run(self):
-        data = self.get_json()
-
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
-        existing_sns = set(
-            models.Diamond.objects.filter(source=self.backend_module).values_list('stock_number', flat=True))
-
-        if not getattr(self, "partial_import", False):
-            # Only mark active discontinued if we're running everything.
-            models.Diamond.objects.filter(source=self.backend_module).update(active=False)
-        
-        # terrible hack to identify the differences between EDT and Stuller JSON backends
-        if hasattr(self, "partial_import"):
-            for obj in data:
-                self.try_write_row(writer, obj, existing_sns=existing_sns)    
-        else:
-            for obj in data:
-                self.try_write_row(writer, obj)
+    def _run(self, writer):
+        for obj in self.get_json():
+            self.try_write_row(writer, obj)
 
         if self.row_buffer:
             writer.writerows(self.row_buffer)
 
-        return tmp_file
-
 class XMLHandler(xml.sax.ContentHandler):
     def __init__(self, backend, writer):
         # ContentHandler is an old-style class
@@ -417,14 +1276,9 @@ class XMLBackend(BaseBackend):
     def get_handler(self, writer):
         return self.handler_class(self, writer)
 
-    def _run(self):
+    def _run(self, writer):
         fp = self.get_fp()
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
         XmlParser = xml.sax.make_parser()
         XmlParser.setContentHandler(self.get_handler(writer))
         XmlParser.parse(fp)
-
-        return tmp_file
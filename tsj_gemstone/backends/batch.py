@@ -0,0 +1,186 @@
+"""
+Columnar filtering for mapped CSV feeds.  Most rows of a big feed are
+skipped for their carat weight, price or an unknown cut, so rather than
+have write_diamond_row build and throw away each of them, chunks of the
+feed are loaded into NumPy arrays and those checks are made a column at a
+time.  Only the rows which may survive go on to write_diamond_row, in the
+order the feed has them, and it still makes every check exactly with
+Decimals.
+
+The arrays only ever reject rows which are certain to fail, and for the
+reason write_diamond_row would give: carat weights compare the same as
+floats, price products get a small margin for float rounding, and a cut
+is only looked up for rows which pass every check made before it.
+
+Aliases other than the cut, and the markup, are still applied row by row
+by write_diamond_row: they only run for the rows which are kept, and
+markups are money.
+"""
+from itertools import islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .base import Rejection, clean
+from .mapping import (
+    CARAT_WEIGHT_MINIMUM_MESSAGE, CARAT_WEIGHT_MAXIMUM_MESSAGE,
+    PRICE_MINIMUM_MESSAGE, PRICE_MAXIMUM_MESSAGE, DEFAULT_FIELDS,
+    money, to_decimal, upper,
+)
+
+# Relative slack on price products, far bigger than float rounding error
+PRICE_MARGIN = 1e-9
+
+def parse_floats(values, thousands=False):
+    "A float array of a column of numbers, with NaN for anything which isn't one"
+    values = numpy.char.strip(numpy.array(values, dtype=str))
+    if thousands:
+        values = numpy.char.replace(values, ',', '')
+    values = numpy.where(values == '', 'nan', values)
+    try:
+        return values.astype(float)
+    except ValueError:
+        pass
+
+    def parse(value):
+        value = clean(value)
+        if thousands:
+            value = value.replace(',', '')
+        try:
+            return float(value)
+        except ValueError:
+            return numpy.nan
+    return numpy.array([parse(v) for v in values], dtype=float)
+
+class BatchFilter(object):
+    """
+    Filters the lines of a mapped feed a chunk at a time.  Only the
+    checks the backend's fields make the default way are done here.
+    """
+    def __init__(self, backend, chunk_size):
+        self.backend = backend
+        self.chunk_size = chunk_size
+        fields = backend.get_fields()
+
+        cut_field = fields.get('cut_id')
+        self.cut = self.get_index(fields, 'cut_id', normalize=upper)
+        if self.cut is not None and (cut_field.required or not (cut_field.lookup and cut_field.missing)):
+            self.cut = None
+        # The stock number is read between the price and the cut
+        if fields.get('stock_number') not in (None, DEFAULT_FIELDS['stock_number']):
+            self.cut = None
+        # A manmade column is checked between the price and the cut
+        manmade_field = fields.get('manmade')
+        if manmade_field is not None and all(s in backend.columns for s in manmade_field.get_sources('manmade')):
+            self.cut = None
+        elif isinstance(backend.check_manmade(backend.manmade), Rejection):
+            self.cut = None
+        if self.cut is not None:
+            self.cut_aliases = getattr(backend, cut_field.lookup)
+            self.cut_missing = cut_field.missing
+
+        self.carat_weight = self.get_index(fields, 'carat_weight', normalize=to_decimal,
+                                           validate='check_carat_weight')
+        self.carat_price = self.get_index(fields, 'carat_price', normalize=money)
+        self.price = self.get_index(fields, 'price', normalize=money)
+
+        self.minimum_carat_weight = float(backend.minimum_carat_weight or 0)
+        self.maximum_carat_weight = float(backend.maximum_carat_weight or 0)
+        self.minimum_price = float(backend.minimum_price or 0) * (1 - PRICE_MARGIN)
+        self.maximum_price = float(backend.maximum_price or 0) * (1 + PRICE_MARGIN)
+
+    def get_index(self, fields, name, normalize, validate=None):
+        "The column of a field if it's read the default way"
+        field = fields.get(name)
+        if field is None or field.normalize is not normalize or field.validate != validate:
+            return None
+        sources = field.get_sources(name)
+        if len(sources) != 1 or sources[0] not in self.backend.columns:
+            return None
+        return self.backend.columns.index(sources[0])
+
+    def __call__(self, lines, blank_columns=None):
+        "Yields the lines which write_diamond_row still needs to see"
+        width = self.backend.column_count + (blank_columns or 0)
+        lines = iter(lines)
+        while True:
+            chunk = list(islice(lines, self.chunk_size))
+            if not chunk:
+                break
+
+            # Rows of the wrong width are left for write_diamond_row to report
+            rows = [line for line in chunk if len(line) == width]
+            kept = iter(self.filter(rows))
+            for line in chunk:
+                if len(line) != width or next(kept):
+                    yield line
+
+    def filter(self, rows):
+        keep = numpy.ones(len(rows), dtype=bool)
+        if not rows:
+            return keep
+
+        # In the order write_diamond_row makes the checks
+        if self.carat_weight is None:
+            return keep
+        carat_weight = parse_floats([line[self.carat_weight] for line in rows])
+        keep &= self.filter_range(keep, carat_weight,
+                                  self.minimum_carat_weight, CARAT_WEIGHT_MINIMUM_MESSAGE,
+                                  self.maximum_carat_weight, CARAT_WEIGHT_MAXIMUM_MESSAGE,
+                                  self.backend.minimum_carat_weight, self.backend.maximum_carat_weight)
+
+        if self.carat_price is not None:
+            price = parse_floats([line[self.carat_price] for line in rows], thousands=True) * carat_weight
+        elif self.price is not None:
+            price = parse_floats([line[self.price] for line in rows], thousands=True)
+        else:
+            price = None
+        if price is None:
+            return keep
+        keep &= self.filter_range(keep, price,
+                                  self.minimum_price, PRICE_MINIMUM_MESSAGE,
+                                  self.maximum_price, PRICE_MAXIMUM_MESSAGE,
+                                  self.backend.minimum_price, self.backend.maximum_price)
+
+        # A row whose carat weight or price can't be read is skipped, or
+        # fails, for that before its cut is looked at
+        return self.filter_cut(rows, keep, keep & numpy.isfinite(carat_weight) & numpy.isfinite(price))
+
+    def filter_cut(self, rows, keep, checked):
+        "Counts and rejects the `checked` rows whose cut is unknown"
+        if self.cut is None or not checked.any():
+            return keep
+
+        values = numpy.array([line[self.cut] for line in rows], dtype=str)
+        uniques, inverse = numpy.unique(values, return_inverse=True)
+        keys = [upper(str(value)) for value in uniques]
+        missing = numpy.array([self.cut_aliases.get(key) is None for key in keys], dtype=bool)
+        rejected = checked & missing[inverse]
+        if not rejected.any():
+            return keep
+
+        counts = numpy.bincount(inverse[rejected], minlength=len(uniques))
+        missing_values = self.backend.missing_values[self.cut_missing]
+        for i in numpy.flatnonzero(counts):
+            missing_values[keys[i]] += int(counts[i])
+        return keep & ~rejected
+
+    def filter_range(self, keep, values, minimum, minimum_message, maximum, maximum_message,
+            minimum_pref, maximum_pref):
+        "Counts and rejects the rows still kept whose value is outside the range"
+        passed = numpy.ones(len(values), dtype=bool)
+        # NaN compares False both ways, so unparseable values are kept
+        with numpy.errstate(invalid='ignore'):
+            if minimum:
+                below = keep & (values < minimum)
+                if below.any():
+                    self.backend.count_skip(minimum_message, (str(minimum_pref),), int(below.sum()))
+                    passed &= ~below
+            if maximum:
+                above = keep & passed & (values > maximum)
+                if above.any():
+                    self.backend.count_skip(maximum_message, (str(maximum_pref),), int(above.sum()))
+                    passed &= ~above
+        return passed
@@ -3,34 +3,21 @@ import logging
 import os
 import json
 import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
 from urlparse import urlparse
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import LRU_CACHE_MAXSIZE, CSVBackend, SkipDiamond, KeyValueError
-from .. import models
+from .base import CSVBackend, SkipDiamond, KeyValueError, clean, cached_clean
 from ..prefs import prefs
 from ..utils import moneyfmt
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
 # TODO: Need to handle spaces between dimensions
 MEASUREMENT_RE = re.compile('[\sxX*-]')
 
-def clean(data, upper=False):
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 def split_measurements(measurements):
     try:
         length, width, depth = [x for x in MEASUREMENT_RE.split(measurements) if x]
@@ -42,6 +29,9 @@ def split_measurements(measurements):
 class Backend(CSVBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/177-diamonds.csv')
     default_filename = os.path.join(settings.FTP_ROOT, 'dnrdiamonds/1177-diamonds.csv')
+    prefilter_width = 45
+    prefilter_carat_weight = 1
+    prefilter_carat_price = 7
 
     @property
     def enabled(self):
@@ -133,7 +123,7 @@ class Backend(CSVBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(color, upper=True))
+        color = self.color_aliases.resolve(color)
 
         certifier = cached_clean(certifier, upper=True)
         # If the diamond must be certified and it isn't, raise an exception to prevent it from being imported
@@ -149,9 +139,7 @@ class Backend(CSVBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -163,7 +151,7 @@ class Backend(CSVBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(cut_grade, upper=True))
+        cut_grade = self.grading_aliases.resolve(cut_grade)
         carat_price = clean(carat_price.replace(',', ''))
         try:
             carat_price = Decimal(carat_price)
@@ -185,26 +173,24 @@ class Backend(CSVBackend):
             girdle = ''
 
         culet = cached_clean(culet, upper=True)
-        polish = self.grading_aliases.get(cached_clean(polish, upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(symmetry, upper=True))
+        polish = self.grading_aliases.resolve(polish)
+        symmetry = self.grading_aliases.resolve(symmetry)
 
         fluorescence = cached_clean(fluorescence, upper=True)
         fluorescence_id = None
         fluorescence_color = None
         fluorescence_color_id = None
-        for abbr, id in self.fluorescence_aliases.iteritems():
-            if fluorescence.startswith(abbr.upper()):
-                fluorescence_id = id
-                fluorescence_color = fluorescence.replace(abbr.upper(), '')
-                continue
+        abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+        if abbr:
+            fluorescence_id = id
+            fluorescence_color = fluorescence.replace(abbr, '')
         fluorescence = fluorescence_id
 
         if fluorescence_color:
             fluorescence_color = cached_clean(fluorescence_color, upper=True)
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
             if not fluorescence_color_id: fluorescence_color_id = None
         fluorescence_color = fluorescence_color_id
 
@@ -262,16 +248,7 @@ class Backend(CSVBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
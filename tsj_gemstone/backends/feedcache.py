@@ -0,0 +1,230 @@
+"""
+An optional local, content-addressed cache of the feeds downloaded from
+vendors, used when TSJ_GEMSTONE_FEED_CACHE_DIR is set.  It keeps a copy of
+every feed, so it belongs on a disk with room for them rather than a tmpfs
+like /tmp, and a backend only starts reading a feed once it's stored.
+
+Each feed is stored once under the SHA-1 of its content, and what's known
+about the feed at a URL (for a set of credentials) is kept beside it: the
+digest, the ETag and Last-Modified the server sent, and when it was
+fetched.  A feed fetched within FEED_CACHE_MAX_AGE is reused without asking
+the server again, so sites sharing a vendor account download it once per
+run, and after that the server is asked for it only if it has changed.
+
+Without the cache, feeds are read as they download (see FeedStream) and
+only the ETag and Last-Modified of the last import are kept.  Either way
+BaseBackend skips transforming a feed which is the same as the last one it
+imported (see BaseBackend.open_feed).
+"""
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Directory to keep downloaded feeds in, or None to stream them
+FEED_CACHE_DIR = getattr(settings, 'TSJ_GEMSTONE_FEED_CACHE_DIR', None)
+
+# Seconds a feed is reused without checking with the server
+FEED_CACHE_MAX_AGE = getattr(settings, 'TSJ_GEMSTONE_FEED_CACHE_MAX_AGE', 60 * 30)
+
+CHUNK_SIZE = 2**16
+
+def get_feed_key(*parts):
+    "A name for the feed identified by `parts`, like its URL and account"
+    return hashlib.sha1('\0'.join(str(part) for part in parts)).hexdigest()
+
+def response_chunks(response):
+    """
+    The (chunks, etag, last_modified) of a urllib2 or requests response, as
+    download functions return them.
+    """
+    if hasattr(response, 'iter_content'):
+        chunks = response.iter_content(CHUNK_SIZE)
+    else:
+        chunks = iter(lambda: response.read(CHUNK_SIZE), '')
+    return chunks, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+def conditional_headers(etag, last_modified):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+class FeedStream(object):
+    """
+    A read-only file over the chunks of a download, so a feed which isn't
+    cached can be parsed while the rest of it is still arriving.
+    """
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        # Lines are read from self.buffer at self.pos rather than sliced off
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = self.buffer[self.pos:] + chunk
+                self.pos = 0
+                return
+        self.eof = True
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) - self.pos < size):
+            self._fill()
+        if size < 0:
+            end = len(self.buffer)
+        else:
+            end = min(self.pos + size, len(self.buffer))
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    def readline(self):
+        end = self.buffer.find('\n', self.pos)
+        while end < 0 and not self.eof:
+            start = len(self.buffer) - self.pos
+            self._fill()
+            end = self.buffer.find('\n', self.pos + start)
+        end = len(self.buffer) if end < 0 else end + 1
+        line = self.buffer[self.pos:end]
+        self.pos = end
+        return line
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def close(self):
+        self.eof = True
+        self.buffer, self.pos = '', 0
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
+class FeedCache(object):
+    def __init__(self, directory=FEED_CACHE_DIR, max_age=FEED_CACHE_MAX_AGE):
+        self.directory = directory
+        self.max_age = max_age
+        for subdirectory in ('feeds', 'blobs'):
+            try:
+                os.makedirs(os.path.join(directory, subdirectory))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def get_meta_path(self, key):
+        return os.path.join(self.directory, 'feeds', key + '.json')
+
+    def get_blob_path(self, digest):
+        return os.path.join(self.directory, 'blobs', digest)
+
+    @contextmanager
+    def lock(self, key):
+        "Only one process at a time downloads a feed; the rest wait and reuse it"
+        with open(os.path.join(self.directory, 'feeds', key + '.lock'), 'w') as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def load_meta(self, key):
+        try:
+            with open(self.get_meta_path(key)) as fp:
+                meta = json.load(fp)
+        except (IOError, ValueError):
+            return None
+        if not os.path.exists(self.get_blob_path(meta['digest'])):
+            return None
+        return meta
+
+    def save_meta(self, key, meta):
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.directory, 'feeds'))
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(meta, fp)
+        os.rename(path, self.get_meta_path(key))
+
+    def store(self, chunks):
+        "Writes a feed into the cache and returns its digest"
+        sha1 = hashlib.sha1()
+        fd, path = tempfile.mkstemp(dir=os.path.join(self.directory, 'blobs'))
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                for chunk in chunks:
+                    sha1.update(chunk)
+                    fp.write(chunk)
+            os.rename(path, self.get_blob_path(sha1.hexdigest()))
+        except:
+            os.remove(path)
+            raise
+        return sha1.hexdigest()
+
+    def remove_unused_blob(self, digest):
+        feeds = os.path.join(self.directory, 'feeds')
+        for name in os.listdir(feeds):
+            if name.endswith('.json'):
+                try:
+                    with open(os.path.join(feeds, name)) as fp:
+                        if json.load(fp)['digest'] == digest:
+                            return
+                except (IOError, ValueError, KeyError):
+                    continue
+        try:
+            os.remove(self.get_blob_path(digest))
+        except OSError:
+            pass
+
+    def fetch(self, key, download):
+        """
+        Returns the path and digest of the feed stored under `key`.  Unless
+        it was fetched within max_age, download(etag, last_modified) is
+        called for it first.  It returns None if the server says the feed
+        hasn't changed, or else (chunks, etag, last_modified); see
+        response_chunks and conditional_headers.
+        """
+        with self.lock(key):
+            meta = self.load_meta(key)
+            now = time.time()
+            if meta is not None and now - meta['fetched'] < self.max_age:
+                return self.get_blob_path(meta['digest']), meta['digest']
+
+            if meta is None:
+                result = download(None, None)
+            else:
+                result = download(meta['etag'], meta['last_modified'])
+
+            if result is None:
+                if meta is None:
+                    raise ValueError('The feed was not modified, but none is cached')
+                meta['fetched'] = now
+            else:
+                chunks, etag, last_modified = result
+                previous = meta['digest'] if meta is not None else None
+                meta = {
+                    'digest': self.store(chunks),
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'fetched': now,
+                }
+            self.save_meta(key, meta)
+
+            if result is not None and previous and previous != meta['digest']:
+                self.remove_unused_blob(previous)
+            return self.get_blob_path(meta['digest']), meta['digest']
@@ -3,34 +3,19 @@ import glob
 import json
 import logging
 import os
-import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
 from urlparse import urlparse
 
 from django.conf import settings
 from django.db import connection, transaction
-from django.utils.lru_cache import lru_cache
 
-from .base import LRU_CACHE_MAXSIZE, CSVBackend, SkipDiamond, KeyValueError
-from .. import models
+from .base import CSVBackend, SkipDiamond, KeyValueError, clean, cached_clean
 from ..prefs import prefs
 from ..utils import moneyfmt
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 # GN combines fluorescence and fluorescence_color
 FLUORESCENCE_MAP = {
     #'DIST.': (None, None),
@@ -80,6 +65,9 @@ def split_measurements(measurements):
 class Backend(CSVBackend):
     infile_glob = os.path.join(settings.FTP_ROOT, 'gndiamond/diamonds/Diamond*txt')
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/gndiamond.csv')
+    prefilter_width = 37
+    prefilter_carat_weight = 1
+    prefilter_carat_price = 5
 
     def get_default_filename(self):
         files = sorted(glob.glob(self.infile_glob))
@@ -201,9 +189,7 @@ class Backend(CSVBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -215,7 +201,7 @@ class Backend(CSVBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(cut_grade, upper=True))
+        cut_grade = self.grading_aliases.resolve(cut_grade)
         carat_price = clean(carat_price.replace(',', ''))
         if carat_price:
             carat_price = Decimal(carat_price)
@@ -237,8 +223,8 @@ class Backend(CSVBackend):
             girdle = ''
 
         culet = cached_clean(culet, upper=True)
-        polish = self.grading_aliases.get(cached_clean(polish, upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(symmetry, upper=True))
+        polish = self.grading_aliases.resolve(polish)
+        symmetry = self.grading_aliases.resolve(symmetry)
 
         fluorescence = cached_clean(fluorescence, upper=True)
         if fluorescence in FLUORESCENCE_MAP:
@@ -273,27 +259,7 @@ class Backend(CSVBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        if manmade == 'f' or not self.lab_markup_list:
-            for markup in self.markup_list:
-                if prefs.get('markup') == 'carat_weight':
-                    if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                        price = (price_before_markup * (1 + markup[2]/100))
-                        break
-                else:
-                    if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                        price = (price_before_markup * (1 + markup[2]/100))
-                        break
-        else:
-            for markup in self.lab_markup_list:
-                if prefs.get('markup') == 'carat_weight':
-                    if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                        price = (price_before_markup * (1 + markup[2]/100))
-                        break
-                else:
-                    if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                        price = (price_before_markup * (1 + markup[2]/100))
-                        break
+        price = self.markup.apply(price_before_markup, carat_weight, manmade)
         if not price:
             if prefs.get('markup') == 'carat_weight':
                 raise SkipDiamond("A diamond markup doesn't exist for a diamond with carat weight of %s." % carat_weight)
@@ -1,37 +1,19 @@
 from decimal import Decimal, InvalidOperation
-import io
 import logging
 import os
-import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
-import zipfile
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import LRU_CACHE_MAXSIZE, XMLBackend, XMLHandler, ImportSourceError, SkipDiamond, KeyValueError
-from .. import models
+from .base import XMLBackend, XMLHandler, ImportSourceError, SkipDiamond, KeyValueError, clean, cached_clean
+from .feedcache import conditional_headers, get_feed_key, response_chunks
+from .streaming import ZipMemberStream
 from ..prefs import prefs
 from ..utils import moneyfmt
-from thinkspace.utils.http import url_exists
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 def split_measurements(measurements):
     try:
         length, width, depth = measurements.split('x')
@@ -55,8 +37,11 @@ class IdexHandler(XMLHandler):
 
 class Backend(XMLBackend):
     handler_class = IdexHandler
+    prefilter_carat_weight = 'ct'
+    prefilter_carat_price = 'ap'
 
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/idex.xml')
+    delta_import = True
 
     @property
     def enabled(self):
@@ -78,27 +63,19 @@ class Backend(XMLBackend):
         data = urllib.urlencode({'String_Access': key, 'Show_Empty': 1})
 
         url = 'http://idexonline.com/Idex_Feed_API-Full_Inventory'
-        try:
-            idex_request = Request(url + '?' + data)
-        except HTTPError as e:
-            raise ImportSourceError(str(e))
 
-        # Response objects don't support seeking, which ZipFile expects
-        response = urlopen(idex_request)
-        zipbytes = io.BytesIO(response.read())
+        def download(etag, last_modified):
+            idex_request = Request(url + '?' + data, headers=conditional_headers(etag, last_modified))
+            try:
+                return response_chunks(urlopen(idex_request))
+            except HTTPError as e:
+                if e.code == 304:
+                    return None
+                raise ImportSourceError(str(e))
 
-        if zipbytes.read(5) == '<root':
-            zipbytes.seek(0)
-            raise ImportSourceError(zipbytes.read())
-        zipbytes.seek(0)
-
-        try:
-            z = zipfile.ZipFile(zipbytes)
-        except Exception:
-            import pdb
-            pdb.set_trace()
-            raise
-        fp = z.open(z.infolist()[0])
+        # Inflate the feed as it downloads (or is read from the feed cache)
+        # rather than loading the whole zip into memory for ZipFile
+        fp = ZipMemberStream(self.open_feed(get_feed_key(url, key), download))
 
         return fp
 
@@ -128,7 +105,7 @@ class Backend(XMLBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(data.get('col'), upper=True))
+        color = self.color_aliases.resolve(data.get('col'))
 
         certifier = cached_clean(data.get('lab'), upper=True)
         # If the diamond must be certified and it isn't, raise an exception to prevent it from being imported
@@ -146,9 +123,7 @@ class Backend(XMLBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -160,7 +135,7 @@ class Backend(XMLBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('mk'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('mk'))
         try:
             carat_price = clean(data.get('ap').replace(',', ''))
             if carat_price:
@@ -189,24 +164,22 @@ class Backend(XMLBackend):
             girdle = ''
 
         culet = cached_clean(data.get('cs'), upper=True)
-        polish = self.grading_aliases.get(cached_clean(data.get('pol'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('sym'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('pol'))
+        symmetry = self.grading_aliases.resolve(data.get('sym'))
 
         fluorescence = cached_clean(data.get('fl'), upper=True)
         fluorescence_id = None
         fluorescence_color = cached_clean(data.get('fc'), upper=True)
         fluorescence_color_id = None
-        for abbr, id in self.fluorescence_aliases.iteritems():
-            if fluorescence.startswith(abbr.upper()):
-                fluorescence_id = id
-                continue
+        abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+        if abbr:
+            fluorescence_id = id
         fluorescence = fluorescence_id
 
         if fluorescence_color:
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
             if not fluorescence_color_id: fluorescence_color_id = None
         fluorescence_color = fluorescence_color_id
 
@@ -222,8 +195,6 @@ class Backend(XMLBackend):
         cert_image = data.get('cp')
         if not cert_image:
             cert_image = ''
-        elif verify_cert_images and cert_image != '' and not url_exists(cert_image):
-            cert_image = ''
 
         if carat_price is None:
             raise SkipDiamond('No carat_price specified')
@@ -236,16 +207,7 @@ class Backend(XMLBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
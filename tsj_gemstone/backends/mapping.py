@@ -0,0 +1,515 @@
+"""
+Declarative feeds.  Rather than unpacking a row by hand, a backend lists
+its feed's columns in order and the engine here reads, cleans, looks up and
+checks each field of BaseBackend.Row the same way the hand-written
+write_diamond_row methods do:
+
+    class Backend(MappedBackend, CSVBackend):
+        columns = (
+            'cut',
+            'carat_weight',
+            'unused_measurements',
+            ...
+        )
+        fields = {
+            'color_id': Field('color', lookup='color_aliases', missing='color_aliases',
+                              required='No valid color found'),
+        }
+
+Columns starting with "unused_" are ignored.  `fields` only needs the
+fields which differ from DEFAULT_FIELDS; mapping one to None leaves it out.
+A field whose columns aren't in the feed gets the Row's default value.
+
+Only feeds with a fixed list of columns, read the way DEFAULT_FIELDS
+reads them, are specs so far: rdi, premiergem, rditrading,
+rditrading_advanced, brilliantediamond, vantyghem, mid and rapnet10.  The
+other backends parse XML, JSON or API responses, find their columns by
+header, or have rules of their own (manmade from the cert or the origin,
+fancy colors split out of one column, ...), and keep their own
+write_diamond_row until Field can express those.
+"""
+from decimal import Decimal, InvalidOperation
+import json
+import re
+
+from django.conf import settings
+from django.utils.lru_cache import lru_cache
+
+from .base import (BaseBackend, MissingValue, Rejection, Skip, LRU_CACHE_MAXSIZE,
+                   CARAT_WEIGHT_MINIMUM_MESSAGE, CARAT_WEIGHT_MAXIMUM_MESSAGE,
+                   PRICE_MINIMUM_MESSAGE, PRICE_MAXIMUM_MESSAGE, clean, cached_clean)
+from ..prefs import prefs
+
+# Filter CSV feeds this many rows at a time with NumPy (see batch.py)
+# before the rows are read one by one, or 0 not to.  Without NumPy
+# installed the rows are only read one by one.
+BATCH_SIZE = getattr(settings, 'TSJ_GEMSTONE_BATCH_SIZE', 10000)
+
+MEASUREMENT_RE = re.compile('[\sx*-]')
+
+CARAT_WEIGHT_MARKUP_MESSAGE = "A diamond markup doesn't exist for a diamond with carat weight of %s."
+PRICE_MARKUP_MESSAGE = "A diamond markup doesn't exist for a diamond with pre-markup price of %s."
+
+# Skips which don't depend on the row are only made once
+NO_CARAT_PRICE = Skip('No carat_price specified')
+NO_CERTIFIER = Skip('No valid certifier was specified.')
+CERTIFIER_DISABLED = Skip('Certifier disabled')
+NO_MINED = Skip("Don't include mined")
+NO_LAB_GROWN = Skip("Don't include lab-grown")
+
+CENTS = Decimal('0.01')
+
+ROW_INDEX = dict((name, i) for i, name in enumerate(BaseBackend.Row._fields))
+CARAT_WEIGHT, COST, CARAT_PRICE, PRICE, MANMADE = (ROW_INDEX[name] for name in
+    ('carat_weight', 'cost', 'carat_price', 'price', 'manmade'))
+
+def split_measurements(measurements):
+    try:
+        length, width, depth = [x for x in MEASUREMENT_RE.split(measurements) if x]
+    except ValueError:
+        length, width, depth = None, None, None
+
+    return length, width, depth
+
+# Normalizers take the raw value of each of a field's columns
+
+def upper(value):
+    return cached_clean(value, upper=True)
+
+# Carat weights and percentages repeat a lot, and Decimals are slow to make
+@lru_cache(maxsize=LRU_CACHE_MAXSIZE)
+def to_decimal(value):
+    return Decimal(str(cached_clean(value)))
+
+def money(value):
+    try:
+        return Decimal(clean(value).replace(',', ''))
+    except InvalidOperation:
+        return None
+
+@lru_cache(maxsize=LRU_CACHE_MAXSIZE)
+def percent(value):
+    try:
+        return Decimal(str(cached_clean(value)))
+    except InvalidOperation:
+        return 'NULL'
+
+def bounded_percent(value):
+    value = percent(value)
+    if value != 'NULL' and value > 100:
+        return 'NULL'
+    return value
+
+def girdle(value):
+    value = upper(value)
+    if value == '-':
+        return ''
+    return value
+
+def girdle_range(thin, thick):
+    value = thin or ''
+    if thin != thick and thick:
+        if thin:
+            value += ' - ' + thick
+        else:
+            value = thick
+    return girdle(value)
+
+def measurement(index, split=split_measurements):
+    def normalize(value):
+        return split(clean(value))[index]
+    return normalize
+
+def cert_image_url(value):
+    return value.replace('.net//', '.net/').replace('\\', '/').strip()
+
+def dimension(value):
+    "Some feeds use 0 for an unknown length, width or depth"
+    value = clean(value)
+    if value == '0':
+        return None
+    return value
+
+def fancy_color(value):
+    if not value:
+        return None
+    return cached_clean(value.replace('-', ' ').lower())
+
+def flag(value):
+    return 't' if clean(value) else 'f'
+
+def json_data(*keys):
+    "Stores the non-empty columns in Diamond.data under `keys`"
+    def normalize(*values):
+        return json.dumps(dict((k, v) for k, v in zip(keys, values) if v))
+    return normalize
+
+class Field(object):
+    """
+    How one field of BaseBackend.Row is read from a feed.
+
+    `source` is the column, or tuple of columns, passed to `normalize`; it
+    defaults to the field's name without "_id".  Values are cleaned, and
+    upper-cased if they're looked up, unless `normalize` is given.  If `required` is set, an
+    empty value skips the diamond with that message.  `lookup` names the
+    backend AliasTable to translate the value to an id with; an unknown
+    value is counted in missing_values under `missing`, or left as None
+    when `missing` isn't set.  `validate` names a backend method which is
+    given the value to check and returns the value to store, or a
+    Rejection, and `null` stores empty values as NULL.
+    """
+    def __init__(self, source=None, normalize=None, lookup=None, missing=None,
+            required=None, validate=None, null=False):
+        self.source = source
+        if normalize is None:
+            normalize = upper if lookup else cached_clean
+        self.normalize = normalize
+        self.lookup = lookup
+        self.missing = missing
+        self.required = required
+        self.validate = validate
+        self.null = null
+
+    @property
+    def can_reject(self):
+        "Whether reading the field may return a Rejection rather than a value"
+        return bool(self.required or self.missing or self.validate)
+
+    def get_sources(self, name):
+        if self.source is None:
+            return (name[:-3] if name.endswith('_id') else name,)
+        if isinstance(self.source, basestring):
+            return (self.source,)
+        return self.source
+
+    def bind(self, name, columns, backend):
+        """
+        Returns a function which reads the field from a row of the feed, or
+        None if the feed doesn't have the field's columns.
+        """
+        try:
+            indexes = [columns.index(source) for source in self.get_sources(name)]
+        except ValueError:
+            return None
+
+        normalize = self.normalize
+        required = Skip(self.required) if self.required else None
+        table = getattr(backend, self.lookup) if self.lookup else None
+        missing = self.missing
+        validate = getattr(backend, self.validate) if self.validate else None
+        null = self.null
+        index = indexes[0] if len(indexes) == 1 else None
+
+        def read(line):
+            if index is not None:
+                value = normalize(line[index])
+            else:
+                value = normalize(*[line[i] for i in indexes])
+
+            if required and not value:
+                return required
+
+            if table is not None:
+                key = value
+                value = table.get(key)
+                if value is None and missing:
+                    return MissingValue(missing, key)
+
+            if validate is not None:
+                value = validate(value)
+                if isinstance(value, Rejection):
+                    return value
+
+            if null and (value is None or value == ''):
+                return 'NULL'
+            return value
+
+        return read
+
+# The order fields are read in, which decides which reason a diamond is
+# skipped for when it has several problems.
+FIELD_ORDER = (
+    'carat_weight',
+    'carat_price',
+    'price',
+    'manmade',
+    'stock_number',
+    'cut_id',
+    'color_id',
+    'certifier_id',
+    'clarity_id',
+    'cut_grade_id',
+    'depth_percent',
+    'table_percent',
+    'girdle',
+    'culet',
+    'polish_id',
+    'symmetry_id',
+    'fluorescence_id',
+    'fluorescence_color_id',
+    'fancy_color_id',
+    'fancy_color_intensity_id',
+    'fancy_color_overtone_id',
+    'cert_num',
+    'cert_image',
+    'length',
+    'width',
+    'depth',
+    'comment',
+    'city',
+    'state',
+    'country',
+    'laser_inscribed',
+    'lot_num',
+    'owner',
+    'data',
+)
+
+DEFAULT_FIELDS = {
+    'stock_number': Field(normalize=upper),
+    'cut_id': Field('cut', lookup='cut_aliases', missing='cut_aliases'),
+    'carat_weight': Field(normalize=to_decimal, validate='check_carat_weight'),
+    'color_id': Field('color', lookup='color_aliases', null=True),
+    'certifier_id': Field('certifier', normalize=upper, validate='get_certifier_id'),
+    'clarity_id': Field('clarity', lookup='clarity_aliases', missing='clarity',
+                        required='No clarity specified'),
+    'cut_grade_id': Field('cut_grade', lookup='grading_aliases', null=True),
+    'carat_price': Field(normalize=money),
+    'price': Field(normalize=money),
+    'depth_percent': Field(normalize=bounded_percent),
+    'table_percent': Field(normalize=bounded_percent),
+    'girdle': Field(normalize=girdle),
+    'culet': Field(normalize=upper),
+    'polish_id': Field('polish', lookup='grading_aliases', null=True),
+    'symmetry_id': Field('symmetry', lookup='grading_aliases', null=True),
+    'fluorescence_id': Field('fluorescence', normalize=upper, validate='get_fluorescence_id', null=True),
+    'fluorescence_color_id': Field('fluorescence', normalize=upper, validate='get_fluorescence_color_id', null=True),
+    'fancy_color_id': Field(normalize=fancy_color, lookup='fancy_colors', null=True),
+    'fancy_color_intensity_id': Field(normalize=fancy_color, lookup='fancy_color_intensities', null=True),
+    'fancy_color_overtone_id': Field(normalize=fancy_color, lookup='fancy_color_overtones', null=True),
+    'cert_num': Field(normalize=clean),
+    'cert_image': Field(normalize=clean),
+    'length': Field(normalize=clean, null=True),
+    'width': Field(normalize=clean, null=True),
+    'depth': Field(normalize=clean, null=True),
+    'comment': Field(),
+    'city': Field(),
+    'state': Field(),
+    'country': Field(),
+    'laser_inscribed': Field('laser_inscription', normalize=flag),
+}
+
+# Fields which are read, and the price checked, before any others, so most
+# of the diamonds outside the import's ranges are skipped without the cost
+# of cleaning and looking up the rest of the row
+PREFILTER_FIELDS = ('carat_weight', 'carat_price', 'price')
+
+# What a field is when the feed doesn't have it
+ROW_DEFAULTS = {
+    'active': 't',
+    'lot_num': '',
+    'owner': '',
+    'cert_num': '',
+    'cert_image': '',
+    'cert_image_local': '',
+    'depth_percent': 'NULL',
+    'table_percent': 'NULL',
+    'girdle': '',
+    'culet': '',
+    'length': 'NULL',
+    'width': 'NULL',
+    'depth': 'NULL',
+    'comment': '',
+    'city': '',
+    'state': '',
+    'country': '',
+    'laser_inscribed': 'f',
+    'rap_date': 'NULL',
+    'data': '{}',
+}
+
+class MappedBackend(object):
+    """
+    Implements write_diamond_row from the `columns` and `fields` of the
+    backend.  Goes before the feed type in the bases, e.g.
+    Backend(MappedBackend, CSVBackend).
+    """
+    # The feed's columns, in order
+    columns = ()
+    # Fields which are read differently from DEFAULT_FIELDS
+    fields = {}
+    # Whether diamonds are lab-grown when the feed doesn't have a manmade field
+    manmade = 'f'
+    batch_size = BATCH_SIZE
+
+    def populate_import_data(self):
+        super(MappedBackend, self).populate_import_data()
+
+        self.markup_by_carat_weight = prefs.get('markup') == 'carat_weight'
+
+        self.bind_fields()
+
+    def get_fields(self):
+        fields = DEFAULT_FIELDS.copy()
+        fields.update(self.fields)
+        return fields
+
+    def bind_fields(self):
+        "Works out how to read each field for this import"
+        fields = self.get_fields()
+        order = [name for name in FIELD_ORDER if name in fields]
+        order.extend(sorted(name for name in fields if name not in FIELD_ORDER))
+
+        self.prefilter_readers = []
+        self.field_readers = []
+        for name in order:
+            if fields[name] is None:
+                continue
+            read = fields[name].bind(name, self.columns, self)
+            if read is None:
+                continue
+            if name in PREFILTER_FIELDS:
+                self.prefilter_readers.append((ROW_INDEX[name], read, fields[name].can_reject))
+            else:
+                self.field_readers.append((ROW_INDEX[name], read, fields[name].can_reject))
+
+        # Without a manmade column every diamond is self.manmade, which the
+        # mined and lab-grown prefs still apply to
+        if not any(reader[0] == MANMADE for reader in self.field_readers):
+            manmade, check_manmade = self.manmade, self.check_manmade
+            self.field_readers.insert(0, (MANMADE, lambda line: check_manmade(manmade), True))
+
+        defaults = dict(ROW_DEFAULTS,
+            created=self.added_date,
+            modified=self.added_date,
+            source=self.backend_module,
+            manmade=self.manmade,
+        )
+        self.row_template = [defaults.get(name, 'NULL') for name in self.Row._fields]
+        self.column_count = len(self.columns)
+
+    def _iter_lines(self, reader, headers, blank_columns=None):
+        lines = super(MappedBackend, self)._iter_lines(reader, headers, blank_columns)
+        if not self.batch_size:
+            return lines
+
+        # batch imports numpy, if it's installed
+        from .batch import BatchFilter, numpy
+        if numpy is None:
+            return lines
+        return BatchFilter(self, self.batch_size)(lines, blank_columns)
+
+    def write_diamond_row(self, line, blank_columns=None):
+        if blank_columns:
+            line = line[:-blank_columns]
+        if len(line) != self.column_count:
+            raise ValueError('Expected %s columns, found %s' % (self.column_count, len(line)))
+
+        # Skipped diamonds are returned as Rejections rather than raised
+        row = self.row_template[:]
+        for index, read, can_reject in self.prefilter_readers:
+            value = row[index] = read(line)
+            if can_reject and isinstance(value, Rejection):
+                return value
+        rejection = self.check_price(row)
+        if rejection is not None:
+            return rejection
+        for index, read, can_reject in self.field_readers:
+            value = row[index] = read(line)
+            if can_reject and isinstance(value, Rejection):
+                return value
+        rejection = self.set_prices(row)
+        if rejection is not None:
+            return rejection
+
+        return self.Row._make(row)
+
+    def check_price(self, row):
+        """
+        Works out cost and carat_price from carat_price or price, and checks
+        cost is in range.  Returns a Rejection if it isn't.
+        """
+        carat_weight = row[CARAT_WEIGHT]
+        carat_price = row[CARAT_PRICE]
+        if carat_price in (None, 'NULL'):
+            carat_price = None
+            # Some feeds only have the total price
+            if row[PRICE] not in (None, 'NULL') and carat_weight:
+                carat_price = row[PRICE] / carat_weight
+
+        if carat_price is None:
+            return NO_CARAT_PRICE
+
+        price_before_markup = carat_price * carat_weight
+
+        if self.minimum_price and price_before_markup < self.minimum_price:
+            return self.price_minimum_skip
+        if self.maximum_price and price_before_markup > self.maximum_price:
+            return self.price_maximum_skip
+
+        row[COST] = price_before_markup
+        row[CARAT_PRICE] = carat_price
+
+    def set_prices(self, row):
+        "Marks up the price, once everything else is known.  Returns a Rejection without a markup."
+        carat_weight = row[CARAT_WEIGHT]
+        price_before_markup = row[COST]
+        carat_price = row[CARAT_PRICE]
+        price = self.markup.apply(price_before_markup, carat_weight, row[MANMADE])
+
+        if not price:
+            if self.markup_by_carat_weight:
+                return Skip(CARAT_WEIGHT_MARKUP_MESSAGE, carat_weight)
+            return Skip(PRICE_MARKUP_MESSAGE, price_before_markup)
+
+        # The same as moneyfmt(value, curr='', sep=''), without the overhead
+        row[COST] = str(price_before_markup.quantize(CENTS))
+        row[CARAT_PRICE] = str(carat_price.quantize(CENTS))
+        row[PRICE] = str(price.quantize(CENTS))
+
+    # Validators named by DEFAULT_FIELDS, which return a Rejection to skip the diamond
+
+    def check_carat_weight(self, carat_weight):
+        if carat_weight < self.minimum_carat_weight:
+            return self.carat_weight_minimum_skip
+        elif self.maximum_carat_weight and carat_weight > self.maximum_carat_weight:
+            return self.carat_weight_maximum_skip
+        return carat_weight
+
+    def check_manmade(self, manmade):
+        if manmade == 't':
+            if not self.include_lab_grown:
+                return NO_LAB_GROWN
+        elif not self.include_mined:
+            return NO_MINED
+        return manmade
+
+    def get_certifier_id(self, certifier):
+        # If the diamond must be certified and it isn't, leave it out of the import
+        if self.must_be_certified:
+            if not certifier or certifier.find('NONE') >= 0 or certifier == 'N':
+                return NO_CERTIFIER
+        try:
+            certifier_id, certifier_disabled = self.certifier_aliases[certifier]
+        except KeyError:
+            return MissingValue('certifier_aliases', certifier)
+
+        if certifier_disabled:
+            return CERTIFIER_DISABLED
+
+        if certifier and not certifier_id:
+            return self.new_certifier(certifier)
+        return certifier_id
+
+    def get_fluorescence_id(self, fluorescence):
+        return self.fluorescence_aliases.match_prefix(fluorescence)[1]
+
+    def get_fluorescence_color_id(self, fluorescence):
+        "The color is whatever follows the intensity, e.g. MEDIUM BLUE"
+        abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+        if not abbr:
+            return None
+        fluorescence_color = upper(fluorescence.replace(abbr, ''))
+        if not fluorescence_color:
+            return None
+        return self.fluorescence_color_aliases.match_prefix(fluorescence_color)[1]
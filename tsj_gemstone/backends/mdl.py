@@ -2,39 +2,22 @@ from decimal import Decimal, InvalidOperation
 import glob
 import logging
 import os
-import re
 import six
-from string import ascii_letters, digits, whitespace, punctuation
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
 import requests
 
-from .. import models
 from ..prefs import prefs
 from ..utils import moneyfmt
 
-from .base import (LRU_CACHE_MAXSIZE, XMLBackend, XMLHandler, ImportSourceError,
-                   SkipDiamond, KeyValueError, SkipImport)
+from .base import (XMLBackend, XMLHandler, ImportSourceError,
+                   SkipDiamond, KeyValueError, SkipImport, clean, cached_clean)
 
 logger = logging.getLogger(__name__)
 
 XML_URL = 'http://1800gia.com/xml.php'
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 class MDLHandler(XMLHandler):
     def __init__(self, backend, writer):
         # ContentHandler is an old-style class
@@ -81,6 +64,8 @@ class MDLHandler(XMLHandler):
 
 class Backend(XMLBackend):
     handler_class = MDLHandler
+    prefilter_carat_weight = 'weight'
+    prefilter_total_price = 'price'
 
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/mdl.xml')
 
@@ -133,7 +118,7 @@ class Backend(XMLBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(data.get('colour'), upper=True))
+        color = self.color_aliases.resolve(data.get('colour'))
         if not color:
             raise SkipDiamond('No color was specified.')
 
@@ -153,9 +138,7 @@ class Backend(XMLBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -167,7 +150,7 @@ class Backend(XMLBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('make'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('make'))
 
         try:
             price = clean(data.get('price').replace(',', ''))
@@ -207,16 +190,7 @@ class Backend(XMLBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -0,0 +1,120 @@
+from collections import deque
+import logging
+from multiprocessing.pool import ThreadPool
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# How many pages of a paginated API to have in flight at once
+PAGE_WORKERS = getattr(settings, 'TSJ_GEMSTONE_PAGE_WORKERS', 4)
+
+class TokenBucket(object):
+    """
+    Allows `rate` calls to consume() a second on average, in bursts of up to
+    `capacity`, across all of the threads sharing it.
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class PageFetcher(object):
+    """
+    Iterates over the rows of a paginated API, fetching up to `workers`
+    pages at a time while still yielding rows in page order.
+
+    `fetch_page(page_number)` returns a page's rows and `get_id(row)` the id
+    used to drop rows already seen on earlier pages.  Requests are spread out
+    to `rate` a second, failures in `retry_exceptions` are retried with
+    exponential backoff and an empty page is asked for again `empty_retries`
+    times before it's counted as blank.  Fetching stops after more than
+    `max_blank_pages` blank pages in a row, or at a page with nothing new on
+    it (which usually means the API is handing back the last page forever).
+    """
+    def __init__(self, fetch_page, get_id, name='API', first_page=1, workers=PAGE_WORKERS,
+            rate=None, retries=3, backoff=1, retry_exceptions=(), empty_retries=0, max_blank_pages=0):
+        self.fetch_page = fetch_page
+        self.get_id = get_id
+        self.name = name
+        self.first_page = first_page
+        self.workers = max(1, workers)
+        self.limiter = TokenBucket(rate) if rate else None
+        self.retries = retries
+        self.backoff = backoff
+        self.retry_exceptions = tuple(retry_exceptions)
+        self.empty_retries = empty_retries
+        self.max_blank_pages = max_blank_pages
+        self.ids = set()
+
+    def get_page(self, page_number):
+        attempt = empty = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.consume()
+            try:
+                rows = self.fetch_page(page_number)
+            except self.retry_exceptions as e:
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.warning('%s page %s failed (%s), retrying', self.name, page_number, e)
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+                continue
+
+            if not rows and empty < self.empty_retries:
+                empty += 1
+                continue
+            return rows
+
+    def __iter__(self):
+        pool = ThreadPool(self.workers)
+        pending = deque()
+        next_page = self.first_page
+        blank_pages = 0
+        try:
+            while True:
+                while len(pending) < self.workers:
+                    pending.append(pool.apply_async(self.get_page, (next_page,)))
+                    next_page += 1
+
+                rows = pending.popleft().get()
+                if not rows:
+                    blank_pages += 1
+                    if blank_pages > self.max_blank_pages:
+                        break
+                    continue
+                blank_pages = 0
+
+                new_ids = 0
+                for row in rows:
+                    id = self.get_id(row)
+                    if id not in self.ids:
+                        self.ids.add(id)
+                        new_ids += 1
+                        yield row
+
+                # If there aren't any new serial numbers, we're probably in an infinite loop
+                if not new_ids:
+                    logger.warning('{} infinite loop (diamond count {})'.format(self.name, len(self.ids)))
+                    break
+        finally:
+            # Don't wait on pages past the end
+            pool.terminate()
+            pool.join()
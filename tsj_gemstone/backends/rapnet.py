@@ -1,25 +1,18 @@
-import csv
 from decimal import Decimal, InvalidOperation
 import logging
 import os
-import random
-import re
-from string import ascii_letters, digits, whitespace, punctuation
-import tempfile
-import time
 
-from lxml import etree
 import requests
 import zeep
 
 #from zeep.wsdl.utils import etree_to_string
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import (LRU_CACHE_MAXSIZE, BaseBackend, ImportSourceError,
-                   KeyValueError, SkipDiamond)
-from .. import models
+from .base import (BaseBackend, ImportSourceError,
+                   KeyValueError, SkipDiamond, clean, cached_clean)
+from .paging import PageFetcher, PAGE_WORKERS
+from .streaming import iter_xml_rows
 from ..prefs import prefs
 from ..utils import moneyfmt
 
@@ -27,22 +20,15 @@ logger = logging.getLogger(__name__)
 
 RAPNET_WSDL = 'https://technet.rapaport.com/WebServices/RetailFeed/Feed.asmx?WSDL'
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
+# Pages of GetDiamonds to fetch at once, and at most how many a second
+RAPNET_PAGE_WORKERS = getattr(settings, 'TSJ_GEMSTONE_RAPNET_PAGE_WORKERS', PAGE_WORKERS)
+RAPNET_PAGE_RATE = getattr(settings, 'TSJ_GEMSTONE_RAPNET_PAGE_RATE', 10)
 
 class Backend(BaseBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/rapnet.xml')
+    delta_import = True
+    prefilter_carat_weight = 'Weight'
+    prefilter_total_price = 'FinalPrice'
 
     @property
     def enabled(self):
@@ -52,21 +38,15 @@ class Backend(BaseBackend):
         return username and password and version == 'rapnetii'
 
     def get_data(self):
-        doc = None
-        data = []
-
-        if self.filename:
-            doc = etree.parse(open(self.filename, 'rb'))
+        filename = self.filename
 
         # TODO: We should put a couple paginated XML files in ../tests/data
         #       so that we can run through the loop below when debugging
         if settings.DEBUG and not self.nodebug:
-            doc = etree.parse(open(self.debug_filename, 'rb'))
+            filename = self.debug_filename
 
-        if doc:
-            for obj in doc.xpath('//Table1'):
-                data.append(dict(((e.tag, e.text) for e in list(obj.iterchildren()))))
-            return data
+        if filename:
+            return iter_xml_rows(open(filename, 'rb'), 'Table1')
 
         username = prefs.get('rapaport_username')
         password = prefs.get('rapaport_password')
@@ -141,72 +121,30 @@ class Backend(BaseBackend):
             'AuthenticationTicketHeader': factory.AuthenticationTicketHeader(*[ticket]),
         }
 
-        ids = set()
-
-        # Accumulate paginated diamond data into ret
-        loop_try = blank_pages = 0
-        while True:
-            new_ids = 0
-            page_data = []
-
+        def fetch_page(page_number):
+            page_params = dict(params, PageNumber=str(page_number))
             response = client.service.GetDiamonds(
-                SearchParams=factory.FeedParameters(**params),
+                SearchParams=factory.FeedParameters(**page_params),
                 DiamondsFound=0,
                 _soapheaders=headers,
             )
-            #  print factory.FeedParameters(**params)
-            #  print headers
             doc = response['GetDiamondsResult']['_value_1']
-            for obj in doc.xpath('//Table1'):
-                page_data.append(dict(((e.tag, e.text) for e in list(obj.iterchildren()))))
-
-            if not page_data:
-                #print ("break on no 'page_data' - page number: ", params['PageNumber'])
-                if loop_try == 2 and blank_pages > 60:
-                    break
-                if loop_try == 2 and blank_pages <= 60:
-                    #print ("2 empty pages in a row - breaking out of data download ")
-                    #print (etree_to_string(doc).decode('utf-8'))
-                    blank_pages += 1
-                    loop_try =  0
-                    params['PageNumber'] = int(params['PageNumber']) + 1
-                    continue
-                #print ("trying again: ", loop_try)
-                loop_try +=1
-                continue
-            else:
-                blank_pages = 0
-
-            #print response
-            #print (etree_to_string(doc).decode('utf-8'))
-            for row in page_data:
-                if row['DiamondID'] not in ids:
-                    ids.add(row['DiamondID'])
-                    new_ids += 1
-                    data.append(row)
-                #else:
-                #     print "duplicate id"
-
-            # If there aren't any new serial numbers, we're probably in an infinite loop
-            if not new_ids:
-                logger.warning('RapNet infinite loop (diamond count {})'.format(len(ids)))
-                #print ("Break on no 'new_ids'")
-                break
-
-            params['PageNumber'] = int(params['PageNumber']) + 1
-
-            # Spread requests out a bit.  We're not sure what sort of rate
-            # limiting the new API will bring with it.
-            time.sleep(random.random()*.05)
-            #print("completed sleep cycle - current data length: ", len(data), "page number: ", params['PageNumber'])
-
-        return data
-
-    def _run(self):
-        data = self.get_data()
+            return [dict(((e.tag, e.text) for e in list(obj.iterchildren()))) for obj in doc.xpath('//Table1')]
+
+        # RapNet sometimes hands back blank pages in the middle of the
+        # results, so ask again before skipping past them
+        pages = PageFetcher(
+            fetch_page, lambda row: row['DiamondID'], name='RapNet',
+            workers=RAPNET_PAGE_WORKERS, rate=RAPNET_PAGE_RATE,
+            retry_exceptions=(zeep.exceptions.TransportError, requests.RequestException),
+            empty_retries=2, max_blank_pages=60,
+        )
+        # Rows are yielded as their pages arrive rather than collected, so
+        # only a window of pages is ever held in memory
+        return iter(pages)
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
+    def _run(self, writer):
+        data = self.get_data()
 
         for row in data:
             self.try_write_row(writer, row)
@@ -214,8 +152,6 @@ class Backend(BaseBackend):
         if self.row_buffer:
             writer.writerows(self.row_buffer)
 
-        return tmp_file
-
     def write_diamond_row(self, data):
         (
             minimum_carat_weight,
@@ -235,8 +171,8 @@ class Backend(BaseBackend):
         except KeyError as e:
             raise KeyValueError('cut_aliases', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('CutLongTitle'), upper=True))
-        color = self.color_aliases.get(cached_clean(data.get('ColorTitle'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('CutLongTitle'))
+        color = self.color_aliases.resolve(data.get('ColorTitle'))
 
         clarity = cached_clean(data.get('ClarityTitle'), upper=True)
         if not clarity:
@@ -262,16 +198,7 @@ class Backend(BaseBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -295,9 +222,7 @@ class Backend(BaseBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -334,8 +259,8 @@ class Backend(BaseBackend):
             girdle = ''
 
         culet = cached_clean(data.get('CuletSizeTitle'))
-        polish = self.grading_aliases.get(cached_clean(data.get('PolishTitle'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('SymmetryTitle'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('PolishTitle'))
+        symmetry = self.grading_aliases.resolve(data.get('SymmetryTitle'))
 
         fluorescence_id = None
         # TODO: No fluorescence_color in the feed?
@@ -343,10 +268,9 @@ class Backend(BaseBackend):
         fl = data.get('FluorescenceIntensityTitle', '')
         if fl:
             fluorescence = cached_clean(fl, upper=True)
-            for abbr, id in self.fluorescence_aliases.iteritems():
-                if fluorescence.startswith(abbr.upper()):
-                    fluorescence_id = id
-                    continue
+            abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+            if abbr:
+                fluorescence_id = id
 
         length = data.get('MeasLength')
         width = data.get('MeasWidth')
@@ -1,24 +1,18 @@
-import csv
 import json
 from decimal import Decimal, InvalidOperation
 import logging
 import os
-import random
 import re
-from string import ascii_letters, digits, whitespace, punctuation
-import tempfile
-import time
 from collections import defaultdict
 #from lxml import etree
 import requests
 
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import (LRU_CACHE_MAXSIZE, BaseBackend, ImportSourceError,
-                   KeyValueError, SkipDiamond)
-from .. import models
+from .base import (BaseBackend, ImportSourceError,
+                   KeyValueError, SkipDiamond, clean, cached_clean)
+from .paging import PageFetcher
 from ..prefs import prefs
 from ..utils import moneyfmt
 
@@ -26,22 +20,14 @@ logger = logging.getLogger(__name__)
 
 RAPNET_JSON = 'https://technet.rapaport.com/HTTP/JSON/RetailFeed/GetDiamonds.aspx'
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
+# Pages (of 1000 diamonds) to fetch at once, and at most how many a second
+RAPNET_JSON_PAGE_WORKERS = getattr(settings, 'TSJ_GEMSTONE_RAPNET_JSON_PAGE_WORKERS', 2)
+RAPNET_JSON_PAGE_RATE = getattr(settings, 'TSJ_GEMSTONE_RAPNET_JSON_PAGE_RATE', 1)
 
 class Backend(BaseBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/rapnet_test.json')
+    prefilter_carat_weight = 'size'
+    prefilter_total_price = 'total_sales_price'
 
     @property
     def enabled(self):
@@ -52,7 +38,6 @@ class Backend(BaseBackend):
 
     def get_data(self):
         doc = None
-        data = []
 
         if settings.DEBUG and not self.nodebug and not self.filename:
             self.filename = self.debug_filename
@@ -109,71 +94,36 @@ class Backend(BaseBackend):
             if v:
                 params[k] = v
 
-        ids = set()
-        # Accumulate paginated diamond data into ret
-        while True:
-            new_ids = 0
-            page_data = []
-
-            response =requests.post(RAPNET_JSON, headers=headers, json=params)
+        def fetch_page(page_number):
+            body = dict(params['request']['body'], page_number=page_number)
+            page_params = dict(params, request=dict(params['request'], body=body))
+            response = requests.post(RAPNET_JSON, headers=headers, json=page_params)
             doc = response.json()
-            #doc = doc['response']['body']['diamonds']
-
-            #  1. got page of diamonds
-            #  2.  make sure there is at least one diamond there. else
-            #  3. setup and update data(return) with this pages dict of diamonds
-            #  4  return data  in same dict as
             try:
-                for obj in doc['response']['body']['diamonds']:
-                    obj_data = []
-                    for k,v in filter(lambda x: not isinstance(x[1], (list, dict)), obj.items()):
-                        obj_data.append((k,v))
-                    page_data.append(dict(obj_data))
+                diamonds = doc['response']['body']['diamonds']
             except KeyError:
-                break
-
-            if not page_data:
-                break
-
-            
-            for row in page_data:
-                try:            
-                    if row['diamond_id'] not in ids:
-                        ids.add(row['diamond_id'])
-                        new_ids += 1
-                        data.append(row)
-                except TypeError:
-                    #print row
-                    #print(params['request']['header']['page_number'])
-                    #print(params)
-                    raise
-
-            # If there aren't any new serial numbers, we're probably in an infinite loop
-            if not new_ids:
-                logger.warning('RapNet infinite loop (diamond count {})'.format(len(ids)))
-                break
-            #print(len(page_data),len(data))
-            params['request']['body']['page_number'] =  1 + params['request']['body']['page_number']
-
-            # Spread requests out a bit.  We're not sure what sort of rate
-            # limiting the new API will bring with it.
-            time.sleep(random.random()*2.5)
-
-        return data
-
-    def _run(self):
+                return []
+            return [
+                dict((k, v) for k, v in obj.items() if not isinstance(v, (list, dict)))
+                for obj in diamonds
+            ]
+
+        # Rows are yielded as their pages arrive rather than collected, so
+        # only a window of pages is ever held in memory
+        return iter(PageFetcher(
+            fetch_page, lambda row: row['diamond_id'], name='RapNet',
+            workers=RAPNET_JSON_PAGE_WORKERS, rate=RAPNET_JSON_PAGE_RATE,
+            retry_exceptions=(requests.RequestException, ValueError),
+        ))
+
+    def _run(self, writer):
         data = self.get_data()
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
         for row in data:
             self.try_write_row(writer, row)
 
         if self.row_buffer:
             writer.writerows(self.row_buffer)
-        #raise Exception ('aborting')
-        return tmp_file
 
     def write_diamond_row(self, data):
         (
@@ -194,8 +144,8 @@ class Backend(BaseBackend):
         except KeyError as e:
             raise KeyValueError('cut_aliases', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('cut'), upper=True))
-        color = self.color_aliases.get(cached_clean(data.get('color'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('cut'))
+        color = self.color_aliases.resolve(data.get('color'))
 
         clarity = cached_clean(data.get('clarity'), upper=True)
         if not clarity:
@@ -221,18 +171,9 @@ class Backend(BaseBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    carat_price = price / carat_weight
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    carat_price = price / carat_weight
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
+        if price:
+            carat_price = price / carat_weight
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -256,9 +197,7 @@ class Backend(BaseBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -295,8 +234,8 @@ class Backend(BaseBackend):
             girdle = ''
 
         culet = cached_clean(data.get('culet_size'))
-        polish = self.grading_aliases.get(cached_clean(data.get('polish'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('symmetry'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('polish'))
+        symmetry = self.grading_aliases.resolve(data.get('symmetry'))
 
         fluorescence_color_id = None
         fluorescence_id = None
@@ -304,18 +243,16 @@ class Backend(BaseBackend):
         fc = data.get('fluor_color', '')
         if fc:
             fluorescence_color = cached_clean(fc, upper=True)
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
 
         fl = data.get('fluor_intensity', '')
         if fl:
             fluorescence = cached_clean(fl, upper=True)
-            for abbr, id in self.fluorescence_aliases.iteritems():
-                if fluorescence.startswith(abbr.upper()):
-                    fluorescence_id = id
-                    continue
+            abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+            if abbr:
+                fluorescence_id = id
 
         length = data.get('meas_length')
         width = data.get('meas_width')
@@ -1,11 +1,7 @@
-import csv
 from decimal import Decimal, InvalidOperation
 import logging
 import os
 import random
-import re
-from string import ascii_letters, digits, whitespace, punctuation
-import tempfile
 import time
 
 from lxml import etree
@@ -15,11 +11,9 @@ import zeep
 from zeep.wsdl.utils import etree_to_string
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import (LRU_CACHE_MAXSIZE, BaseBackend, ImportSourceError,
-                   KeyValueError, SkipDiamond)
-from .. import models
+from .base import (BaseBackend, ImportSourceError,
+                   KeyValueError, SkipDiamond, clean, cached_clean)
 from ..prefs import prefs
 from ..utils import moneyfmt
 
@@ -27,22 +21,10 @@ logger = logging.getLogger(__name__)
 
 RAPNET_WSDL = 'https://technet.rapaport.com/WebServices/RetailFeed/Feed.asmx?WSDL'
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
-
 class Backend(BaseBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/rapnet.xml')
+    prefilter_carat_weight = 'Weight'
+    prefilter_total_price = 'FinalPrice'
 
     @property
     def enabled(self):
@@ -204,20 +186,15 @@ class Backend(BaseBackend):
 
         return data
 
-    def _run(self):
+    def _run(self, writer):
         data = self.get_data()
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
         for row in data:
             self.try_write_row(writer, row)
 
         if self.row_buffer:
             writer.writerows(self.row_buffer)
 
-        return tmp_file
-
     def write_diamond_row(self, data):
         (
             minimum_carat_weight,
@@ -237,8 +214,8 @@ class Backend(BaseBackend):
         except KeyError as e:
             raise KeyValueError('cut_aliases', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('CutLongTitle'), upper=True))
-        color = self.color_aliases.get(cached_clean(data.get('ColorTitle'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('CutLongTitle'))
+        color = self.color_aliases.resolve(data.get('ColorTitle'))
 
         clarity = cached_clean(data.get('ClarityTitle'), upper=True)
         if not clarity:
@@ -264,16 +241,7 @@ class Backend(BaseBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -297,9 +265,7 @@ class Backend(BaseBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -336,8 +302,8 @@ class Backend(BaseBackend):
             girdle = ''
 
         culet = cached_clean(data.get('CuletSizeTitle'))
-        polish = self.grading_aliases.get(cached_clean(data.get('PolishTitle'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('SymmetryTitle'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('PolishTitle'))
+        symmetry = self.grading_aliases.resolve(data.get('SymmetryTitle'))
 
         fluorescence_id = None
         # TODO: No fluorescence_color in the feed?
@@ -345,10 +311,9 @@ class Backend(BaseBackend):
         fl = data.get('FluorescenceIntensityTitle', '')
         if fl:
             fluorescence = cached_clean(fl, upper=True)
-            for abbr, id in self.fluorescence_aliases.iteritems():
-                if fluorescence.startswith(abbr.upper()):
-                    fluorescence_id = id
-                    continue
+            abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+            if abbr:
+                fluorescence_id = id
 
         length = data.get('MeasLength')
         width = data.get('MeasWidth')
@@ -1,41 +1,27 @@
 from decimal import Decimal, InvalidOperation
-import csv
 import glob
 import json
 import logging
 import os
 import re
-from string import ascii_letters, digits, whitespace, punctuation
 import urllib
 from urllib2 import Request, urlopen, URLError, HTTPError
 from urlparse import urlparse
 
 from django.conf import settings
 from django.db import connection, transaction
-from django.utils.lru_cache import lru_cache
 from django.conf import settings
 
-from .base import LRU_CACHE_MAXSIZE, CSVBackend, SkipDiamond, KeyValueError, ImportSourceError
-from .. import models
+from .base import CSVBackend, SkipDiamond, KeyValueError, clean, cached_clean
 from ..utils import moneyfmt
 from tsj_pointofsale.prefs import prefs as pos_prefs
 from tsj_gemstone.prefs import prefs
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
 # TODO: Need to handle spaces between dimensions
 MEASUREMENT_RE = re.compile('[\sxX*-]')
 
-def clean(data, upper=False):
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 def split_measurements(measurements):
     try:
         length, width, depth = [x for x in MEASUREMENT_RE.split(measurements) if x]
@@ -46,6 +32,10 @@ def split_measurements(measurements):
 
 class Backend(CSVBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/spicer.csv')
+    # New diamonds are added alongside the existing ones, whose status and
+    # prices are updated from the feed (see SyncCopyWriter).
+    replaces_source = False
+    sync_import = True
 
     def __init__(self, *args, **kwargs):
         super(Backend, self).__init__(*args, **kwargs)
@@ -77,89 +67,6 @@ class Backend(CSVBackend):
             self.logger.info('Importing Spicer Greene EDGE file "%s"' % fn)
             return fn
 
-    def save(self, fp):
-        # fp should be a tempfile.NamedTemporaryFile.  We currently assume
-        # that it's also still open in write mode, so flush and reopen.
-        fp.flush()
-        fp = open(fp.name)
-
-        with transaction.atomic():
-            try:
-                cursor = connection.cursor()
-                cursor.copy_from(fp, 'tsj_gemstone_diamond', null='NULL', columns=self.Row._fields)
-            except Exception as e:
-                self.logger.exception("Error on copy_from for %s" % self.backend_module)
-
-        fp.close()
-
-    def _read_rows(self, reader, writer, headers, blank_columns=None):
-        existing_sns = set(models.Diamond.objects.filter(source=self.backend_module).values_list('stock_number', flat=True))
-
-        if not self.partial_import:
-            # Only mark active discontinued if we're running everything.
-            models.Diamond.objects.filter(source=self.backend_module).update(active=False)
-
-        try:
-            for line in reader:
-                # Sometimes the feed has blank lines
-                if not line:
-                    continue
-
-                # Rather than fail on malformed CSVs, pad rows which have fewer
-                # columns than the header row
-                col_diff = (len(headers) - blank_columns) - len(line)
-                if col_diff > 0:
-                    line.extend([''] * col_diff)
-
-                self.try_write_row(writer, line, blank_columns=blank_columns, existing_sns=existing_sns)
-        except csv.Error as e:
-            raise ImportSourceError(str(e))
-
-    def try_write_row(self, writer, *args, **kwargs):
-        existing_sns = kwargs.pop('existing_sns')
-
-        try:
-            diamond_row = self.write_diamond_row(*args, **kwargs)
-        except SkipDiamond as e:
-            self.import_skip[str(e)] += 1
-            self.logger.info('Skipping Diamond "%s" - SkipDiamond' % repr(e))
-        except KeyValueError as e:
-            self.missing_values[e.key][e.value] += 1
-        except KeyError as e:
-            self.import_errors[str(e)] += 1
-            self.logger.info('KeyError', exc_info=e)
-        except ValueError as e:
-            self.import_errors[str(e)] += 1
-            self.logger.info('ValueError', exc_info=e)
-        except Exception as e:
-            self.import_errors[str(e)] += 1
-            self.logger.error('Diamond import exception', exc_info=e)
-        else:
-            if diamond_row.stock_number in existing_sns:
-                diamond = models.Diamond.objects.get(stock_number=diamond_row.stock_number)
-                if diamond_row.active == 't':
-                    diamond.active = True
-                else:
-                    diamond.active = False
-                diamond.data = json.loads(diamond_row.data)
-                diamond.price = diamond_row.price
-                diamond.carat_price = diamond_row.carat_price
-
-                try:
-                    diamond.certifier_id = diamond_row.certifier_id
-                except:
-                    pass
-                diamond.save()
-                self.logger.info('Updating Existing Diamond "%s"' % diamond_row.stock_number)
-            else:
-                if len(self.row_buffer) > self.buffer_size:
-                    writer.writerows(self.row_buffer)
-                    self.row_buffer = [diamond_row]
-                else:
-                    self.row_buffer.append(diamond_row)
-                self.import_successes += 1
-                self.logger.info('Adding New Diamond "%s"' % diamond_row.stock_number)
-
     def write_diamond_row(self, line, blank_columns=None):
         if blank_columns:
             line = line[:-blank_columns]
@@ -327,7 +234,7 @@ class Backend(CSVBackend):
         if carat_weight < minimum_carat_weight:
             raise SkipDiamond('Carat weight is less than the minimum of %s.' % minimum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(color, upper=True))
+        color = self.color_aliases.resolve(color)
 
         certifier = cached_clean(certifier, upper=True)
 
@@ -341,9 +248,7 @@ class Backend(CSVBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -357,7 +262,7 @@ class Backend(CSVBackend):
             raise KeyValueError('clarity', e.args[0])
 
         try:
-            cut_grade = self.grading_aliases.get(cached_clean(cut_grade, upper=True))
+            cut_grade = self.grading_aliases.resolve(cut_grade)
         except KeyError as e:
             self.logger.info('Skipping Diamond "%s" - Cut Grade Aliases' % stock_number)
             raise KeyValueError('cut', e.args[0])
@@ -371,16 +276,15 @@ class Backend(CSVBackend):
         if carat_price is None:
             raise SkipDiamond('No carat_price specified')
 
-        polish = self.grading_aliases.get(cached_clean(polish, upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(symmetry, upper=True))
+        polish = self.grading_aliases.resolve(polish)
+        symmetry = self.grading_aliases.resolve(symmetry)
 
         fluorescence = cached_clean(fluorescence, upper=True)
         fluorescence_id = None
-        for abbr, id in self.fluorescence_aliases.iteritems():
-            if fluorescence.startswith(abbr.upper()):
-                fluorescence_id = id
-                #fluorescence_color = fluorescence.replace(abbr.upper(), '')
-                break
+        abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+        if abbr:
+            fluorescence_id = id
+            #fluorescence_color = fluorescence.replace(abbr, '')
         fluorescence = fluorescence_id
         fluorescence_color_id = None
 
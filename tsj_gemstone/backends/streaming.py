@@ -0,0 +1,266 @@
+from datetime import datetime, time
+from decimal import Decimal
+import posixpath
+import re
+import struct
+import zipfile
+import zlib
+
+from django.utils.dateparse import parse_date, parse_datetime
+from lxml import etree
+from xlrd.xldate import xldate_as_datetime
+from xlrd.xlsx import error_code_from_text
+
+from .base import ImportSourceError
+
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+ZIP_LOCAL_SIGNATURE = 'PK\x03\x04'
+ZIP_STORED, ZIP_DEFLATED = 0, 8
+
+XLSX_NS = '{http://schemas.openxmlformats.org/spreadsheetml/2006/main}'
+XLSX_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+XLSX_PACKAGE_REL_NS = '{http://schemas.openxmlformats.org/package/2006/relationships}'
+CELL_COLUMN_RE = re.compile(r'^([A-Z]+)')
+
+# Excel's built in date and time number formats
+DATE_FORMAT_IDS = set(range(14, 23)) | set(range(45, 48))
+# Quoted text, escaped characters and [colours] or [conditions] in a format
+FORMAT_LITERAL_RE = re.compile(r'"[^"]*"|\\.|_.|\*.|\[[^\]]*\]')
+
+def iter_xml_rows(fp, tag):
+    """
+    Yield each `tag` element of an XML file as a dict of its children's text,
+    clearing elements as it goes so the document is never held in memory.
+    """
+    for event, elem in etree.iterparse(fp, events=('end',), tag=tag):
+        yield dict(((e.tag, e.text) for e in elem.iterchildren()))
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+class ZipMemberStream(object):
+    """
+    Reads the first file of a zip archive from a stream which can't seek,
+    like an HTTP response, inflating it as it's read.  ZipFile needs the
+    central directory at the end of the archive, so it would have to
+    download the whole thing first.
+
+    Anything that isn't a zip is assumed to be an error message from the
+    server and raised as an ImportSourceError.
+    """
+    chunk_size = 2**16
+
+    def __init__(self, fp):
+        self.fp = fp
+        header = fp.read(ZIP_LOCAL_HEADER.size)
+        if header[:4] != ZIP_LOCAL_SIGNATURE or len(header) < ZIP_LOCAL_HEADER.size:
+            raise ImportSourceError(header + fp.read())
+
+        (_, _, flags, method, _, _, _, compressed_size, _,
+         name_length, extra_length) = ZIP_LOCAL_HEADER.unpack(header)
+        self.name = fp.read(name_length)
+        fp.read(extra_length)
+
+        if method == ZIP_DEFLATED:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        elif method == ZIP_STORED and not flags & 0x08:
+            self.decompressor = None
+            self.remaining = compressed_size
+        else:
+            raise ImportSourceError('Unsupported zip member %s (method %s, flags %s)' % (self.name, method, flags))
+
+        self.buffer = ''
+        self.eof = False
+
+    def _fill(self):
+        if self.decompressor is None:
+            data = self.fp.read(min(self.chunk_size, self.remaining))
+            self.remaining -= len(data)
+            self.eof = not data or not self.remaining
+            return data
+
+        data = self.fp.read(self.chunk_size)
+        if not data:
+            self.eof = True
+            return self.decompressor.flush()
+        inflated = self.decompressor.decompress(data)
+        # Anything after the end of the deflate stream is the next header
+        if self.decompressor.unused_data:
+            self.eof = True
+        return inflated
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.buffer += self._fill()
+        if size < 0:
+            data, self.buffer = self.buffer, ''
+        else:
+            data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.fp.close()
+
+def is_date_format(code):
+    """
+    Whether a custom number format shows a date or time: it has more of
+    the date parts y, m, d, h and s than of the digit placeholders 0, # and ?,
+    the same test xlrd uses.
+    """
+    code = FORMAT_LITERAL_RE.sub('', code).lower()
+    if code == 'general':
+        return False
+    dates = sum(code.count(c) for c in 'ymdhs')
+    digits = sum(code.count(c) for c in '0#?')
+    return dates > digits
+
+def column_index(ref):
+    """The 0-based column of a cell reference like "AB12"."""
+    index = 0
+    for letter in CELL_COLUMN_RE.match(ref).group(1):
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+class XLSXReader(object):
+    """
+    Iterates over the rows of the first sheet of an .xlsx workbook, parsing
+    the sheet as it goes instead of loading the whole workbook like xlrd.
+
+    Cells come back as the strings IterableSheet makes of xlrd's values, so
+    a backend reads the same thing from either: numbers go through a float
+    ("220.0", "2.01" rather than the stored "2.0099999999999998"), dates
+    stay serial numbers, booleans are "1" or "0" and errors are xlrd's
+    error codes.  Text is UTF-8 encoded where str() of xlrd's unicode
+    would fail.  Blank rows between rows with values are kept, as xlrd
+    does, and rows are padded to the width in the sheet's dimension, which
+    can count a column that only has formatting where xlrd wouldn't.
+
+    The differences from xlrd: ISO 8601 date cells (t="d"), which xlrd
+    can't read, come back as their text, and with `typed` numbers are
+    Decimals, cells formatted as dates are datetimes, and booleans are
+    bools.
+    """
+    def __init__(self, fp, typed=False):
+        self.zip = zipfile.ZipFile(fp)
+        self.typed = typed
+        self.shared_strings = self.read_shared_strings()
+        self.datemode = 0
+        self.date_styles = self.read_date_styles()
+        self.rows = self.iter_rows(self.get_first_sheet())
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.rows)
+
+    def get_first_sheet(self):
+        workbook = etree.fromstring(self.zip.read('xl/workbook.xml'))
+        properties = workbook.find(XLSX_NS + 'workbookPr')
+        if properties is not None and properties.get('date1904') in ('1', 'true'):
+            self.datemode = 1
+        sheet = workbook.find('%ssheets/%ssheet' % (XLSX_NS, XLSX_NS))
+        rel_id = sheet.get(XLSX_REL_NS + 'id')
+
+        rels = etree.fromstring(self.zip.read('xl/_rels/workbook.xml.rels'))
+        for rel in rels.iter(XLSX_PACKAGE_REL_NS + 'Relationship'):
+            if rel.get('Id') == rel_id:
+                target = rel.get('Target')
+                if target.startswith('/'):
+                    return target.lstrip('/')
+                return posixpath.normpath(posixpath.join('xl', target))
+        return 'xl/worksheets/sheet1.xml'
+
+    def read_shared_strings(self):
+        try:
+            fp = self.zip.open('xl/sharedStrings.xml')
+        except KeyError:
+            return []
+
+        strings = []
+        for event, elem in etree.iterparse(fp, events=('end',), tag=XLSX_NS + 'si'):
+            strings.append(self.text(elem))
+            elem.clear()
+        return strings
+
+    def read_date_styles(self):
+        "The indexes of the cell styles which show numbers as dates"
+        try:
+            styles = etree.fromstring(self.zip.read('xl/styles.xml'))
+        except KeyError:
+            return set()
+
+        date_formats = set(DATE_FORMAT_IDS)
+        for fmt in styles.iterfind('%snumFmts/%snumFmt' % (XLSX_NS, XLSX_NS)):
+            if is_date_format(fmt.get('formatCode', '')):
+                date_formats.add(int(fmt.get('numFmtId')))
+
+        return set(index for index, xf in enumerate(styles.iterfind('%scellXfs/%sxf' % (XLSX_NS, XLSX_NS)))
+                   if int(xf.get('numFmtId', 0)) in date_formats)
+
+    def text(self, elem):
+        # Rich text is split across runs; skip phonetic guides
+        return ''.join(t.text or '' for t in elem.iter(XLSX_NS + 't')
+                       if t.getparent().tag != XLSX_NS + 'rPh').encode('utf-8')
+
+    def value(self, cell):
+        "The cell's value, or None for an empty cell, which xlrd leaves out"
+        cell_type = cell.get('t', 'n')
+        if cell_type == 'inlineStr':
+            inline = cell.find(XLSX_NS + 'is')
+            return self.text(inline) if inline is not None else ''
+
+        value = cell.findtext(XLSX_NS + 'v')
+        if cell_type == 's':
+            return self.shared_strings[int(value)] if value else None
+        if cell_type == 'str':
+            return (value or '').encode('utf-8')
+        if value is None:
+            return None
+        if cell_type == 'n':
+            number = float(value)
+            if not self.typed:
+                return str(number)
+            if int(cell.get('s', 0)) in self.date_styles:
+                return xldate_as_datetime(number, self.datemode)
+            return Decimal(repr(number))
+        if cell_type == 'b':
+            return value in ('1', 'true') if self.typed else str(int(value in ('1', 'true')))
+        if cell_type == 'e':
+            return value.encode('utf-8') if self.typed else str(error_code_from_text.get(value, 0x2A))
+        if cell_type == 'd' and self.typed:
+            return parse_datetime(value) or datetime.combine(parse_date(value), time())
+        return value.encode('utf-8')
+
+    def iter_rows(self, sheet):
+        width = 0
+        last_row = 0
+        for event, elem in etree.iterparse(self.zip.open(sheet), events=('end',),
+                                           tag=(XLSX_NS + 'dimension', XLSX_NS + 'row')):
+            if elem.tag == XLSX_NS + 'dimension':
+                ref = elem.get('ref', '').split(':')[-1]
+                if CELL_COLUMN_RE.match(ref):
+                    width = column_index(ref) + 1
+                continue
+
+            row_number = int(elem.get('r', last_row + 1))
+            row = []
+            has_values = False
+            for cell in elem.iterchildren(XLSX_NS + 'c'):
+                ref = cell.get('r')
+                if ref:
+                    row.extend([''] * (column_index(ref) - len(row)))
+                value = self.value(cell)
+                has_values = has_values or value is not None
+                row.append('' if value is None else value)
+
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+
+            if has_values:
+                for blank in xrange(row_number - last_row - 1):
+                    yield [''] * width
+                last_row = row_number
+                row.extend([''] * (width - len(row)))
+                yield row
@@ -3,36 +3,19 @@ import hashlib
 import json
 import logging
 import os
-import re
-from string import ascii_letters, digits, whitespace, punctuation
 import time
 
 import requests
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import LRU_CACHE_MAXSIZE, JSONBackend, ImportSourceError, SkipDiamond, KeyValueError
-from .. import models
+from .base import JSONBackend, ImportSourceError, SkipDiamond, KeyValueError, clean, cached_clean
+from .feedcache import conditional_headers, get_feed_key, response_chunks
 from ..prefs import prefs
 from ..utils import moneyfmt
-from thinkspace.utils.http import url_exists
 
 logger = logging.getLogger(__name__)
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
 def split_measurements(measurements):
     try:
         length, width, depth = measurements.split('x')
@@ -45,6 +28,7 @@ def split_measurements(measurements):
 
 class Backend(JSONBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/stuller.json')
+    prefilter_carat_weight = 'CaratWeight'
 
     def get_json(self):
         if self.filename:
@@ -55,38 +39,40 @@ class Backend(JSONBackend):
         if settings.DEBUG and not self.nodebug:
             return json.load(open(self.debug_filename, 'rb'))['Diamonds']
 
-        session = requests.Session()
-        session.auth = (settings.STULLER_USER, settings.STULLER_PASSWORD)
-        session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
         url = 'https://api.stuller.com/v2/gem'
         next_page = None
         prev_page_hash = None
-        serial_numbers = set()
-        ret = []
-
-        new_serial_numbers = 0
 
-        response = session.get(url)
+        def download(etag, last_modified):
+            session = requests.Session()
+            session.auth = (settings.STULLER_USER, settings.STULLER_PASSWORD)
+            session.headers.update({'Content-Type': 'application/json', 'Accept': 'application/json'})
+            response = session.get(url, headers=conditional_headers(etag, last_modified), stream=True)
 
-        if response.status_code != 200:
-            raise ImportSourceError('Stuller HTTP error {}'.format(response.status_code))
+            if response.status_code == 304:
+                return None
+            if response.status_code != 200:
+                raise ImportSourceError('Stuller HTTP error {}'.format(response.status_code))
+            return response_chunks(response)
 
-        data = response.json()
+        data = json.load(self.open_feed(get_feed_key(url, settings.STULLER_USER), download))
         if 'Diamonds' not in data:
             logger.warning('Stuller no Diamonds provided')
 
-        for x, d in enumerate(data['Diamonds']):
+        return self.iter_new_diamonds(data['Diamonds'])
+
+    def iter_new_diamonds(self, diamonds):
+        # Yield rows straight to _run rather than copying them into a list
+        serial_numbers = set()
+        for d in diamonds:
             if d['SerialNumber'] not in serial_numbers:
                 serial_numbers.add(d['SerialNumber'])
-                new_serial_numbers += 1
-                ret.append(d)
+                yield d
 
         # If there aren't any new serial numbers, we're probably in an infinite loop
-        if not new_serial_numbers:
+        if not serial_numbers:
             logger.warning('Stuller no Diamonds provided')
 
-        return ret
-
     def write_diamond_row(self, data):
         (
             minimum_carat_weight,
@@ -115,7 +101,7 @@ class Backend(JSONBackend):
         elif maximum_carat_weight and carat_weight > maximum_carat_weight:
             raise SkipDiamond('Carat weight is greater than the maximum of %s.' % maximum_carat_weight)
 
-        color = self.color_aliases.get(cached_clean(data.get('Color'), upper=True))
+        color = self.color_aliases.resolve(data.get('Color'))
 
         if not color:
             raise SkipDiamond('Not a standard color.')
@@ -136,9 +122,7 @@ class Backend(JSONBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -150,7 +134,7 @@ class Backend(JSONBackend):
         except KeyError as e:
             raise KeyValueError('clarity', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('Make'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('Make'))
         try:
             if isinstance(data.get('PricePerCarat'), dict):
                 # TODO: Verify that data['PricePerCarat']['CurrencyCode'] is USD
@@ -190,8 +174,8 @@ class Backend(JSONBackend):
             girdle = ''
 
         culet = cached_clean(data.get('Culet'), upper=True)
-        polish = self.grading_aliases.get(cached_clean(data.get('Polish'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('Symmetry'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('Polish'))
+        symmetry = self.grading_aliases.resolve(data.get('Symmetry'))
 
         # Fluorescence and color are combined, e.g 'FAINT BLUE'
         fl = data.get('Fluorescence', '')
@@ -203,16 +187,14 @@ class Backend(JSONBackend):
             fluorescence = cached_clean(fl, upper=True)
             fluorescence_color = cached_clean(flcolor, upper=True)
 
-            for abbr, id in self.fluorescence_aliases.iteritems():
-                if fluorescence.startswith(abbr.upper()):
-                    fluorescence_id = id
-                    continue
+            abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+            if abbr:
+                fluorescence_id = id
             fluorescence = fluorescence_id
 
-            for abbr, id in self.fluorescence_color_aliases.iteritems():
-                if fluorescence_color.startswith(abbr.upper()):
-                    fluorescence_color_id = id
-                    continue
+            abbr, id = self.fluorescence_color_aliases.match_prefix(fluorescence_color)
+            if abbr:
+                fluorescence_color_id = id
             if fluorescence_color_id:
                 fluorescence_color = fluorescence_color_id
             else:
@@ -231,8 +213,6 @@ class Backend(JSONBackend):
         cert_image = data.get('CertificatePath')
         if not cert_image:
             cert_image = ''
-        elif verify_cert_images and cert_image != '' and not url_exists(cert_image):
-            cert_image = ''
 
         if carat_price is None:
             raise SkipDiamond('No carat_price specified')
@@ -245,16 +225,7 @@ class Backend(JSONBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
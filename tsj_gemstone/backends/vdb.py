@@ -1,22 +1,16 @@
-import csv
 from decimal import Decimal, InvalidOperation
 import json
 import logging
 import os
-import random
-import re
-from string import ascii_letters, digits, whitespace, punctuation
-import tempfile
-import time
 
 import requests
 
 from django.conf import settings
-from django.utils.lru_cache import lru_cache
 
-from .base import (LRU_CACHE_MAXSIZE, BaseBackend, ImportSourceError,
-                   KeyValueError, SkipDiamond)
-from .. import models
+from .base import (BaseBackend, ImportSourceError,
+                   KeyValueError, SkipDiamond, clean, cached_clean)
+from .feedcache import FEED_CACHE_DIR, get_feed_key
+from .paging import PageFetcher
 from ..prefs import prefs
 from ..utils import moneyfmt
 
@@ -24,22 +18,15 @@ logger = logging.getLogger(__name__)
 
 API_URL = 'http://apiservices.vdbapp.com/v2/diamonds'
 
-CLEAN_RE = re.compile('[%s%s%s%s]' % (punctuation, whitespace, ascii_letters, digits))
-
-def clean(data, upper=False):
-    if data is None:
-        return ''
-    data = ''.join(CLEAN_RE.findall(data)).strip().replace('\n', ' ').replace('\r', '')
-    if upper:
-        data = data.upper()
-
-    return data
-
-cached_clean = lru_cache(maxsize=LRU_CACHE_MAXSIZE)(clean)
-
+# Pages to fetch at once, and at most how many a second.  VDB rate limits,
+# so these stay low.
+VDB_PAGE_WORKERS = getattr(settings, 'TSJ_GEMSTONE_VDB_PAGE_WORKERS', 2)
+VDB_PAGE_RATE = getattr(settings, 'TSJ_GEMSTONE_VDB_PAGE_RATE', 2)
 
 class Backend(BaseBackend):
     debug_filename = os.path.join(os.path.dirname(__file__), '../tests/data/vdb.json')
+    prefilter_carat_weight = 'size'
+    prefilter_total_price = 'total_sales_price'
 
     @property
     def enabled(self):
@@ -85,60 +72,52 @@ class Backend(BaseBackend):
             'Authorization': 'Token token={}, api_key={}'.format(prefs.get('vdb_access_token'), prefs.get('vdb_api_key')),
         }
 
-        ids = set()
-
-        # Preliminary request to check that we've got access
-        response = requests.get(API_URL, params=params, headers=headers)
-        doc = response.json()
-        if doc['response']['header']['status'] != 200:
-            raise ImportSourceError('VDB Error: %s' % doc['response']['body'])
-
-        # Accumulate paginated diamond data into ret
-        while True:
-            new_ids = 0
-            page_data = []
-
-            response = requests.get(API_URL, params=params, headers=headers)
+        def iter_rows():
+            session = requests.Session()
 
+            # Preliminary request to check that we've got access
+            response = session.get(API_URL, params=params, headers=headers)
             doc = response.json()
-            for d in doc['response']['body']['diamonds']:
-                page_data.append(d)
-
-            if not page_data:
-                break
-
-            for row in page_data:
-                if row['id'] not in ids:
-                    ids.add(row['id'])
-                    new_ids += 1
-                    data.append(row)
-
-            # If there aren't any new serial numbers, we're probably in an infinite loop
-            if not new_ids:
-                logger.warning('VDB infinite loop (diamond count {})'.format(len(ids)))
-                break
-
-            params['page_number'] = int(params['page_number']) + 1
-
-            # Spread requests out a bit to avoid rate limiting
-            time.sleep(random.random()*2.5)
-
-        return data
-
-    def _run(self):
+            if doc['response']['header']['status'] != 200:
+                raise ImportSourceError('VDB Error: %s' % doc['response']['body'])
+
+            def fetch_page(page_number):
+                response = session.get(API_URL, params=dict(params, page_number=page_number), headers=headers)
+                response.raise_for_status()
+                return response.json()['response']['body']['diamonds']
+
+            pages = PageFetcher(
+                fetch_page, lambda row: row['id'], name='VDB',
+                workers=VDB_PAGE_WORKERS, rate=VDB_PAGE_RATE,
+                retry_exceptions=(requests.RequestException, ValueError),
+            )
+            # Rows are yielded as their pages arrive rather than collected, so
+            # only a window of pages is ever held in memory
+            return iter(pages)
+
+        # VDB has no ETags, so without the feed cache there's nothing to
+        # keep and the rows are transformed as they arrive
+        if not FEED_CACHE_DIR:
+            return iter_rows()
+
+        # With it, a feed is reused while it's fresh, and sites with the
+        # same account and search prefs share it.  Rows are stored one per
+        # line and transformed once paging finishes.
+        def download(etag, last_modified):
+            return (json.dumps(row) + '\n' for row in iter_rows()), None, None
+
+        key = get_feed_key(API_URL, prefs.get('vdb_api_key'), prefs.get('vdb_access_token'), sorted(params.items()))
+        return (json.loads(line) for line in self.open_feed(key, download))
+
+    def _run(self, writer):
         data = self.get_data()
 
-        tmp_file = tempfile.NamedTemporaryFile(mode='w', prefix='gemstone_diamond_%s.' % self.backend_module)
-        writer = csv.writer(tmp_file, quoting=csv.QUOTE_NONE, escapechar='\\', lineterminator='\n', delimiter='\t')
-
         for row in data:
             self.try_write_row(writer, row)
 
         if self.row_buffer:
             writer.writerows(self.row_buffer)
 
-        return tmp_file
-
     def write_diamond_row(self, data):
         (
             minimum_carat_weight,
@@ -158,8 +137,8 @@ class Backend(BaseBackend):
         except KeyError as e:
             raise KeyValueError('cut_aliases', e.args[0])
 
-        cut_grade = self.grading_aliases.get(cached_clean(data.get('cut'), upper=True))
-        color = self.color_aliases.get(cached_clean(data.get('color'), upper=True))
+        cut_grade = self.grading_aliases.resolve(data.get('cut'))
+        color = self.color_aliases.resolve(data.get('color'))
 
         clarity = cached_clean(data.get('clarity'), upper=True)
         if not clarity:
@@ -183,16 +162,7 @@ class Backend(BaseBackend):
         if maximum_price and price_before_markup > maximum_price:
             raise SkipDiamond('Price before markup is greater than the maximum of %s.' % maximum_price)
 
-        price = None
-        for markup in self.markup_list:
-            if prefs.get('markup') == 'carat_weight':
-                if markup[0] <= carat_weight and markup[1] >= carat_weight:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
-            else:
-                if markup[0] <= price_before_markup and markup[1] >= price_before_markup:
-                    price = (price_before_markup * (1 + markup[2]/100))
-                    break
+        price = self.markup.apply(price_before_markup, carat_weight)
 
         if not price:
             if prefs.get('markup') == 'carat_weight':
@@ -216,9 +186,7 @@ class Backend(BaseBackend):
             raise SkipDiamond('Certifier disabled')
 
         if certifier and not certifier_id:
-            new_certifier = models.Certifier.objects.create(name=certifier, abbr=certifier)
-            self.certifier_aliases.update({certifier: (int(new_certifier.id), new_certifier.disabled)})
-            certifier = new_certifier.pk
+            certifier = self.new_certifier(certifier)
         else:
             certifier = certifier_id
 
@@ -253,18 +221,17 @@ class Backend(BaseBackend):
             girdle = ''
 
         culet = cached_clean(data.get('culet_size'))
-        polish = self.grading_aliases.get(cached_clean(data.get('polish'), upper=True))
-        symmetry = self.grading_aliases.get(cached_clean(data.get('symmetry'), upper=True))
+        polish = self.grading_aliases.resolve(data.get('polish'))
+        symmetry = self.grading_aliases.resolve(data.get('symmetry'))
 
         fluorescence_id = None
         fluorescence_color_id = None
         fl = data.get('fluor_intensity', '')
         if fl:
             fluorescence = cached_clean(fl, upper=True)
-            for abbr, id in self.fluorescence_aliases.iteritems():
-                if fluorescence.startswith(abbr.upper()):
-                    fluorescence_id = id
-                    continue
+            abbr, id = self.fluorescence_aliases.match_prefix(fluorescence)
+            if abbr:
+                fluorescence_id = id
 
         length = data.get('meas_length')
         width = data.get('meas_width')
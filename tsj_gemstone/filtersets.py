@@ -1,7 +1,7 @@
 from django import forms
 from django.db.models import FieldDoesNotExist, Min, Max, Q
 
-from tsj_gemstone.models import Certifier, Clarity, Color, Cut, Diamond, FancyColorIntensity, Fluorescence, Grading
+from tsj_gemstone.models import GRADE_ORDER_FIELDS, Certifier, Clarity, Color, Cut, Diamond, FancyColorIntensity, Fluorescence, Grading
 
 import django_filters
 
@@ -36,6 +36,17 @@ class RangeChoiceFilter(django_filters.RangeFilter):
     field_class = RangeChoiceField
 
     def filter(self, qs, value):
+        if value.start and value.stop and self.name in GRADE_ORDER_FIELDS:
+            # Range over the diamond's own copy of the grades' order, unless
+            # the order of either grade isn't known yet
+            orders = qs.model._meta.get_field(self.name).related_model.objects.as_order_dict()
+            start, stop = orders.get(value.start.pk), orders.get(value.stop.pk)
+            if start is not None and stop is not None:
+                if start > stop:
+                    start, stop = stop, start
+                order = '%s_order' % self.name
+                q = (Q(**{'%s__range' % order: (start, stop)}) | Q(**{'%s__isnull' % order: True}))
+                return qs.filter(q)
         if value.start and value.stop:
             rel_model = qs.model._meta.get_field(self.name).related_model
             try:
@@ -0,0 +1,113 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import QueryDict
+
+from poc_command_overrides.management.utils import MultisiteCommand
+
+from tsj_gemstone.filtersets import GemstoneFilterSet
+from tsj_gemstone.models import Diamond
+from tsj_gemstone.paginator import KeysetPaginator
+from tsj_gemstone.summary import get_summary
+
+PAGE_SIZE = 50
+
+def get_plan_indexes(plan):
+    "The names of the indexes an EXPLAIN plan scans"
+    names = set()
+    if 'Index Name' in plan:
+        names.add(plan['Index Name'])
+    for subplan in plan.get('Plans', ()):
+        names |= get_plan_indexes(subplan)
+    return names
+
+def get_parent_indexes(names):
+    "Partitions' indexes by the partitioned table's index they belong to"
+    cursor = connection.cursor()
+    cursor.execute("""
+        SELECT child.relname, parent.relname FROM pg_inherits
+        JOIN pg_class child ON child.oid = inhrelid
+        JOIN pg_class parent ON parent.oid = inhparent
+        WHERE child.relname = ANY(%s)
+    """, (list(names),))
+    parents = dict(cursor.fetchall())
+    return set(parents.get(name, name) for name in names)
+
+class Command(MultisiteCommand, BaseCommand):
+    help = "EXPLAIN ANALYZE the diamond list views' queries on this site's inventory"
+    tsj_site_option_required = False
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+
+        parser.add_argument('-r', '--repeat',
+            action='store',
+            dest='repeat',
+            type=int,
+            default=3,
+            help='Number of times to run each query; the fastest run is reported',
+        )
+
+    def get_cases(self):
+        "(name, queryset, the index it should use) for each kind of page"
+        totals = get_summary().totals(active=True)
+        if not totals:
+            return []
+
+        active = Diamond.objects.filter(active=True)
+        # The middle of the ranges
+        price = (totals['price_min'] + totals['price_max']) / 2
+        carat_weight = (totals['carat_weight_min'] + totals['carat_weight_max']) / 2
+        cut = active.values_list('cut__abbr', flat=True)[:1][0]
+
+        def search(ordering, **data):
+            q = QueryDict('', mutable=True)
+            for name, value in data.items():
+                q.setlist(name, value if isinstance(value, list) else [value])
+            return GemstoneFilterSet(q, queryset=active.order_by(ordering)).qs
+
+        keyset = KeysetPaginator(active, PAGE_SIZE, Diamond._meta.get_field('price'))
+        deep = keyset.seek(active.order_by('price', 'pk'), (price, 0), True)
+
+        return [
+            ('first page by price', search('price'), 'tsj_gemstone_diamond_active_price'),
+            ('one shape by price', search('price', cut=[cut]), 'tsj_gemstone_diamond_active_cut_price'),
+            ('carat range by carat', search('carat_weight', carat_weight_0=totals['carat_weight_min'],
+                                            carat_weight_1=carat_weight), 'tsj_gemstone_diamond_active_carat'),
+            ('deep keyset page by price', deep, 'tsj_gemstone_diamond_active_price'),
+            ('fancy colors by carat', active.filter(fancy_color__isnull=False).order_by('carat_weight'),
+                'tsj_gemstone_diamond_fancy_carat'),
+            ('lab grown by carat', active.filter(manmade=True).order_by('carat_weight'),
+                'tsj_gemstone_diamond_manmade_carat'),
+        ]
+
+    def explain(self, queryset, repeat):
+        "The fastest of `repeat` runs' execution time (ms) and the indexes it scanned"
+        sql, params = queryset[:PAGE_SIZE].query.sql_with_params()
+        cursor = connection.cursor()
+        best = None
+        for i in range(repeat):
+            cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + sql, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            if best is None or plan[0]['Execution Time'] < best[0]['Execution Time']:
+                best = plan
+        return best[0]['Execution Time'], get_parent_indexes(get_plan_indexes(best[0]['Plan']))
+
+    def handle(self, *args, **options):
+        if options.get('site'):
+            self.set_site(options)
+
+        cases = self.get_cases()
+        if not cases:
+            self.stdout.write('There are no active diamonds to search')
+            return
+
+        self.stdout.write('%-28s %10s  %-4s %s' % ('Query', 'ms', 'Uses', 'Indexes'))
+        for name, queryset, expected in cases:
+            elapsed, indexes = self.explain(queryset, options['repeat'])
+            self.stdout.write('%-28s %10.2f  %-4s %s' % (
+                name, elapsed, 'yes' if expected in indexes else 'NO',
+                ', '.join(sorted(indexes)) or '(none)'))
@@ -32,6 +32,13 @@ class Command(MultisiteCommand, LabelCommand):
             dest='dry_run',
             help='Simulate an import and log what would occur',
         )
+        parser.add_argument('-w', '--workers',
+            action='store',
+            dest='workers',
+            type=int,
+            default=None,
+            help='Number of backends to run concurrently per site (requires --async)',
+        )
 
     def handle_label(self, router, **options):
         if Flags.readonly:
@@ -48,6 +55,7 @@ class Command(MultisiteCommand, LabelCommand):
             'dry_run': options.get('dry_run'),
             'nodebug': options.get('nodebug'),
             'verbosity': int(options.get('verbosity')),
+            'workers': options.get('workers'),
         }
 
         if options.get('site'):
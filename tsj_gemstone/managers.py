@@ -1,4 +1,21 @@
+from contextlib import contextmanager
+import threading
+from uuid import uuid4
+
+from django.conf import settings
+from django.core.cache import cache
 from django.db import models, connection
+from django.db.models import FieldDoesNotExist
+from django.db.models.signals import post_delete, post_save
+
+# Keep the alias dicts built by DictManager/NameDictManager in each process
+# rather than rebuilding them for every backend of every import
+ALIAS_CACHE = getattr(settings, 'TSJ_GEMSTONE_ALIAS_CACHE', True)
+
+# (version key, method) -> (version, dict).  The version for each schema's
+# table lives in the shared cache and is replaced whenever one of its rows
+# is saved or deleted, which lets every process notice the change.
+_alias_dicts = {}
 
 def list_to_dict(row_list):
     result_list = []
@@ -67,8 +84,93 @@ def list_to_dict_disabled(row_list):
 
     return dict(result_list)
 
-class DictManager(models.Manager):
+# The schema remembered for the length of an import (see remember_schema)
+_schema = threading.local()
+
+def get_schema_name():
+    """
+    The current site's schema.  Multi-tenant connections know it already,
+    and imports remember it; otherwise the database is asked.
+    """
+    schema = getattr(connection, 'schema_name', None) or getattr(_schema, 'name', None)
+    if schema is None:
+        cursor = connection.cursor()
+        cursor.execute('SELECT current_schema();')
+        schema = cursor.fetchone()[0]
+    return schema
+
+@contextmanager
+def remember_schema():
+    "Asks for the schema once for the whole block, which mustn't change it"
+    previous = getattr(_schema, 'name', None)
+    _schema.name = get_schema_name()
+    try:
+        yield
+    finally:
+        _schema.name = previous
+
+def get_alias_version_key(db_table):
+    return 'tsj_gemstone:aliases:%s:%s' % (get_schema_name(), db_table)
+
+def get_summary_key():
+    return 'tsj_gemstone:summary:%s' % get_schema_name()
+
+def invalidate_summary(sender=None, **kwargs):
+    "Drops the inventory summary (see summary.py) so the next page view rebuilds it"
+    cache.delete(get_summary_key())
+
+def invalidate_alias_dicts(sender, **kwargs):
+    cache.set(get_alias_version_key(sender._meta.db_table), uuid4().hex, None)
+    # The summary holds copies of the lookup tables
+    invalidate_summary()
+
+def cached_alias_dict(manager, method, build):
+    """
+    Return a copy of the dict `build` makes, reusing the one this process
+    built last time if nobody has changed the table since.  Changes made
+    without signals (queryset.update(), raw SQL) aren't noticed.
+    """
+    if not ALIAS_CACHE:
+        return build()
+
+    key = get_alias_version_key(manager.model._meta.db_table)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, uuid4().hex, None)
+        version = cache.get(key)
+
+    cached = _alias_dicts.get((key, method))
+    if cached is None or cached[0] != version:
+        cached = _alias_dicts[(key, method)] = (version, build())
+    return dict(cached[1])
+
+class AliasDictMixin(object):
+    def contribute_to_class(self, model, name):
+        super(AliasDictMixin, self).contribute_to_class(model, name)
+        if not model._meta.abstract:
+            post_save.connect(invalidate_alias_dicts, sender=model, dispatch_uid='tsj_gemstone_aliases_save_%s' % model._meta.db_table)
+            post_delete.connect(invalidate_alias_dicts, sender=model, dispatch_uid='tsj_gemstone_aliases_delete_%s' % model._meta.db_table)
+
+class DictManager(AliasDictMixin, models.Manager):
     def as_dict(self):
+        return cached_alias_dict(self, 'as_dict', self._as_dict)
+
+    def as_order_dict(self):
+        "Each row's place on its scale by id, as stored in the diamonds' *_order columns"
+        return cached_alias_dict(self, 'as_order_dict', self._as_order_dict)
+
+    def get_order_sql(self):
+        "SELECT id, order for every row; scales without an order are ordered by abbr"
+        try:
+            self.model._meta.get_field('order')
+        except FieldDoesNotExist:
+            return 'SELECT id, dense_rank() OVER (ORDER BY abbr) AS "order" FROM %s' % self.model._meta.db_table
+        return 'SELECT id, "order" FROM %s' % self.model._meta.db_table
+
+    def as_dict_disabled(self):
+        return cached_alias_dict(self, 'as_dict_disabled', self._as_dict_disabled)
+
+    def _as_dict(self):
         cursor = connection.cursor()
         try:
             name_field = self.model._meta.get_field('name')
@@ -77,7 +179,12 @@ class DictManager(models.Manager):
             cursor.execute('SELECT id, abbr, aliases FROM %s;' % self.model._meta.db_table)
         return list_to_dict(cursor.fetchall())
 
-    def as_dict_disabled(self):
+    def _as_order_dict(self):
+        cursor = connection.cursor()
+        cursor.execute(self.get_order_sql())
+        return dict(cursor.fetchall())
+
+    def _as_dict_disabled(self):
         cursor = connection.cursor()
         try:
             disabled_field = self.model._meta.get_field('disabled')
@@ -90,8 +197,11 @@ class DictManager(models.Manager):
                 cursor.execute('SELECT id, abbr, aliases FROM %s;' % self.model._meta.db_table)
         return list_to_dict_disabled(cursor.fetchall())
 
-class NameDictManager(models.Manager):
+class NameDictManager(AliasDictMixin, models.Manager):
     def as_dict(self):
+        return cached_alias_dict(self, 'as_dict', self._as_dict)
+
+    def _as_dict(self):
         cursor = connection.cursor()
         cursor.execute('SELECT id, name, aliases FROM %s;' % self.model._meta.db_table)
         return list_to_dict(cursor.fetchall())
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsj_gemstone', '0009_cost'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='diamond',
+            name='content_hash',
+            field=models.CharField(max_length=32, null=True, editable=False, blank=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='diamond',
+            index_together=set([('source', 'stock_number'), ('source', 'lot_num')]),
+        ),
+    ]
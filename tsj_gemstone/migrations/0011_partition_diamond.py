@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Declarative partitioning of tsj_gemstone_diamond by source (PostgreSQL 11+).
+# Each backend gets its own partition, created on demand by
+# tsj_gemstone_diamond_partition(), and anything else (e.g. diamonds added in
+# the admin) lands in tsj_gemstone_diamond_default.  A primary key on a
+# partitioned table has to include the partition key, so it becomes
+# (id, source); ids still come from the one sequence.
+
+# Other tables' foreign keys to the diamonds (e.g. carts or orders in the
+# host project) would have to reference the whole (id, source) key, and they
+# keep the old table from being dropped, so refuse to migrate until they're
+# dealt with.
+CHECK_INBOUND_FOREIGN_KEYS = """
+DO $$
+DECLARE
+    referencing text;
+BEGIN
+    SELECT string_agg(format('%%s (%%s)', conrelid::regclass, conname), ', ') INTO referencing
+    FROM pg_constraint
+    WHERE confrelid = '%(table)s'::regclass AND conrelid <> confrelid AND contype = 'f';
+
+    IF referencing IS NOT NULL THEN
+        RAISE EXCEPTION 'tsj_gemstone_diamond can''t be %(action)s while foreign keys reference it: %%', referencing
+            USING HINT = 'Drop those foreign keys, migrate, and recreate them to reference (id, source) if they are still needed.';
+    END IF;
+END;
+$$;
+"""
+
+# Recreate the foreign keys and indexes of the renamed table %(old)s on
+# %(new)s, then drop %(old)s.
+MOVE_CONSTRAINTS = """
+DO $$
+DECLARE
+    r record;
+    index_defs text[];
+    index_def text;
+BEGIN
+    FOR r IN
+        SELECT conname, pg_get_constraintdef(oid) AS def FROM pg_constraint
+        WHERE conrelid = '%(old)s'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('ALTER TABLE %(new)s ADD CONSTRAINT %%I %%s', r.conname, r.def);
+    END LOOP;
+
+    SELECT array_agg(replace(pg_get_indexdef(indexrelid), '%(old)s', '%(new)s')) INTO index_defs
+    FROM pg_index WHERE indrelid = '%(old)s'::regclass AND NOT indisprimary;
+
+    DROP TABLE %(old)s;
+
+    FOREACH index_def IN ARRAY coalesce(index_defs, '{}') LOOP
+        EXECUTE index_def;
+    END LOOP;
+END;
+$$;
+"""
+
+# The partition holding src's diamonds, created if need be.  New partitions
+# are named after the source plus a hash of it, so sources which only differ
+# in punctuation or case (or share a long prefix) can't collide.
+PARTITION_FUNCTION = """
+CREATE OR REPLACE FUNCTION tsj_gemstone_diamond_partition(src text) RETURNS text AS $$
+DECLARE
+    part text;
+BEGIN
+    SELECT c.relname INTO part
+    FROM pg_inherits i INNER JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'tsj_gemstone_diamond'::regclass
+    AND pg_get_expr(c.relpartbound, c.oid) = format('FOR VALUES IN (%L)', src);
+
+    IF part IS NULL THEN
+        part := 'tsj_gemstone_diamond_p_'
+            || left(regexp_replace(lower(src), '[^a-z0-9_]', '_', 'g'), 30)
+            || '_' || left(md5(src), 8);
+        -- A partition can't be created while the default partition still
+        -- holds rows which belong in it, so move them over.
+        CREATE TEMP TABLE tsj_gemstone_diamond_moved AS
+            SELECT * FROM tsj_gemstone_diamond_default WHERE source = src;
+        DELETE FROM tsj_gemstone_diamond_default WHERE source = src;
+        EXECUTE format('CREATE TABLE %I PARTITION OF tsj_gemstone_diamond FOR VALUES IN (%L)', part, src);
+        INSERT INTO tsj_gemstone_diamond SELECT * FROM tsj_gemstone_diamond_moved;
+        DROP TABLE tsj_gemstone_diamond_moved;
+    END IF;
+    RETURN part;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+PARTITION_SQL = [
+    CHECK_INBOUND_FOREIGN_KEYS % {'table': 'tsj_gemstone_diamond', 'action': 'partitioned'},
+    'ALTER TABLE tsj_gemstone_diamond RENAME TO tsj_gemstone_diamond_unpartitioned',
+    'ALTER TABLE tsj_gemstone_diamond_unpartitioned RENAME CONSTRAINT tsj_gemstone_diamond_pkey TO tsj_gemstone_diamond_unpartitioned_pkey',
+    """
+    CREATE TABLE tsj_gemstone_diamond (
+        LIKE tsj_gemstone_diamond_unpartitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+    ) PARTITION BY LIST (source)
+    """,
+    'ALTER TABLE tsj_gemstone_diamond ADD CONSTRAINT tsj_gemstone_diamond_pkey PRIMARY KEY (id, source)',
+    'ALTER SEQUENCE tsj_gemstone_diamond_id_seq OWNED BY tsj_gemstone_diamond.id',
+    'CREATE TABLE tsj_gemstone_diamond_default PARTITION OF tsj_gemstone_diamond DEFAULT',
+    PARTITION_FUNCTION,
+    'SELECT tsj_gemstone_diamond_partition(source) FROM (SELECT DISTINCT source FROM tsj_gemstone_diamond_unpartitioned) s',
+    'INSERT INTO tsj_gemstone_diamond SELECT * FROM tsj_gemstone_diamond_unpartitioned',
+    MOVE_CONSTRAINTS % {'old': 'tsj_gemstone_diamond_unpartitioned', 'new': 'tsj_gemstone_diamond'},
+]
+
+UNPARTITION_SQL = [
+    CHECK_INBOUND_FOREIGN_KEYS % {'table': 'tsj_gemstone_diamond', 'action': 'unpartitioned'},
+    'ALTER TABLE tsj_gemstone_diamond RENAME TO tsj_gemstone_diamond_partitioned',
+    'ALTER TABLE tsj_gemstone_diamond_partitioned RENAME CONSTRAINT tsj_gemstone_diamond_pkey TO tsj_gemstone_diamond_partitioned_pkey',
+    """
+    CREATE TABLE tsj_gemstone_diamond (
+        LIKE tsj_gemstone_diamond_partitioned INCLUDING DEFAULTS INCLUDING CONSTRAINTS
+    )
+    """,
+    'ALTER TABLE tsj_gemstone_diamond ADD CONSTRAINT tsj_gemstone_diamond_pkey PRIMARY KEY (id)',
+    'ALTER SEQUENCE tsj_gemstone_diamond_id_seq OWNED BY tsj_gemstone_diamond.id',
+    'INSERT INTO tsj_gemstone_diamond SELECT * FROM tsj_gemstone_diamond_partitioned',
+    'DROP FUNCTION tsj_gemstone_diamond_partition(text)',
+    MOVE_CONSTRAINTS % {'old': 'tsj_gemstone_diamond_partitioned', 'new': 'tsj_gemstone_diamond'},
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsj_gemstone', '0010_content_hash'),
+    ]
+
+    operations = [
+        migrations.RunSQL(PARTITION_SQL, UNPARTITION_SQL),
+    ]
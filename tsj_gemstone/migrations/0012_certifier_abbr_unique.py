@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Backends create the certifiers they find in their feeds with an upsert on
+# the normalized abbreviation (see BaseBackend.create_certifiers), which
+# needs it to be unique.  Imports running side by side used to create the
+# same certifier more than once, so first merge each set of duplicates into
+# the oldest: its aliases are kept and everything pointing at a duplicate is
+# pointed at it instead.
+MERGE_DUPLICATES = """
+DO $$
+DECLARE
+    r record;
+BEGIN
+    CREATE TEMP TABLE tsj_gemstone_certifier_duplicate AS
+        SELECT c.id, k.keep FROM tsj_gemstone_certifier c
+        JOIN (
+            SELECT upper(btrim(abbr)) AS abbr, min(id) AS keep FROM tsj_gemstone_certifier
+            GROUP BY upper(btrim(abbr)) HAVING count(*) > 1
+        ) k ON upper(btrim(c.abbr)) = k.abbr AND c.id <> k.keep;
+
+    UPDATE tsj_gemstone_certifier c SET aliases = concat_ws(E'\\n', nullif(c.aliases, ''), a.aliases)
+    FROM (
+        SELECT d.keep, string_agg(nullif(x.aliases, ''), E'\\n') AS aliases
+        FROM tsj_gemstone_certifier x JOIN tsj_gemstone_certifier_duplicate d ON d.id = x.id
+        GROUP BY d.keep
+    ) a
+    WHERE c.id = a.keep AND a.aliases IS NOT NULL;
+
+    FOR r IN
+        SELECT conrelid::regclass AS tbl, attname FROM pg_constraint
+        JOIN pg_attribute ON attrelid = conrelid AND attnum = conkey[1]
+        WHERE confrelid = 'tsj_gemstone_certifier'::regclass AND contype = 'f'
+    LOOP
+        EXECUTE format('UPDATE %s t SET %I = d.keep FROM tsj_gemstone_certifier_duplicate d WHERE t.%I = d.id',
+                       r.tbl, r.attname, r.attname);
+    END LOOP;
+
+    DELETE FROM tsj_gemstone_certifier c USING tsj_gemstone_certifier_duplicate d WHERE c.id = d.id;
+    DROP TABLE tsj_gemstone_certifier_duplicate;
+END;
+$$;
+"""
+
+UNIQUE_SQL = [
+    MERGE_DUPLICATES,
+    'CREATE UNIQUE INDEX tsj_gemstone_certifier_abbr_uniq ON tsj_gemstone_certifier (upper(btrim(abbr)))',
+]
+
+# The merged duplicates stay merged
+NOT_UNIQUE_SQL = [
+    'DROP INDEX tsj_gemstone_certifier_abbr_uniq',
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsj_gemstone', '0011_partition_diamond'),
+    ]
+
+    operations = [
+        migrations.RunSQL(UNIQUE_SQL, NOT_UNIQUE_SQL),
+    ]
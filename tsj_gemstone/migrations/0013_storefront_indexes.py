@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Indexes for the list views' queries (see the benchmark_diamond_list
+# command).  GemstoneListView only shows active diamonds, sorted by price
+# unless asked otherwise and paged by (sort column, id), and most searches
+# pick a shape; the fancy and lab grown views sort by carat weight.  They're
+# partial so inactive diamonds, kept by delta imports, cost nothing.
+#
+# Created on the partitioned table, so each partition gets its own, and
+# StagingCopyWriter copies them onto its staging tables.
+INDEXES = (
+    ('tsj_gemstone_diamond_active_price', '(price, id) WHERE active'),
+    ('tsj_gemstone_diamond_active_carat', '(carat_weight, id) WHERE active'),
+    ('tsj_gemstone_diamond_active_cut_price', '(cut_id, price, id) WHERE active'),
+    ('tsj_gemstone_diamond_active_cut_carat', '(cut_id, carat_weight, id) WHERE active'),
+    ('tsj_gemstone_diamond_fancy_carat', '(carat_weight, id) WHERE fancy_color_id IS NOT NULL'),
+    ('tsj_gemstone_diamond_manmade_carat', '(carat_weight, id) WHERE manmade'),
+)
+
+CREATE_SQL = ['CREATE INDEX %s ON tsj_gemstone_diamond %s' % index for index in INDEXES] + [
+    'ANALYZE tsj_gemstone_diamond',
+]
+
+DROP_SQL = ['DROP INDEX %s' % name for name, definition in INDEXES]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tsj_gemstone', '0012_certifier_abbr_unique'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_SQL, DROP_SQL),
+    ]
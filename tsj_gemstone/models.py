@@ -1,6 +1,7 @@
 import json
 
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models.signals import post_delete, post_save
 from django.template import Context, loader
 from django.utils.functional import cached_property
 from django.core.urlresolvers import reverse as django_reverse
@@ -14,7 +15,7 @@ from thinkspace.apps.pages.urlresolvers import reverse
 from thinkspace.lib.db.models import View
 from ts_company.prefs import prefs as company_prefs
 from tsj_commerce_local.prefs import prefs as commerce_prefs
-from tsj_gemstone.managers import DictManager, NameDictManager
+from tsj_gemstone.managers import DictManager, NameDictManager, get_schema_name, invalidate_summary
 from tsj_gemstone.utils import moneyfmt
 
 class Cut(models.Model):
@@ -130,6 +131,7 @@ class FluorescenceColor(models.Model):
 
 class Certifier(models.Model):
     name = models.CharField(max_length=255)
+    # Unique ignoring case and surrounding spaces (migration 0012)
     abbr = models.CharField('Abbreviation', max_length=255, db_index=True)
     aliases = models.TextField(blank=True, help_text='One entry per line. Case-insensitive.')
     url = models.URLField('URL', blank=True)
@@ -243,6 +245,9 @@ class LabGrownDiamondMarkup(models.Model):
         verbose_name_plural = 'Lab Grown Markups'
         ordering = ['percent']
 
+# Grades with an *_order column on the diamonds
+GRADE_ORDER_FIELDS = ('color', 'clarity', 'cut_grade', 'polish', 'symmetry', 'fluorescence')
+
 class DiamondBase(TimeStampedModel):
     active = models.BooleanField(default=True)
     source = models.CharField(max_length=64)
@@ -289,6 +294,28 @@ class DiamondBase(TimeStampedModel):
 
     data = JSONField(default={})
 
+    # md5 of the imported row, used by delta imports to skip unchanged diamonds
+    content_hash = models.CharField(max_length=32, null=True, blank=True, editable=False)
+
+    # Copies of each grade's place on its scale (see DictManager.as_order_dict)
+    # so range searches don't have to join the lookup tables
+    color_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+    clarity_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+    cut_grade_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+    polish_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+    symmetry_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+    fluorescence_order = models.SmallIntegerField(null=True, blank=True, editable=False)
+
+    def save(self, *args, **kwargs):
+        # Code saving many diamonds looks the orders up once with
+        # get_grade_orders() and passes them in as grade_orders
+        grade_orders = kwargs.pop('grade_orders', None)
+        if grade_orders is None:
+            grade_orders = get_grade_orders()
+        for name in GRADE_ORDER_FIELDS:
+            setattr(self, name + '_order', grade_orders[name].get(getattr(self, name + '_id')))
+        super(DiamondBase, self).save(*args, **kwargs)
+
     def formatted_cost(self):
         curr = commerce_prefs.get('currency_symbol', '$')
         # Cost can be None.
@@ -380,6 +407,46 @@ class Diamond(DiamondBase):
         verbose_name = 'Diamond'
         verbose_name_plural = 'Diamonds'
         permissions = (("can_import_diamonds", "Can Import Diamonds"),)
+        index_together = (
+            ('source', 'stock_number'),
+            ('source', 'lot_num'),
+        )
+
+# Imports rebuild the inventory summary themselves; this catches diamonds
+# edited in the admin
+post_save.connect(invalidate_summary, sender=Diamond, dispatch_uid='tsj_gemstone_summary_save_diamond')
+post_delete.connect(invalidate_summary, sender=Diamond, dispatch_uid='tsj_gemstone_summary_delete_diamond')
+
+def get_grade_orders():
+    "The order of every grade by id, for each of GRADE_ORDER_FIELDS"
+    return dict((name, DiamondBase._meta.get_field(name).related_model.objects.as_order_dict())
+                for name in GRADE_ORDER_FIELDS)
+
+def update_grade_orders(scale):
+    "Brings the diamonds' *_order columns up to date after a change to a grading scale"
+    cursor = connection.cursor()
+    for name in GRADE_ORDER_FIELDS:
+        if Diamond._meta.get_field(name).related_model is not scale:
+            continue
+        cursor.execute("""
+            UPDATE tsj_gemstone_diamond d SET %s_order = g.order FROM (%s) g
+            WHERE d.%s_id = g.id AND d.%s_order IS DISTINCT FROM g.order
+        """ % (name, scale.objects.get_order_sql(), name, name))
+    # The grade's own save dropped the summary before these changed, and
+    # anything loaded since (counts, the search index) has the old orders
+    invalidate_summary()
+
+def queue_grade_orders_update(sender, **kwargs):
+    "Updates the diamonds' orders in a task rather than while the grade is saved"
+    # tasks imports the backends, which import this module
+    from tsj_gemstone.tasks import update_diamond_grade_orders
+
+    scale, schema = sender._meta.label, get_schema_name()
+    transaction.on_commit(lambda: update_diamond_grade_orders.delay(scale, schema=schema))
+
+for scale in (Color, Clarity, Grading, Fluorescence):
+    post_save.connect(queue_grade_orders_update, sender=scale, dispatch_uid='tsj_gemstone_grade_orders_save_%s' % scale._meta.db_table)
+    post_delete.connect(queue_grade_orders_update, sender=scale, dispatch_uid='tsj_gemstone_grade_orders_delete_%s' % scale._meta.db_table)
 
 # TODO: Generalize import logging into inventory_common or Django logging
 class ImportLog(models.Model):
@@ -0,0 +1,118 @@
+"""
+Keyset ("seek") pagination for the diamond list.  Rather than an OFFSET,
+which makes the database walk past every earlier row, each page asks for
+the rows after (or before) the last one shown, by the sort column and id:
+
+    WHERE (price, id) > (1234.00, 5678) ORDER BY price, id LIMIT 51
+
+so deep pages cost the same as the first.  Pages are linked with ?after=
+and ?before= cursors instead of page numbers.
+
+Only a local column which can't be NULL is used as a key; a NULL in the
+row comparison would hide rows.  KeysetPaginator.supports() says whether a
+sort field qualifies.
+"""
+from django.core.exceptions import ValidationError
+from django.db import connection
+
+CURSOR_SEPARATOR = '~'
+
+class KeysetPage(object):
+    def __init__(self, object_list, paginator, querystring, has_next, has_previous):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.querystring = querystring
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def get_query(self, **cursor):
+        q = self.querystring.copy()
+        for name in ('after', 'before', 'page'):
+            q.pop(name, None)
+        q.update(cursor)
+        return q.urlencode()
+
+    @property
+    def next_query(self):
+        if self._has_next and self.object_list:
+            return self.get_query(after=self.paginator.get_cursor(self.object_list[-1]))
+
+    @property
+    def previous_query(self):
+        if self._has_previous and self.object_list:
+            return self.get_query(before=self.paginator.get_cursor(self.object_list[0]))
+
+class KeysetPaginator(object):
+    def __init__(self, queryset, per_page, field, descending=False, count=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+        self.descending = descending
+        self._count = count
+
+    @staticmethod
+    def supports(field):
+        return field.concrete and not field.is_relation and not field.null
+
+    @property
+    def count(self):
+        "The number of rows across the pages, counted only if it wasn't given"
+        if self._count is None:
+            self._count = self.queryset.count()
+        return self._count
+
+    def get_cursor(self, obj):
+        return '%s%s%s' % (getattr(obj, self.field.attname), CURSOR_SEPARATOR, obj.pk)
+
+    def parse_cursor(self, cursor):
+        "The (value, pk) of a cursor, or None if it isn't one"
+        try:
+            value, pk = cursor.rsplit(CURSOR_SEPARATOR, 1)
+            return self.field.to_python(value), int(pk)
+        except (AttributeError, TypeError, ValueError, ValidationError):
+            return None
+
+    def seek(self, queryset, key, forward):
+        "The rows of the queryset after `key` if forward, or else before it"
+        qn = connection.ops.quote_name
+        opts = queryset.model._meta
+        columns = '(%s.%s, %s.%s)' % (qn(opts.db_table), qn(self.field.column),
+                                      qn(opts.db_table), qn(opts.pk.column))
+        op = '>' if forward != self.descending else '<'
+        return queryset.extra(where=['%s %s (%%s, %%s)' % (columns, op)], params=list(key))
+
+    def page(self, querystring):
+        prefix = '-' if self.descending else ''
+        queryset = self.queryset.order_by(prefix + self.field.name, prefix + 'pk')
+
+        after = self.parse_cursor(querystring.get('after'))
+        before = self.parse_cursor(querystring.get('before')) if after is None else None
+        if before is not None:
+            rows = list(self.seek(queryset, before, False).reverse()[:self.per_page + 1])
+            has_previous = len(rows) > self.per_page
+            rows = rows[:self.per_page][::-1]
+            has_next = True
+        else:
+            if after is not None:
+                queryset = self.seek(queryset, after, True)
+            rows = list(queryset[:self.per_page + 1])
+            has_next = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            has_previous = after is not None
+
+        return KeysetPage(rows, self, querystring, has_next, has_previous)
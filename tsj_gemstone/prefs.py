@@ -48,7 +48,7 @@ class GemstonePreferencesForm(PreferencesForm):
     rapaport_must_be_certified = forms.BooleanField(label='Must Be Certified',
             required=False, initial=True, help_text="Every imported diamond must be certified. If the certifier doesn't exist in the database, an entry will be automatically created by the import tool. If the diamond being imported isn't certified, it will be discarded. If the certifier of the diamond being imported exists but is disabled, it will be discarded.")
     rapaport_verify_cert_images = forms.BooleanField(label='Verify Cert. Images',
-            required=False, help_text="If a certificate image URL is provided, confirm the URL. This will slow the import process down considerably as each defined certificate image is independently confirmed. If the image doesn't exist, the URL is removed from the diamond being imported but the rest of the diamond will be imported as expected.")
+            required=False, help_text="If a certificate image URL is provided, confirm the URL. This will slow the import process down as each new certificate image URL has to be confirmed, although URLs are checked several at a time and remembered between imports. If the image doesn't exist, the URL is removed from the diamond being imported but the rest of the diamond will be imported as expected.")
 
     include_mined = forms.BooleanField(label='Include Mined Diamonds', required=False, initial=True)
     include_lab_grown = forms.BooleanField(label='Include Lab-Grown Diamonds', required=False, initial=False)
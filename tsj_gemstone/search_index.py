@@ -0,0 +1,187 @@
+"""
+An in-memory, columnar copy of a site's diamonds for the list views.  The
+columns the storefront searches and sorts on are loaded into NumPy arrays
+once per state of the inventory (InventorySummary.version, which changes
+with every import), and each search is answered with vectorized masks and
+a sort in the process.  Only the diamonds on the page being shown are then
+fetched from the database.
+
+Turned on with TSJ_GEMSTONE_SEARCH_INDEX, and only used when NumPy is
+installed.  Searches it can't answer exactly like GemstoneFilterSet would
+(other filters or sort orders) go through the ORM as before.
+"""
+from collections import OrderedDict
+from decimal import ROUND_CEILING, ROUND_FLOOR
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.conf import settings
+from django.db import connection
+
+import django_filters
+
+from .filtersets import RangeChoiceFilter, RangeDecimalFilter
+from .models import GRADE_ORDER_FIELDS, Diamond
+
+SEARCH_INDEX = getattr(settings, 'TSJ_GEMSTONE_SEARCH_INDEX', False) and numpy is not None
+
+# Indexes kept by each process; older ones are dropped first
+SEARCH_INDEX_SIZE = getattr(settings, 'TSJ_GEMSTONE_SEARCH_INDEX_SIZE', 8)
+
+# Stands in for NULL in the integer columns
+NULL = -1
+
+# Decimal columns, held as whole multiples of 1/scale so they compare exactly
+DECIMAL_COLUMNS = {
+    'price': 100,
+    'carat_price': 100,
+    'carat_weight': 100,
+}
+
+INDEX_SQL = """
+    SELECT id, active, manmade, fancy_color_id IS NOT NULL, source, cut_id, certifier_id,
+           (price * 100)::bigint, (carat_price * 100)::bigint, (carat_weight * 100)::bigint,
+           %s
+    FROM tsj_gemstone_diamond
+""" % ', '.join('%s_order' % name for name in GRADE_ORDER_FIELDS)
+
+def nullable(values, dtype):
+    return numpy.array([NULL if value is None else value for value in values], dtype=dtype)
+
+class SearchResults(object):
+    """
+    The diamonds a search found, in order, for a paginator.  Slicing fetches
+    just those diamonds from `queryset`.
+    """
+    def __init__(self, ids, queryset):
+        self.ids = ids
+        self.queryset = queryset
+
+    def count(self):
+        return len(self.ids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        ids = [int(id) for id in self.ids[key]]
+        diamonds = dict((diamond.pk, diamond) for diamond in self.queryset.filter(pk__in=ids))
+        # Anything deleted since the index was loaded is left out
+        return [diamonds[id] for id in ids if id in diamonds]
+
+class SearchIndex(object):
+    def __init__(self):
+        cursor = connection.cursor()
+        cursor.execute(INDEX_SQL)
+        rows = cursor.fetchall()
+        columns = zip(*rows) if rows else [()] * (10 + len(GRADE_ORDER_FIELDS))
+
+        self.id = numpy.array(columns[0], dtype=numpy.int64)
+        self.active = numpy.array(columns[1], dtype=bool)
+        self.manmade = nullable(columns[2], numpy.int8)
+        self.fancy = numpy.array(columns[3], dtype=bool)
+        self.sources, self.source = numpy.unique(numpy.array(columns[4], dtype=object), return_inverse=True)
+        self.cut = numpy.array(columns[5], dtype=numpy.int32)
+        self.certifier = nullable(columns[6], numpy.int32)
+        self.price = numpy.array(columns[7], dtype=numpy.int64)
+        self.carat_price = numpy.array(columns[8], dtype=numpy.int64)
+        self.carat_weight = numpy.array(columns[9], dtype=numpy.int64)
+        self.orders = dict(
+            (name, nullable(values, numpy.int16))
+            for name, values in zip(GRADE_ORDER_FIELDS, columns[10:])
+        )
+
+    def filter_flags(self, mask, flags, sources, hide_manmade):
+        "The rows of the view's queryset; see InventorySummary.totals"
+        for flag, value in flags.items():
+            if flag == 'manmade':
+                mask &= self.manmade == int(value)
+            else:
+                mask &= getattr(self, flag) == value
+        if sources:
+            codes = [i for i, source in enumerate(self.sources) if source in sources]
+            mask &= numpy.in1d(self.source, codes)
+        if hide_manmade:
+            mask &= self.manmade != 1
+        return mask
+
+    def filter_decimal(self, mask, name, value):
+        "RangeDecimalFilter.filter"
+        column, scale = getattr(self, name), DECIMAL_COLUMNS[name]
+        if value.start:
+            mask &= column >= int((value.start * scale).to_integral_value(ROUND_CEILING))
+        if value.stop:
+            mask &= column <= int((value.stop * scale).to_integral_value(ROUND_FLOOR))
+        return mask
+
+    def filter_grade(self, mask, name, value):
+        """
+        RangeChoiceFilter.filter, or None for a grade without an order, which
+        RangeChoiceFilter looks up in the grade table instead.
+        """
+        if value.start and value.stop:
+            orders = Diamond._meta.get_field(name).related_model.objects.as_order_dict()
+            start, stop = orders.get(value.start.pk), orders.get(value.stop.pk)
+            if start is None or stop is None:
+                return None
+            start, stop = sorted((start, stop))
+            column = self.orders[name]
+            mask &= ((column >= start) & (column <= stop)) | (column == NULL)
+        return mask
+
+    def search(self, queryset, filterset, flags, sources=None, hide_manmade=False,
+               sort='price', descending=False):
+        """
+        SearchResults for the filterset over the view's diamonds, sorted by
+        `sort`, or None if this index can't answer it.  Like the views'
+        querysets, only active diamonds are searched.
+        """
+        if sort not in DECIMAL_COLUMNS or not filterset.form.is_valid():
+            return None
+
+        mask = self.filter_flags(self.active.copy(), flags, sources, hide_manmade)
+        for name, filter_ in filterset.filters.items():
+            value = filterset.form.cleaned_data.get(name)
+            if isinstance(filter_, RangeDecimalFilter) and name in DECIMAL_COLUMNS:
+                if value:
+                    mask = self.filter_decimal(mask, name, value)
+            elif isinstance(filter_, RangeChoiceFilter) and name in GRADE_ORDER_FIELDS:
+                if value:
+                    mask = self.filter_grade(mask, name, value)
+                    if mask is None:
+                        return None
+            elif isinstance(filter_, django_filters.ModelMultipleChoiceFilter) and name in ('cut', 'certifier'):
+                if value:
+                    mask &= numpy.in1d(getattr(self, name), [obj.pk for obj in value])
+            elif value:
+                return None
+
+        rows = numpy.flatnonzero(mask)
+        order = numpy.lexsort((self.id[rows], getattr(self, sort)[rows]))
+        if descending:
+            order = order[::-1]
+        return SearchResults(self.id[rows[order]], queryset)
+
+_indexes = OrderedDict()
+_lock = threading.Lock()
+
+def get_search_index(summary):
+    "The index of the inventory `summary` describes, loading it if need be"
+    with _lock:
+        index = _indexes.pop(summary.version, None)
+        if index is not None:
+            _indexes[summary.version] = index
+            return index
+
+    index = SearchIndex()
+    with _lock:
+        _indexes[summary.version] = index
+        while len(_indexes) > SEARCH_INDEX_SIZE:
+            _indexes.popitem(last=False)
+    return index
@@ -0,0 +1,111 @@
+"""
+A summary of each site's diamond inventory for the list views: the carat
+weight and price ranges, cuts, labs and number of diamonds of each group of
+diamonds, along with the lookup tables the search form offers.
+
+It only changes when diamonds are imported or edited, so it's kept in the
+shared cache and rebuilt at the end of each import (see BaseBackend.run)
+rather than aggregated over the whole table on every page view.  Saving or
+deleting a diamond or a lookup table row drops it, and the next page view
+builds it again.
+"""
+from collections import namedtuple
+from hashlib import md5
+from uuid import uuid4
+
+from django.conf import settings
+
+from django.core.cache import cache
+from django.db import connection
+
+from .managers import get_summary_key
+from .models import Certifier, Clarity, Color, Cut, Fluorescence, Grading
+
+# Seconds the size of a filtered list is remembered (see InventorySummary.count)
+COUNT_CACHE_TIMEOUT = getattr(settings, 'TSJ_GEMSTONE_COUNT_CACHE_TIMEOUT', 60 * 60)
+
+# Diamonds are summarized in groups which the list views can combine: by
+# source and by each of the flags the views filter on
+SummaryGroup = namedtuple('SummaryGroup', (
+    'source', 'active', 'manmade', 'fancy', 'count',
+    'carat_weight_min', 'carat_weight_max', 'price_min', 'price_max',
+    'cut_ids', 'certifier_ids',
+))
+
+SUMMARY_SQL = """
+    SELECT source, active, manmade, fancy_color_id IS NOT NULL, count(*),
+           min(carat_weight), max(carat_weight), min(price), max(price),
+           array_agg(DISTINCT cut_id), array_remove(array_agg(DISTINCT certifier_id), NULL)
+    FROM tsj_gemstone_diamond
+    GROUP BY 1, 2, 3, 4
+"""
+
+class InventorySummary(object):
+    def __init__(self):
+        # Names what's cached for this state of the inventory
+        self.version = uuid4().hex
+
+        cursor = connection.cursor()
+        cursor.execute(SUMMARY_SQL)
+        self.groups = [SummaryGroup(*row) for row in cursor.fetchall()]
+
+        self.cuts = list(Cut.objects.order_by('order'))
+        self.colors = list(Color.objects.order_by('-abbr'))
+        self.clarities = list(Clarity.objects.order_by('-order'))
+        self.gradings = list(Grading.objects.order_by('-order'))
+        self.fluorescences = list(Fluorescence.objects.order_by('-order'))
+        self.certifiers = list(Certifier.objects.order_by('abbr'))
+
+    def totals(self, sources=None, hide_manmade=False, **flags):
+        """
+        Totals over the diamonds with the given flags (active, manmade,
+        fancy), from `sources` if given and leaving out lab grown diamonds
+        if hide_manmade, matching the list views' querysets.
+        """
+        groups = [
+            group for group in self.groups
+            if all(getattr(group, flag) == value for flag, value in flags.items())
+            and (not sources or group.source in sources)
+            and not (hide_manmade and group.manmade)
+        ]
+        if not groups:
+            return None
+
+        cut_ids = set()
+        certifier_ids = set()
+        counts = {}
+        for group in groups:
+            cut_ids.update(group.cut_ids)
+            certifier_ids.update(group.certifier_ids)
+            counts[group.source] = counts.get(group.source, 0) + group.count
+
+        return {
+            'count': sum(counts.values()),
+            'sources': counts,
+            'carat_weight_min': min(group.carat_weight_min for group in groups),
+            'carat_weight_max': max(group.carat_weight_max for group in groups),
+            'price_min': min(group.price_min for group in groups),
+            'price_max': max(group.price_max for group in groups),
+            'cuts': [cut for cut in self.cuts if cut.id in cut_ids],
+            'certifiers': [certifier for certifier in self.certifiers if certifier.id in certifier_ids],
+        }
+
+    def count(self, queryset, *key):
+        """
+        The number of diamonds in `queryset`, which `key` identifies.  It's
+        remembered until the summary is rebuilt, when it may have changed.
+        """
+        cache_key = 'tsj_gemstone:count:%s:%s' % (self.version, md5(repr(key)).hexdigest())
+        count = cache.get(cache_key)
+        if count is None:
+            count = queryset.count()
+            cache.set(cache_key, count, COUNT_CACHE_TIMEOUT)
+        return count
+
+def rebuild_summary():
+    summary = InventorySummary()
+    cache.set(get_summary_key(), summary, None)
+    return summary
+
+def get_summary():
+    return cache.get(get_summary_key()) or rebuild_summary()
@@ -1,16 +1,21 @@
 import logging
 
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
 from django.db import connection
 
 from celery import shared_task, current_task
+from celery.exceptions import SoftTimeLimitExceeded
 
 logger = logging.getLogger(__name__)
 
 # FIXME: Loading prefs here means values will persist until the worker process dies,
 #        changes made in the admin won't be reflected.  What if we added a setting
 #        to prefs to never persist values in memory?
-from tsj_gemstone import backends, prefs
+from tsj_gemstone import backends, models, prefs
 from tsj_gemstone.backends.base import SkipImport
+from tsj_gemstone.summary import rebuild_summary
 from tsj_gemstone.utils import get_backend
 
 try:
@@ -18,8 +23,21 @@ try:
 except ImportError:
     set_site = False
 
+# Number of backends a site may run at the same time.  1 keeps the original
+# behavior of running every backend one after another in a single task.
+# Otherwise the backends are dealt out into that many lanes, each a series of
+# Celery tasks that start the next backend when they finish.  The lanes still
+# running are counted in the cache, which must be shared by the workers.
+IMPORT_WORKERS = getattr(settings, 'TSJ_GEMSTONE_IMPORT_WORKERS', 1)
+
+# Seconds a single backend may run before it's abandoned (None to disable).
+# Only enforced when backends are dispatched as separate Celery tasks.  A
+# backend that ignores this soft limit is killed a minute later; it gets no
+# import record, but its lane carries on with the next backend.
+BACKEND_TIMEOUT = getattr(settings, 'TSJ_GEMSTONE_BACKEND_TIMEOUT', None)
+
 @shared_task
-def import_gemstone_backends(router, dry_run=False, nodebug=False, verbosity=1):
+def import_gemstone_backends(router, dry_run=False, nodebug=False, verbosity=1, workers=None):
     cursor = connection.cursor()
     cursor.execute("""
         SELECT DISTINCT db_schema FROM tsj_sites_siteinstance
@@ -29,16 +47,47 @@ def import_gemstone_backends(router, dry_run=False, nodebug=False, verbosity=1):
 
     if current_task.request.called_directly:
         for row in cursor.fetchall():
-            import_site_gemstone_backends(schema=row[0], dry_run=dry_run, nodebug=nodebug, verbosity=verbosity)
+            import_site_gemstone_backends(schema=row[0], dry_run=dry_run, nodebug=nodebug, verbosity=verbosity, workers=workers)
     else:
         for row in cursor.fetchall():
-            import_site_gemstone_backends.delay(schema=row[0], dry_run=dry_run, nodebug=nodebug, verbosity=verbosity)
+            import_site_gemstone_backends.delay(schema=row[0], dry_run=dry_run, nodebug=nodebug, verbosity=verbosity, workers=workers)
+
+def _run_backend(backend, bname, schema=None, verbosity=1):
+    "Run a single enabled backend.  Returns a short status string."
+    try:
+        backend.run()
+    except SkipImport:
+        if verbosity > 1:
+            print 'Skipping {}'.format(bname)
+        return 'skipped'
+    except SoftTimeLimitExceeded:
+        logger.error('Backend {} for site {} exceeded its time limit'.format(bname, schema))
+        if backend.import_id:
+            backend.import_errors['Import exceeded the time limit of {} seconds'.format(BACKEND_TIMEOUT)] = 1
+            backend.update_import_record('error')
+        return 'timeout'
+    except Exception:
+        logger.exception('Exception from backend {} for site {}'.format(bname, schema))
+        return 'error'
+
+    return 'processed'
+
+def _delete_disabled(delete_disabled):
+    if delete_disabled:
+        cursor = connection.cursor()
+        sql = 'DELETE FROM tsj_gemstone_diamond WHERE source IN (%s)' % ','.join(["'%s'" % bname for bname in delete_disabled])
+        cursor.execute(sql)
+        rebuild_summary()
 
 @shared_task
-def import_site_gemstone_backends(schema=None, dry_run=False, nodebug=False, verbosity=1):
+def import_site_gemstone_backends(schema=None, dry_run=False, nodebug=False, verbosity=1, workers=None):
     if set_site and not schema:
         assert schema, "Schema required for MT"
 
+    if workers is None:
+        workers = IMPORT_WORKERS
+
+    enabled = []
     delete_disabled = []
 
     if set_site:
@@ -65,20 +114,104 @@ def import_site_gemstone_backends(schema=None, dry_run=False, nodebug=False, ver
                 else:
                     print 'Running {}'.format(bname)
             if not dry_run:
-                try:
-                    backend.run()
-                except SkipImport:
-                    if verbosity > 1:
-                        print 'Skipping {}'.format(bname)
-                except Exception:
-                    logger.exception('Exception from backend {} for site {}'.format(bname, schema))
-                    continue
+                enabled.append((bname, backend))
         else:
             # A backend may have been enabled in the past, so we clear out
             # any potential leftover diamonds
             delete_disabled.append(bname)
 
-    if delete_disabled:
-        cursor = connection.cursor()
-        sql = 'DELETE FROM tsj_gemstone_diamond WHERE source IN (%s)' % ','.join(["'%s'" % bname for bname in delete_disabled])
-        cursor.execute(sql)
+    # Cleaned up first so a backend that fails, times out or loses its
+    # worker can't leave disabled diamonds on the site
+    _delete_disabled(delete_disabled)
+
+    concurrent = workers > 1 and len(enabled) > 1 and not current_task.request.called_directly
+
+    if concurrent:
+        # Deal the backends out into one lane per worker so that no more
+        # than `workers` backends run at once for this site, and rebuild the
+        # inventory summary once every lane has run out of backends.
+        task_id = current_task.request.id
+        bnames = [item[0] for item in enabled]
+        lanes = [bnames[i::workers] for i in range(min(workers, len(bnames)))]
+        cache.set(get_lanes_key(task_id), len(lanes), None)
+        for lane in lanes:
+            _lane_signature(lane, schema=schema, nodebug=nodebug, verbosity=verbosity,
+                            task_id=task_id).apply_async()
+        return
+
+    for bname, backend in enabled:
+        _run_backend(backend, bname, schema=schema, verbosity=verbosity)
+
+def get_lanes_key(task_id):
+    return 'tsj_gemstone:import_lanes:%s' % task_id
+
+def _lane_signature(lane, **kwargs):
+    """
+    The task for the first backend in `lane`, which starts the rest of the
+    lane when it's done, or if it fails or is killed
+    """
+    options = {}
+    if BACKEND_TIMEOUT:
+        options = {
+            'soft_time_limit': BACKEND_TIMEOUT,
+            'time_limit': BACKEND_TIMEOUT + 60,
+        }
+    bname, rest = lane[0], list(lane[1:])
+    signature = import_site_gemstone_backend.si(bname, lane=rest, **kwargs).set(**options)
+    signature.on_error(resume_site_gemstone_lane.si(bname, rest, **kwargs))
+    return signature
+
+def _continue_lane(lane, schema=None, task_id=None, **kwargs):
+    if lane:
+        _lane_signature(lane, schema=schema, task_id=task_id, **kwargs).apply_async()
+        return
+
+    # The last lane to finish rebuilds the summary
+    try:
+        remaining = cache.decr(get_lanes_key(task_id))
+    except ValueError:
+        remaining = 0
+    if remaining <= 0:
+        cache.delete(get_lanes_key(task_id))
+        finish_site_gemstone_backends.delay(schema=schema)
+
+@shared_task
+def import_site_gemstone_backend(bname, schema=None, nodebug=False, verbosity=1, task_id=None, lane=None):
+    if set_site:
+        set_site({'site': schema})
+
+    # Import records are tagged with the id of the site task that dispatched
+    # us so that one run's reports stay together.
+    backend = get_backend(bname)
+    backend = backend.Backend(
+        nodebug=nodebug,
+        task_id=task_id,
+    )
+    status = _run_backend(backend, bname, schema=schema, verbosity=verbosity)
+
+    if lane is not None:
+        _continue_lane(lane, schema=schema, nodebug=nodebug, verbosity=verbosity, task_id=task_id)
+    return bname, status
+
+# Bound so that Celery sends it on as a task rather than calling it in the
+# worker that saw the failure
+@shared_task(bind=True)
+def resume_site_gemstone_lane(self, bname, lane, schema=None, nodebug=False, verbosity=1, task_id=None):
+    "Error callback for a backend's task that failed, or was killed, before starting the rest of its lane"
+    logger.error('Backend {} for site {} did not finish, going on with the rest of its lane'.format(bname, schema))
+    _continue_lane(lane, schema=schema, nodebug=nodebug, verbosity=verbosity, task_id=task_id)
+
+@shared_task
+def finish_site_gemstone_backends(schema=None):
+    if set_site:
+        set_site({'site': schema})
+
+    rebuild_summary()
+
+@shared_task
+def update_diamond_grade_orders(scale, schema=None):
+    "Brings the diamonds' *_order columns up to date after a change to the grading scale `scale` (a model label)"
+    if set_site:
+        set_site({'site': schema})
+
+    models.update_grade_orders(apps.get_model(scale))
@@ -1,3 +1,15 @@
+from .test_aliases import AliasTableTest
+from .test_feedcache import FeedCacheTest, FeedStreamTest, OpenFeedTest
+from .test_grades import GradeOrderTest
+from .test_managers import CachedAliasDictTest
+from .test_mapping import (BatchFilterTest, FieldTest, ManmadeTest, MappedBackendEquivalenceTest, NormalizerTest,
+                           PrefilterTest, SkipReportTest)
+from .test_markup import MarkupTableTest, MarkupTest
+from .test_paginator import KeysetPaginatorTest
 from .test_rapaport import RapaportBackendTest
 from .test_rapnet10 import Rapnet10BackendTest
+from .test_search_index import SearchIndexTest
+from .test_streaming import XLSXReaderTest
 from .test_views import DiamondViewsTest
+from .test_writers import (CopyWriterTest, DeltaCopyWriterTest, PartitionTest, StagingCopyWriterTest,
+                           SyncCopyWriterTest)
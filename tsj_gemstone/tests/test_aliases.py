@@ -0,0 +1,41 @@
+from django.test import SimpleTestCase
+
+from tsj_gemstone.backends.base import AliasTable
+
+class AliasTableTest(SimpleTestCase):
+    def setUp(self):
+        self.aliases = AliasTable({
+            'VG': 1,
+            'VERY GOOD': 1,
+            'F': 2,
+            'FAINT': 2,
+            'M': 3,
+            'MEDIUM': 3,
+        })
+
+    def test_resolve(self):
+        self.assertEqual(self.aliases.resolve('very good'), 1)
+        self.assertEqual(self.aliases.resolve(' vg '), 1)
+        self.assertIsNone(self.aliases.resolve('EXCELLENT'))
+
+    def test_resolve_sees_changes(self):
+        self.assertIsNone(self.aliases.resolve('EX'))
+        self.aliases['EX'] = 4
+        self.assertEqual(self.aliases.resolve('EX'), 4)
+        self.aliases.update({'EXCELLENT': 4})
+        self.assertEqual(self.aliases.resolve('excellent'), 4)
+
+    def test_match_prefix_longest(self):
+        self.assertEqual(self.aliases.match_prefix('MEDIUM BLUE'), ('MEDIUM', 3))
+        self.assertEqual(self.aliases.match_prefix('FAINT'), ('FAINT', 2))
+        self.assertEqual(self.aliases.match_prefix('FNT'), ('F', 2))
+
+    def test_match_prefix_none(self):
+        self.assertEqual(self.aliases.match_prefix('NONE'), (None, None))
+        self.assertEqual(self.aliases.match_prefix(''), (None, None))
+        self.assertEqual(self.aliases.match_prefix(None), (None, None))
+
+    def test_match_prefix_sees_changes(self):
+        self.assertEqual(self.aliases.match_prefix('STRONG BLUE'), (None, None))
+        self.aliases['STRONG'] = 5
+        self.assertEqual(self.aliases.match_prefix('STRONG BLUE'), ('STRONG', 5))
@@ -0,0 +1,107 @@
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.test import SimpleTestCase
+
+from tsj_gemstone.backends.base import CopyWriter, FeedUnchanged
+from tsj_gemstone.backends.feedcache import FeedCache, FeedStream
+
+from .test_mapping import import_prefs
+from .test_writers import WriterTestCase
+
+class FeedStreamTest(SimpleTestCase):
+    def test_lines(self):
+        fp = FeedStream(['a,b\r\nc', '', ',d\r\n', 'e'])
+        self.assertEqual(list(fp), ['a,b\r\n', 'c,d\r\n', 'e'])
+
+    def test_read(self):
+        fp = FeedStream(['abc', 'def', 'g'])
+        self.assertEqual(fp.read(2), 'ab')
+        self.assertEqual(fp.read(3), 'cde')
+        self.assertEqual(fp.readline(), 'fg')
+        self.assertEqual(fp.read(), '')
+
+        fp = FeedStream(['abc', 'def'])
+        fp.read(1)
+        self.assertEqual(fp.read(), 'bcdef')
+
+    def test_reads_as_needed(self):
+        "Nothing is downloaded before it's read"
+        sent = []
+        def chunks():
+            for chunk in ('a\n', 'b\n', 'c\n'):
+                sent.append(chunk)
+                yield chunk
+        fp = FeedStream(chunks())
+        self.assertEqual(sent, [])
+        self.assertEqual(fp.readline(), 'a\n')
+        self.assertEqual(sent, ['a\n'])
+
+class FeedCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reuses_fresh_feed(self):
+        calls = []
+        def download(etag, last_modified):
+            calls.append((etag, last_modified))
+            return iter(['feed']), 'v1', None
+
+        feeds = FeedCache(self.directory)
+        path, digest = feeds.fetch('key', download)
+        self.assertEqual(feeds.fetch('key', download), (path, digest))
+        self.assertEqual(calls, [(None, None)])
+        with open(path) as fp:
+            self.assertEqual(fp.read(), 'feed')
+
+        feeds.max_age = 0
+        self.assertEqual(feeds.fetch('key', lambda etag, last_modified: None), (path, digest))
+
+class OpenFeedTest(WriterTestCase):
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+
+    def download(self, etag, last_modified):
+        self.calls.append((etag, last_modified))
+        if etag == '"v1"':
+            return None
+        return iter(['a\nb', '\n']), '"v1"', None
+
+    def open_feed(self, **values):
+        backend = self.backend_class()
+        with import_prefs(**values):
+            backend.populate_import_data()
+        return backend, backend.open_feed('key', self.download)
+
+    def imported(self, backend):
+        "What run_import does once the feed is imported"
+        self.write(CopyWriter, ['A'])
+        cache.set(backend.get_feed_cache_key(), backend.feed_fingerprint, None)
+        cache.set(backend.get_feed_validators_key(), backend.feed_validators, None)
+
+    def test_streams_without_cache(self):
+        backend, fp = self.open_feed()
+        self.assertIsInstance(fp, FeedStream)
+        self.assertEqual(list(fp), ['a\n', 'b\n'])
+        self.assertEqual(backend.feed_validators, ('"v1"', None))
+        self.assertEqual(self.calls, [(None, None)])
+
+    def test_unchanged(self):
+        backend, fp = self.open_feed()
+        self.imported(backend)
+        with self.assertRaises(FeedUnchanged):
+            self.open_feed()
+        self.assertEqual(self.calls[-1], ('"v1"', None))
+
+    def test_changed_prefs_download_again(self):
+        "A 304 can't be used when something besides the feed has changed"
+        backend, fp = self.open_feed()
+        self.imported(backend)
+        backend, fp = self.open_feed(rapaport_minimum_price='100')
+        self.assertEqual(list(fp), ['a\n', 'b\n'])
+        self.assertEqual(self.calls, [(None, None), (None, None)])
@@ -0,0 +1,55 @@
+from tsj_gemstone.backends.base import CopyWriter
+from tsj_gemstone.filtersets import RangeChoiceFilter
+from tsj_gemstone.models import Clarity, Diamond, get_grade_orders, update_grade_orders
+
+from .test_writers import WriterTestCase, make_row
+
+class GradeOrderTest(WriterTestCase):
+    def setUp(self):
+        self.clarities = list(Clarity.objects.order_by('order', 'pk')[:3])
+        backend = self.backend_class()
+        writer = CopyWriter(backend)
+        writer.writerows([make_row(backend, clarity.abbr, clarity_id=clarity.pk) for clarity in self.clarities])
+        writer.close()
+        self.queryset = Diamond.objects.filter(source=backend.backend_module)
+
+    def filter(self, start, stop):
+        filter_ = RangeChoiceFilter(name='clarity')
+        qs = filter_.filter(self.queryset, slice(start, stop))
+        return sorted(qs.values_list('stock_number', flat=True))
+
+    def test_range(self):
+        first, second, third = self.clarities
+        self.assertEqual(self.filter(first, second), sorted([first.abbr, second.abbr]))
+        self.assertEqual(self.filter(third, second), sorted([second.abbr, third.abbr]))
+
+    def test_unknown_order_falls_back(self):
+        "A grade the cached orders don't have yet is looked up in the grade table"
+        first = self.clarities[0]
+        get_grade_orders()
+        # Added without signals, so the cached orders don't notice
+        Clarity.objects.bulk_create([Clarity(name='New', abbr='NEW', order=first.order)])
+        new = Clarity.objects.get(abbr='NEW')
+        self.assertNotIn(new.pk, get_grade_orders()['clarity'])
+        self.assertEqual(self.filter(first, new), [first.abbr])
+
+    def test_save_takes_orders(self):
+        diamond = self.queryset.get(stock_number=self.clarities[0].abbr)
+        grade_orders = get_grade_orders()
+        grade_orders['clarity'] = {diamond.clarity_id: 42}
+        diamond.save(grade_orders=grade_orders)
+        self.assertEqual(Diamond.objects.get(pk=diamond.pk).clarity_order, 42)
+
+        diamond.save()
+        self.assertEqual(Diamond.objects.get(pk=diamond.pk).clarity_order, self.clarities[0].order)
+
+    def test_update_waits_for_task(self):
+        "Saving a grade leaves the diamonds to update_diamond_grade_orders"
+        clarity = self.clarities[0]
+        order, clarity.order = clarity.order, 999
+        clarity.save()
+        self.assertEqual(self.queryset.get(stock_number=clarity.abbr).clarity_order, order)
+
+        # The task's work
+        update_grade_orders(Clarity)
+        self.assertEqual(self.queryset.get(stock_number=clarity.abbr).clarity_order, 999)
@@ -0,0 +1,28 @@
+from django.test import TestCase
+
+from tsj_gemstone.managers import remember_schema
+from tsj_gemstone.models import Cut
+
+class CachedAliasDictTest(TestCase):
+    fixtures = (
+        'tsj_gemstone/cut.json',
+    )
+
+    def test_cached(self):
+        with remember_schema():
+            aliases = Cut.objects.as_dict()
+            with self.assertNumQueries(0):
+                self.assertEqual(Cut.objects.as_dict(), aliases)
+
+    def test_copies(self):
+        aliases = Cut.objects.as_dict()
+        aliases['NEW'] = 0
+        self.assertNotIn('NEW', Cut.objects.as_dict())
+
+    def test_saving_invalidates(self):
+        with remember_schema():
+            Cut.objects.as_dict()
+            cut = Cut.objects.order_by('pk')[0]
+            cut.aliases = 'A NEW ALIAS'
+            cut.save()
+            self.assertEqual(Cut.objects.as_dict()['A NEW ALIAS'], cut.pk)
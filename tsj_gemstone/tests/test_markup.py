@@ -0,0 +1,97 @@
+from decimal import Decimal
+import logging
+
+from django.test import SimpleTestCase
+
+from tsj_gemstone.backends.base import Markup, MarkupTable, logger
+
+D = Decimal
+
+class LogCapture(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class MarkupTableTest(SimpleTestCase):
+    def setUp(self):
+        self.log = LogCapture()
+        logger.addHandler(self.log)
+
+    def tearDown(self):
+        logger.removeHandler(self.log)
+
+    def test_find(self):
+        table = MarkupTable([
+            (D('0'), D('999.99'), D('50')),
+            (D('1000'), D('4999.99'), D('30')),
+            (D('5000'), D('100000'), D('20')),
+        ])
+        self.assertEqual(table.find(D('0')), D('50'))
+        self.assertEqual(table.find(D('999.99')), D('50'))
+        self.assertEqual(table.find(D('1000')), D('30'))
+        self.assertEqual(table.find(D('100000')), D('20'))
+        self.assertIsNone(table.find(D('100000.01')))
+
+    def test_gap(self):
+        table = MarkupTable([
+            (D('0'), D('999.99'), D('50')),
+            (D('2000'), D('4999.99'), D('30')),
+        ])
+        table.check()
+        self.assertIsNone(table.find(D('1500')))
+        self.assertEqual(table.find(D('2000')), D('30'))
+        self.assertEqual(len(self.log.messages), 1)
+        self.assertIn('gap', self.log.messages[0])
+
+    def test_adjacent_ranges_are_not_a_gap(self):
+        MarkupTable([
+            (D('0.00'), D('0.99'), D('50')),
+            (D('1.00'), D('1.99'), D('30')),
+        ]).check()
+        self.assertEqual(self.log.messages, [])
+
+    def test_overlap_greatest_minimum_wins(self):
+        table = MarkupTable([
+            (D('0'), D('10000'), D('50')),
+            (D('1000'), D('2000'), D('30')),
+        ])
+        table.check()
+        self.assertEqual(table.find(D('500')), D('50'))
+        self.assertEqual(table.find(D('1500')), D('30'))
+        # Past the inner range, the outer one still reaches
+        self.assertEqual(table.find(D('5000')), D('50'))
+        self.assertIn('overlap', self.log.messages[0])
+
+    def test_open_minimum(self):
+        table = MarkupTable([(None, D('1000'), D('50'))])
+        self.assertEqual(table.find(D('0')), D('50'))
+
+    def test_missing_maximum_never_matches(self):
+        table = MarkupTable([(D('0'), None, D('50'))])
+        self.assertFalse(table)
+        self.assertIsNone(table.find(D('10')))
+
+class MarkupTest(SimpleTestCase):
+    def setUp(self):
+        self.markup = Markup(
+            [(D('0'), D('100000'), D('50'))],
+            [(D('0'), D('100000'), D('10'))],
+        )
+
+    def test_apply(self):
+        self.assertEqual(self.markup.apply(D('1000'), D('1'), 'f'), D('1500'))
+        self.assertEqual(self.markup.apply(D('1000'), D('1'), 't'), D('1100'))
+        self.assertIsNone(self.markup.apply(D('200000'), D('1'), 'f'))
+
+    def test_lab_grown_falls_back_to_mined(self):
+        markup = Markup([(D('0'), D('100000'), D('50'))], [])
+        self.assertEqual(markup.apply(D('1000'), D('1'), 't'), D('1500'))
+
+    def test_by_carat_weight(self):
+        markup = Markup([(D('0'), D('0.99'), D('50')), (D('1'), D('5'), D('25'))], [], by_carat_weight=True)
+        self.assertEqual(markup.apply(D('1000'), D('0.5')), D('1500'))
+        self.assertEqual(markup.apply(D('1000'), D('1.5')), D('1250'))
+        self.assertIsNone(markup.apply(D('1000'), D('6')))
@@ -0,0 +1,84 @@
+from django.http import QueryDict
+
+from tsj_gemstone.backends.base import CopyWriter
+from tsj_gemstone.models import Diamond
+from tsj_gemstone.paginator import KeysetPaginator
+
+from .test_writers import WriterTestCase, make_row
+
+class KeysetPaginatorTest(WriterTestCase):
+    # Repeated prices, which only the id keeps in order
+    prices = ['3000.00', '1000.00', '2000.00', '1000.00', '2000.00', '1000.00', '4000.00']
+
+    def setUp(self):
+        backend = self.backend_class()
+        writer = CopyWriter(backend)
+        writer.writerows([make_row(backend, str(i), price=price) for i, price in enumerate(self.prices)])
+        writer.close()
+        self.queryset = Diamond.objects.filter(source=backend.backend_module)
+        self.field = Diamond._meta.get_field('price')
+
+    def paginator(self, descending=False):
+        return KeysetPaginator(self.queryset, 3, self.field, descending)
+
+    def walk(self, paginator):
+        "The pages from the first to the last, following the next links"
+        pages = [paginator.page(QueryDict(''))]
+        while pages[-1].has_next():
+            pages.append(paginator.page(QueryDict(pages[-1].next_query)))
+        return pages
+
+    def pks(self, page):
+        return [diamond.pk for diamond in page]
+
+    def test_forward(self):
+        pages = self.walk(self.paginator())
+        expected = list(self.queryset.order_by('price', 'pk').values_list('pk', flat=True))
+        self.assertEqual([pk for page in pages for pk in self.pks(page)], expected)
+        self.assertEqual([len(page) for page in pages], [3, 3, 1])
+        self.assertFalse(pages[0].has_previous())
+        self.assertTrue(pages[-1].has_previous())
+
+    def test_descending(self):
+        pages = self.walk(self.paginator(descending=True))
+        expected = list(self.queryset.order_by('-price', '-pk').values_list('pk', flat=True))
+        self.assertEqual([pk for page in pages for pk in self.pks(page)], expected)
+
+    def test_backward(self):
+        paginator = self.paginator()
+        pages = self.walk(paginator)
+        previous = paginator.page(QueryDict(pages[-1].previous_query))
+        self.assertEqual(self.pks(previous), self.pks(pages[1]))
+        self.assertTrue(previous.has_next())
+        self.assertTrue(previous.has_previous())
+
+        first = paginator.page(QueryDict(previous.previous_query))
+        self.assertEqual(self.pks(first), self.pks(pages[0]))
+        self.assertFalse(first.has_previous())
+
+    def test_cursor(self):
+        paginator = self.paginator()
+        diamond = self.queryset.order_by('pk')[0]
+        cursor = paginator.get_cursor(diamond)
+        self.assertEqual(paginator.parse_cursor(cursor), (diamond.price, diamond.pk))
+        for cursor in (None, '', '1000.00', 'abc~1', '1000.00~x'):
+            self.assertIsNone(paginator.parse_cursor(cursor), cursor)
+
+    def test_bad_cursor_is_first_page(self):
+        paginator = self.paginator()
+        first = paginator.page(QueryDict(''))
+        page = paginator.page(QueryDict('after=nonsense'))
+        self.assertEqual(self.pks(page), self.pks(first))
+        self.assertFalse(page.has_previous())
+
+    def test_query_keeps_filters(self):
+        page = self.paginator().page(QueryDict('cut=1&cut=2&page=4'))
+        query = QueryDict(page.next_query)
+        self.assertEqual(query.getlist('cut'), ['1', '2'])
+        self.assertNotIn('page', query)
+        self.assertIn('after', query)
+
+    def test_supports(self):
+        self.assertTrue(KeysetPaginator.supports(self.field))
+        self.assertFalse(KeysetPaginator.supports(Diamond._meta.get_field('cut')))
+        self.assertFalse(KeysetPaginator.supports(Diamond._meta.get_field('depth_percent')))
@@ -0,0 +1,98 @@
+from unittest import skipIf
+
+from django.http import QueryDict
+
+from tsj_gemstone.backends.base import CopyWriter
+from tsj_gemstone.filtersets import GemstoneFilterSet
+from tsj_gemstone.models import Clarity, Color, Diamond, update_grade_orders
+from tsj_gemstone.search_index import SearchIndex, get_search_index, numpy
+from tsj_gemstone.summary import get_summary
+
+from .test_writers import WriterTestCase, make_row
+
+class DiamondFilterSet(GemstoneFilterSet):
+    class Meta(GemstoneFilterSet.Meta):
+        model = Diamond
+
+@skipIf(numpy is None, 'NumPy is not installed')
+class SearchIndexTest(WriterTestCase):
+    flags = {'active': True}
+
+    def setUp(self):
+        self.clarities = list(Clarity.objects.order_by('order', 'pk')[:3])
+        backend = self.backend_class()
+        rows = [
+            make_row(backend, str(i), price=price, clarity_id=clarity.pk)
+            for i, (price, clarity) in enumerate(zip(
+                ['3000.00', '1000.00', '2000.00', '1000.00', '2000.00', '4000.00'],
+                self.clarities * 2))
+        ]
+        rows.append(make_row(backend, 'inactive', price='1500.00', active='f'))
+        writer = CopyWriter(backend)
+        writer.writerows(rows)
+        writer.close()
+        self.queryset = Diamond.objects.filter(source=backend.backend_module, active=True)
+
+    def search(self, query, **kwargs):
+        filterset = DiamondFilterSet(QueryDict(query), queryset=self.queryset)
+        return filterset, SearchIndex().search(self.queryset, filterset, self.flags, **kwargs)
+
+    def pks(self, found):
+        return [diamond.pk for diamond in found[:len(found)]]
+
+    def test_matches_orm(self):
+        first, second, third = self.clarities
+        for query in ('', 'price_0=1500&price_1=3000', 'clarity_0=%s&clarity_1=%s' % (third.abbr, second.abbr)):
+            for descending in (False, True):
+                filterset, found = self.search(query, descending=descending)
+                ordering = ('-price', '-pk') if descending else ('price', 'pk')
+                expected = list(filterset.qs.order_by(*ordering).values_list('pk', flat=True))
+                self.assertEqual(self.pks(found), expected, query)
+                self.assertEqual(found.count(), len(expected))
+
+    def test_active_only(self):
+        "Inactive diamonds aren't found, even if the view's flags leave active out"
+        self.flags = {}
+        filterset, found = self.search('')
+        self.assertEqual(found.count(), self.queryset.count())
+        self.assertNotIn(Diamond.objects.get(stock_number='inactive').pk, list(found.ids))
+
+    def test_unknown_order_falls_back(self):
+        "A grade the cached orders don't have yet is left to the ORM"
+        first = self.clarities[0]
+        Clarity.objects.as_order_dict()
+        # Added without signals, so the cached orders don't notice
+        Clarity.objects.bulk_create([Clarity(name='New', abbr='NEW', order=first.order)])
+        filterset, found = self.search('clarity_0=%s&clarity_1=NEW' % first.abbr)
+        self.assertIsNone(found)
+
+    def test_unsupported(self):
+        filterset, found = self.search('', sort='stock_number')
+        self.assertIsNone(found)
+        filterset, found = self.search('fluorescence_0=nonsense')
+        self.assertIsNone(found)
+
+    def test_grade_order_change(self):
+        "A search after the diamonds' orders are updated sees the new order"
+        # Colors are ordered by abbr
+        first, second, third = Color.objects.order_by('abbr')[:3]
+        backend = self.backend_class()
+        writer = CopyWriter(backend)
+        writer.writerows([make_row(backend, color.abbr, color_id=color.pk) for color in (first, second)])
+        writer.close()
+        query = 'color_0=%s&color_1=%s' % (first.abbr, third.abbr)
+
+        def found():
+            filterset = DiamondFilterSet(QueryDict(query), queryset=self.queryset)
+            found = get_search_index(get_summary()).search(self.queryset, filterset, self.flags)
+            return sorted(diamond.stock_number for diamond in found[:len(found)])
+
+        both = sorted([first.abbr, second.abbr])
+        self.assertEqual(found(), both)
+        # After every other color
+        second.abbr = 'ZZZ'
+        second.save()
+        # Loaded before update_diamond_grade_orders has run
+        self.assertEqual(found(), both)
+        update_grade_orders(Color)
+        self.assertEqual(found(), [first.abbr])
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime
+from decimal import Decimal
+import os
+
+from django.test import SimpleTestCase
+from lxml import etree
+from xlrd import open_workbook
+
+from tsj_gemstone.backends.streaming import XLSX_NS, XLSXReader, is_date_format
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+def xlrd_rows(filename):
+    "The rows IterableSheet makes of a workbook, without its UnicodeEncodeError"
+    sheet = open_workbook(filename).sheet_by_index(0)
+    return [[cell.value.encode('utf-8') if isinstance(cell.value, unicode) else str(cell.value)
+             for cell in sheet.row(rowx)] for rowx in range(sheet.nrows)]
+
+class XLSXReaderTest(SimpleTestCase):
+    def read(self, name, **kwargs):
+        with open(os.path.join(DATA_DIR, name), 'rb') as fp:
+            return list(XLSXReader(fp, **kwargs))
+
+    def assertSameAsXlrd(self, name):
+        rows = self.read(name)
+        expected = xlrd_rows(os.path.join(DATA_DIR, name))
+        self.assertEqual(len(rows), len(expected))
+        for row, expected_row in zip(rows, expected):
+            # The sheet's dimension may count columns with nothing but formatting
+            self.assertEqual(row[:len(expected_row)], expected_row)
+            self.assertFalse(any(row[len(expected_row):]))
+
+    def test_vendor_sheets(self):
+        for name in ('diamonds-treasure.xlsx', 'marquirettes.xlsx', 'unique.xlsx', 'waldman.xlsx'):
+            self.assertSameAsXlrd(name)
+
+    def test_cell_types(self):
+        self.assertSameAsXlrd('types.xlsx')
+        rows = self.read('types.xlsx')
+        self.assertEqual(rows[1], ['A1', '2.01', '2200.0', '43466.0', '43466.5', '1', '42'])
+        self.assertEqual(rows[2], [''] * 7)
+        self.assertEqual(rows[4], ['B2', '67.4', '', '', '', '0', 'Café'])
+
+    def test_typed(self):
+        rows = self.read('types.xlsx', typed=True)
+        self.assertEqual(rows[1], ['A1', Decimal('2.01'), Decimal('2200'), datetime(2019, 1, 1),
+                                   datetime(2019, 1, 1, 12), True, '#N/A'])
+        self.assertEqual(rows[4][1], Decimal('67.4'))
+        self.assertIs(rows[4][5], False)
+
+    def test_iso_dates(self):
+        "xlrd can't read t=\"d\" cells at all"
+        with open(os.path.join(DATA_DIR, 'types.xlsx'), 'rb') as fp:
+            reader = XLSXReader(fp)
+            cell = etree.fromstring('<c xmlns="%s" t="d"><v>2019-01-01T12:00:00</v></c>' % XLSX_NS[1:-1])
+            self.assertEqual(reader.value(cell), '2019-01-01T12:00:00')
+            reader.typed = True
+            self.assertEqual(reader.value(cell), datetime(2019, 1, 1, 12))
+            cell = etree.fromstring('<c xmlns="%s" t="d"><v>2019-01-01</v></c>' % XLSX_NS[1:-1])
+            self.assertEqual(reader.value(cell), datetime(2019, 1, 1))
+
+    def test_is_date_format(self):
+        self.assertTrue(is_date_format('dd/mm/yyyy\\ hh:mm'))
+        self.assertTrue(is_date_format('[$-409]mmm d, yyyy;@'))
+        self.assertFalse(is_date_format('"$"#,##0.00'))
+        self.assertFalse(is_date_format('0.00" days"'))
+        self.assertFalse(is_date_format('General'))
@@ -0,0 +1,269 @@
+from datetime import datetime
+
+from django.db import connection
+from django.test import TestCase
+
+from tsj_gemstone.backends.base import (BaseBackend, CopyWriter, DeltaCopyWriter, ImportSourceError,
+                                       StagingCopyWriter, SyncCopyWriter)
+from tsj_gemstone.models import Clarity, Cut, Diamond
+
+class WriterBackend(BaseBackend):
+    backend_module = 'writer_test'
+
+    def __init__(self, *args, **kwargs):
+        super(WriterBackend, self).__init__(*args, **kwargs)
+        self.added_date = datetime.now()
+
+def make_row(backend, stock_number, price='1000.00', **kwargs):
+    values = dict.fromkeys(backend.Row._fields, 'NULL')
+    values.update(
+        created=backend.added_date,
+        modified=backend.added_date,
+        active='t',
+        source=backend.backend_module,
+        lot_num='',
+        stock_number=stock_number,
+        owner='',
+        cut_id=Cut.objects.order_by('pk')[0].pk,
+        carat_weight='1.00',
+        carat_price=price,
+        price=price,
+        cert_num='',
+        cert_image='',
+        cert_image_local='',
+        girdle='',
+        culet='',
+        comment='',
+        city='',
+        state='',
+        country='',
+        manmade='f',
+        laser_inscribed='f',
+        data='{}',
+    )
+    values.update(kwargs)
+    return backend.Row(**values)
+
+class WriterTestCase(TestCase):
+    fixtures = (
+        'tsj_gemstone/cut.json',
+        'tsj_gemstone/color.json',
+        'tsj_gemstone/clarity.json',
+        'tsj_gemstone/grading.json',
+        'tsj_gemstone/fluorescence.json',
+    )
+    backend_class = WriterBackend
+
+    def write(self, writer_class, stock_numbers, backend=None, **kwargs):
+        backend = backend or self.backend_class()
+        writer = writer_class(backend)
+        writer.writerows([make_row(backend, stock_number, **kwargs) for stock_number in stock_numbers])
+        writer.close()
+        return writer
+
+    def stock_numbers(self, **filters):
+        return sorted(Diamond.objects.filter(source=self.backend_class.backend_module, **filters)
+                      .values_list('stock_number', flat=True))
+
+class CopyWriterTest(WriterTestCase):
+    def test_replaces_source(self):
+        self.write(CopyWriter, ['A', 'B'])
+        self.write(CopyWriter, ['B', 'C'])
+        self.assertEqual(self.stock_numbers(), ['B', 'C'])
+
+    def test_leaves_other_sources(self):
+        other = self.backend_class()
+        other.backend_module = 'writer_other'
+        self.write(CopyWriter, ['X'], backend=other)
+        self.write(CopyWriter, ['A'])
+        self.assertEqual(Diamond.objects.filter(source='writer_other').count(), 1)
+
+    def test_stages_outside_the_table(self):
+        "Nothing changes in the diamond table until close()"
+        self.write(CopyWriter, ['A'])
+        backend = self.backend_class()
+        writer = CopyWriter(backend, buffer_size=1)
+        writer.writerows([make_row(backend, 'B')])
+        self.assertEqual(self.stock_numbers(), ['A'])
+
+        cursor = connection.cursor()
+        cursor.execute('SELECT stock_number FROM %s' % writer.staging_table)
+        self.assertEqual(cursor.fetchall(), [('B',)])
+
+        writer.abort()
+        self.assertEqual(self.stock_numbers(), ['A'])
+        cursor.execute('SELECT to_regclass(%s)', (writer.staging_table,))
+        self.assertIsNone(cursor.fetchone()[0])
+
+    def test_ids_drawn_once(self):
+        "Staging the rows doesn't use up ids"
+        self.write(CopyWriter, ['A'])
+        last = Diamond.objects.get(stock_number='A').pk
+        self.write(CopyWriter, ['B', 'C'])
+        self.assertEqual(sorted(Diamond.objects.filter(source=self.backend_class.backend_module)
+                                .values_list('pk', flat=True)), [last + 1, last + 2])
+
+    def test_sets_grade_orders(self):
+        clarity = Clarity.objects.order_by('pk')[0]
+        self.write(CopyWriter, ['A'], clarity_id=clarity.pk)
+        self.assertEqual(Diamond.objects.get(source=self.backend_class.backend_module).clarity_order, clarity.order)
+
+class PartitionTest(WriterTestCase):
+    def partition(self, source):
+        cursor = connection.cursor()
+        cursor.execute('SELECT tsj_gemstone_diamond_partition(%s)', (source,))
+        return cursor.fetchone()[0]
+
+    def test_names_dont_collide(self):
+        names = set(self.partition(source) for source in ('a-b', 'a_b', 'A_B', 'x' * 40, 'x' * 41))
+        self.assertEqual(len(names), 5)
+        self.assertTrue(all(len(name) < 64 for name in names))
+
+    def test_finds_existing_partition(self):
+        self.assertEqual(self.partition('a-b'), self.partition('a-b'))
+
+    def test_replacing_imports_swap_partitions(self):
+        backend = self.backend_class()
+        self.assertIsInstance(backend.get_writer(), StagingCopyWriter)
+        backend.replaces_source = False
+        self.assertNotIsInstance(backend.get_writer(), StagingCopyWriter)
+
+class StagingCopyWriterTest(WriterTestCase):
+    def partition_count(self):
+        cursor = connection.cursor()
+        cursor.execute('SELECT tsj_gemstone_diamond_partition(%s)', (self.backend_class.backend_module,))
+        cursor.execute('SELECT COUNT(*) FROM %s' % cursor.fetchone()[0])
+        return cursor.fetchone()[0]
+
+    def test_swaps_partition(self):
+        self.write(StagingCopyWriter, ['A', 'B'])
+        writer = self.write(StagingCopyWriter, ['C'])
+        self.assertTrue(writer.attach)
+        self.assertEqual(self.stock_numbers(), ['C'])
+        self.assertEqual(self.partition_count(), 1)
+
+    def test_partial_import_inserts(self):
+        self.write(StagingCopyWriter, ['A'])
+        backend = self.backend_class()
+        backend.replaces_source = False
+        writer = self.write(StagingCopyWriter, ['B'], backend=backend)
+        self.assertFalse(writer.attach)
+        self.assertEqual(self.stock_numbers(), ['A', 'B'])
+
+    def test_missing_rows_abort(self):
+        self.write(StagingCopyWriter, ['A'])
+        backend = self.backend_class()
+        writer = StagingCopyWriter(backend)
+        writer.writerows([make_row(backend, 'B')])
+        writer.row_count += 1
+        with self.assertRaises(ImportSourceError):
+            writer.close()
+        self.assertEqual(self.stock_numbers(), ['A'])
+        cursor = connection.cursor()
+        cursor.execute('SELECT to_regclass(%s)', (writer.staging_table,))
+        self.assertIsNone(cursor.fetchone()[0])
+
+class DeltaBackend(WriterBackend):
+    delta_import = True
+
+class DeltaCopyWriterTest(WriterTestCase):
+    backend_class = DeltaBackend
+
+    def test_writes_differences(self):
+        self.write(DeltaCopyWriter, ['A', 'B', 'C'])
+        ids = dict(Diamond.objects.values_list('stock_number', 'pk'))
+
+        backend = self.backend_class()
+        writer = DeltaCopyWriter(backend)
+        writer.writerows([
+            make_row(backend, 'A'),
+            make_row(backend, 'B', price='2000.00'),
+            make_row(backend, 'D'),
+        ])
+        writer.close()
+
+        self.assertEqual(self.stock_numbers(active=True), ['A', 'B', 'D'])
+        self.assertEqual(self.stock_numbers(active=False), ['C'])
+        diamonds = dict((d.stock_number, d) for d in Diamond.objects.all())
+        self.assertEqual(diamonds['A'].pk, ids['A'])
+        self.assertEqual(diamonds['B'].pk, ids['B'])
+        self.assertEqual(str(diamonds['B'].price), '2000.00')
+
+    def test_reactivates(self):
+        self.write(DeltaCopyWriter, ['A', 'B'])
+        self.write(DeltaCopyWriter, ['A'])
+        self.write(DeltaCopyWriter, ['A', 'B'])
+        self.assertEqual(self.stock_numbers(active=True), ['A', 'B'])
+        self.assertEqual(Diamond.objects.count(), 2)
+
+    def test_drops_repeats(self):
+        self.write(DeltaCopyWriter, ['A', 'A'])
+        self.assertEqual(self.stock_numbers(), ['A'])
+
+    def test_skips_rows_without_key(self):
+        "Rows without a delta_key would be inserted again on every run"
+        backend = self.backend_class()
+        writer = DeltaCopyWriter(backend)
+        for stock_number in ('A', '', 'NULL'):
+            backend.write_diamond_row = lambda: make_row(backend, stock_number)
+            backend.try_write_row(writer)
+        writer.writerows(backend.row_buffer)
+        writer.close()
+
+        self.assertEqual(self.stock_numbers(), ['A'])
+        self.assertEqual(backend.import_successes, 1)
+        self.assertEqual(sum(backend.skip_counts.values()), 2)
+
+    def test_does_not_build_partition(self):
+        backend = self.backend_class()
+        writer = DeltaCopyWriter(backend)
+        writer.writerows([make_row(backend, 'A')])
+        writer.flush()
+        self.assertFalse(writer.attach)
+        cursor = connection.cursor()
+        cursor.execute('SELECT relpersistence FROM pg_class WHERE oid=%s::regclass', (writer.staging_table,))
+        self.assertEqual(cursor.fetchone()[0], 'u')
+        writer.abort()
+
+class SyncBackend(WriterBackend):
+    sync_import = True
+
+class SyncCopyWriterTest(WriterTestCase):
+    backend_class = SyncBackend
+
+    def test_uses_sync_writer(self):
+        self.assertIsInstance(self.backend_class().get_writer(), SyncCopyWriter)
+
+    def test_updates_synced_fields(self):
+        "Stored diamonds keep their id and everything the point of sale doesn't sync"
+        self.write(SyncCopyWriter, ['A', 'B'], comment='first')
+        ids = dict(Diamond.objects.values_list('stock_number', 'pk'))
+
+        self.write(SyncCopyWriter, ['A', 'B', 'C'], price='2000.00', comment='second')
+
+        diamonds = dict((d.stock_number, d) for d in Diamond.objects.all())
+        self.assertEqual(sorted(diamonds), ['A', 'B', 'C'])
+        self.assertEqual(diamonds['A'].pk, ids['A'])
+        self.assertEqual(str(diamonds['A'].price), '2000.00')
+        self.assertEqual(str(diamonds['A'].carat_price), '2000.00')
+        self.assertEqual(diamonds['A'].comment, 'first')
+        self.assertEqual(diamonds['C'].comment, 'second')
+
+    def test_deactivates_missing(self):
+        self.write(SyncCopyWriter, ['A', 'B'])
+        self.write(SyncCopyWriter, ['A'])
+        self.assertEqual(self.stock_numbers(active=True), ['A'])
+        self.assertEqual(self.stock_numbers(active=False), ['B'])
+
+        self.write(SyncCopyWriter, ['A', 'B'])
+        self.assertEqual(self.stock_numbers(active=True), ['A', 'B'])
+        self.assertEqual(Diamond.objects.count(), 2)
+
+    def test_partial_sync_leaves_missing(self):
+        self.write(SyncCopyWriter, ['A', 'B'])
+        backend = self.backend_class()
+        backend.partial_import = True
+        self.write(SyncCopyWriter, ['B', 'C'], backend=backend, price='2000.00')
+        self.assertEqual(self.stock_numbers(active=True), ['A', 'B', 'C'])
+        self.assertEqual(str(Diamond.objects.get(stock_number='A').price), '1000.00')
+        self.assertEqual(str(Diamond.objects.get(stock_number='B').price), '2000.00')
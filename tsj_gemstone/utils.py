@@ -1,6 +1,7 @@
 import csv
 from decimal import Decimal
 from importlib import import_module
+import zipfile
 
 IMPORTER_MODULES_PACKAGE = 'tsj_gemstone.backends'
 
@@ -12,6 +13,12 @@ def get_backend(mod):
 def _excel_header(fn):
     # TODO: Move import to module level once xlrd is installed on all sites
     import xlrd
+    from tsj_gemstone.backends.streaming import XLSXReader
+
+    with open(fn, 'rb') as fp:
+        if zipfile.is_zipfile(fp):
+            fp.seek(0)
+            return next(XLSXReader(fp), [])
 
     wb = xlrd.open_workbook(file_contents=open(fn, 'rb').read())
     sheet = wb.sheets()[0]
@@ -1,9 +1,9 @@
 from decimal import *
 import json
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import NoReverseMatch
-from django.db.models import Min, Max
 from django.db.models.fields import FieldDoesNotExist
 from django.http import Http404, HttpResponse, JsonResponse
 from django.shortcuts import redirect, render
@@ -23,12 +23,20 @@ from tsj_jewelrybox.forms import InquiryForm
 from thinkspace.apps.pages.settings import TSPAGES_PAGE_ARG
 
 from .filtersets import GemstoneFilterSet, FancyColorFilterSet
-from .models import Cut, Color, Clarity, Diamond, Grading, Fluorescence, FluorescenceColor, Certifier
+from .managers import remember_schema
+from .models import Color, Clarity, Diamond, Grading, FluorescenceColor, Certifier
+from .paginator import KeysetPaginator
+from .search_index import SEARCH_INDEX, get_search_index
+from .summary import get_summary
 
 # TODO: Move to thinkspace, probably also bring up to date with the
 #       current paginator code in Django.
 from tsj_catalog_local.digg_paginator import QuerySetDiggPaginator
 
+# Page the list views with ?after=/?before= cursors rather than page numbers
+# (see paginator.py) whenever they're sorted by a column which allows it
+KEYSET_PAGINATION = getattr(settings, 'TSJ_GEMSTONE_KEYSET_PAGINATION', False)
+
 def _get_queryset_ordering(qs, querystring, opts):
     # Sorting
     try:
@@ -53,14 +61,33 @@ def _get_queryset_ordering(qs, querystring, opts):
 
     return qs
 
+def _get_keyset_ordering(qs):
+    "The field and direction to page a queryset by, or None if it can't be keyset paginated"
+    ordering = qs.query.order_by or qs.model._meta.ordering
+    if len(ordering) != 1:
+        return None
+    name = ordering[0]
+    try:
+        field = qs.model._meta.get_field(name.lstrip('-'))
+    except FieldDoesNotExist:
+        return None
+    if not KeysetPaginator.supports(field):
+        return None
+    return field, name.startswith('-')
+
 class GemstoneListView(PagesTemplateResponseMixin, ListView):
     model = Diamond
     template_name = 'tsj_gemstone/tspages/gemstone-list.html'
     no_template_name = 'tsj_gemstone/tspages/gemstone-no-list.html'
     filterset = GemstoneFilterSet
+    # What get_queryset() selects, as flags of the inventory summary's groups
+    summary_flags = {'active': True}
 
     gemstones_template = 'tsj_gemstone/includes/gemstones.html'
     pagination_template = 'tsj_gemstone/includes/pagination.html'
+    keyset_pagination = KEYSET_PAGINATION
+    keyset_pagination_template = 'tsj_gemstone/includes/keyset-pagination.html'
+    search_index = SEARCH_INDEX
 
     def get_queryset(self):
         querystring = self.request.GET
@@ -100,7 +127,11 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
         if arguments.get('hide_manmade'):
             queryset = queryset.exclude(manmade=True)
 
-        if queryset.exists():
+        inventory = get_summary()
+        totals = inventory.totals(sources=arguments.get('sources'),
+                                  hide_manmade=arguments.get('hide_manmade'),
+                                  **self.summary_flags)
+        if totals:
 
             # Minimum and Maximum Values
             """
@@ -109,21 +140,19 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
             context['cuts'] = Cut.objects.filter(abbr__in=cuts).order_by('order')
             context['other_cuts'] = Cut.objects.exclude(abbr__in=cuts).order_by('order')
             """
-            distinct_cuts = Diamond.objects.values_list('cut', flat=True).order_by('cut__id').distinct('cut__id')
-            context['cuts'] = Cut.objects.filter(id__in=distinct_cuts).order_by('order')
-            context['colors'] = Color.objects.all().order_by('-abbr')
-            context['clarities'] = Clarity.objects.all().order_by('-order')
-            context['gradings'] = Grading.objects.all().order_by('-order')
-            context['fluorescences'] = Fluorescence.objects.all().order_by('-order')
-
-            aggregate = queryset.aggregate(Min('carat_weight'), Max('carat_weight'), Min('price'), Max('price'))
+            context['cuts'] = totals['cuts']
+            context['colors'] = inventory.colors
+            context['clarities'] = inventory.clarities
+            context['gradings'] = inventory.gradings
+            context['fluorescences'] = inventory.fluorescences
+
             carat_weights = {
-                'min': aggregate['carat_weight__min'],
-                'max': aggregate['carat_weight__max'],
+                'min': totals['carat_weight_min'],
+                'max': totals['carat_weight_max'],
             }
             prices = {
-                'min': floatformat(aggregate['price__min'], 0),
-                'max': floatformat(aggregate['price__max'], 0),
+                'min': floatformat(totals['price_min'], 0),
+                'max': floatformat(totals['price_max'], 0),
             }
 
             initial = {
@@ -160,6 +189,9 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
                 initial.update(q)
 
             filterset = self.filterset(initial, queryset=queryset)
+            # Rather than the labs of every diamond in the table
+            certifier_ids = [certifier.id for certifier in totals['certifiers'] if not certifier.disabled]
+            filterset.filters['certifier'].extra['queryset'] = Certifier.objects.filter(id__in=certifier_ids)
 
             context.update({
                 'carat_weights': carat_weights,
@@ -173,16 +205,45 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
                 'sort': sort,
             })
 
-            paginator = QuerySetDiggPaginator(filterset, 50, body=5, padding=2)
-            try:
-                paginator_page = paginator.page(self.request.GET.get('page', 1))
-            except:
-                paginator_page = paginator.page(paginator.num_pages)
+            found = None
+            if self.search_index:
+                ordering = _get_keyset_ordering(self.object_list)
+                if ordering:
+                    found = get_search_index(inventory).search(
+                        self.object_list, filterset, self.summary_flags,
+                        sources=arguments.get('sources'), hide_manmade=arguments.get('hide_manmade'),
+                        sort=ordering[0].name, descending=ordering[1])
+
+            keyset_ordering = found is None and self.keyset_pagination and _get_keyset_ordering(filterset.qs)
+            if keyset_ordering:
+                field, descending = keyset_ordering
+                if hasattr(initial, 'lists'):
+                    data = dict(initial.lists())
+                else:
+                    data = dict(initial)
+                for name in ('page', 'after', 'before', 'sort', 'order'):
+                    data.pop(name, None)
+                count = inventory.count(filterset.qs, self.__class__.__name__,
+                                        arguments.get('sources'), arguments.get('hide_manmade'),
+                                        sorted(data.items()))
+                paginator = KeysetPaginator(filterset.qs, 50, field, descending, count=count)
+                paginator_page = paginator.page(self.request.GET)
+                pagination_template = self.keyset_pagination_template
+            else:
+                # The search index's results page in memory just as well
+                paginator = QuerySetDiggPaginator(filterset if found is None else found, 50, body=5, padding=2)
+                try:
+                    paginator_page = paginator.page(self.request.GET.get('page', 1))
+                except:
+                    paginator_page = paginator.page(paginator.num_pages)
+                pagination_template = self.pagination_template
 
             context.update(dict(
                 object_list = paginator_page.object_list,
                 paginator = paginator,
                 page = paginator_page,
+                keyset_pagination = bool(keyset_ordering),
+                pagination_template = pagination_template,
             ))
 
         else:
@@ -194,7 +255,7 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
 
     def render_to_response(self, context, **response_kwargs):
         gemstones_template = self.gemstones_template
-        pagination_template = self.pagination_template
+        pagination_template = context.get('pagination_template', self.pagination_template)
 
         if self.request.is_ajax():
             response_dict = dict(
@@ -215,18 +276,23 @@ class GemstoneListView(PagesTemplateResponseMixin, ListView):
 
     @method_decorator(requires_csrf_token)
     def dispatch(self, *args, **kwargs):
-        return super(GemstoneListView, self).dispatch(*args, **kwargs)
+        # The summary and grade orders are cached by schema
+        with remember_schema():
+            return super(GemstoneListView, self).dispatch(*args, **kwargs)
 
 class FancyColorGemstoneListView(GemstoneListView):
     template_name = 'tsj_gemstone/tspages/gemstone-fancy-list.html'
     filterset = FancyColorFilterSet
+    summary_flags = {'active': True, 'fancy': True}
 
     def get_queryset(self):
-        return self.model.objects.filter(fancy_color__isnull=False)
+        return self.model.objects.filter(active=True, fancy_color__isnull=False)
 
 class LabGrownGemstoneListView(GemstoneListView):
+    summary_flags = {'active': True, 'manmade': True}
+
     def get_queryset(self):
-        return self.model.objects.filter(manmade=True)
+        return self.model.objects.filter(active=True, manmade=True)
 
 class GemstoneDetailView(PagesTemplateResponseMixin, DetailView):
     model = Diamond
@@ -244,7 +310,8 @@ class GemstoneDetailView(PagesTemplateResponseMixin, DetailView):
         return self.render_to_response(context)
 
     def get_queryset(self):
-        qs = super(GemstoneDetailView, self).get_queryset()
+        # Diamonds which have dropped out of their feed are kept inactive
+        qs = super(GemstoneDetailView, self).get_queryset().filter(active=True)
         qs = qs.select_related('clarity', 'color', 'cut', 'cut_grade', 'certifier', 'fluorescence', 'fluorescence_color', 'polish', 'symmetry')
         return qs
 
@@ -274,6 +341,7 @@ class GemstoneDetailView(PagesTemplateResponseMixin, DetailView):
         similar_gt = float(self.object.carat_weight) + .15
 
         similar = Diamond.objects.filter(
+                    active=True,
                     carat_weight__range=(similar_lt, similar_gt),
                     cut=self.object.cut,
                     color=self.object.color,